@@ -0,0 +1,51 @@
+'''
+Closing runtime against the radius: skimage's binary_closing with a diamond footprint (cost grows with the
+footprint area) against diamond_closing (distance-transform based, flat in the radius).
+
+    python benchmarks/bench_closing.py [--size 2000] [--radii 1 2 4 8 16 32] [--repeat 3]
+'''
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from create_rois import diamond_closing  # noqa: E402
+
+
+def best_of(repeat, fn, *args):
+    times = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - tic)
+    return min(times)
+
+
+def skimage_closing(mask, radius):
+    from skimage.morphology import diamond, binary_closing
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        return binary_closing(mask, diamond(radius))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=2000, help='mask is size x size pixels')
+    parser.add_argument('--radii', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    mask = rng.rand(args.size, args.size) > 0.97
+
+    print('{:>6} {:>16} {:>16} {:>8}'.format('radius', 'binary_closing', 'diamond_closing', 'same'))
+    for radius in args.radii:
+        reference = skimage_closing(mask, radius)
+        fast = diamond_closing(mask, radius)
+        t_ref = best_of(args.repeat, skimage_closing, mask, radius)
+        t_fast = best_of(args.repeat, diamond_closing, mask, radius)
+        print('{:>6} {:>15.3f}s {:>15.3f}s {:>8}'.format(radius, t_ref, t_fast, str(np.array_equal(reference, fast))))
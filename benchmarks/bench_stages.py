@@ -0,0 +1,217 @@
+'''
+Times and memory-profiles every stage of create_rois on synthetic slides (see synthetic.py), and reports how each
+stage scales with the image size and with the number of regions.
+
+    python benchmarks/bench_stages.py                              # default sweep, prints tables
+    python benchmarks/bench_stages.py --save bench.json            # keep the numbers
+    python benchmarks/bench_stages.py --compare bench.json         # exit 1 if a stage got slower than the baseline
+
+Stages: gray/threshold, closing, labeling, size filtering, prune_regions (aspect ratio + clustering),
+cluster_regions and order_regions. Memory is the tracemalloc peak while the stage runs (numpy allocations included).
+'''
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from create_rois import (inverted_gray, threshold_value, diamond_closing, filter_small_regions,  # noqa: E402
+                         prune_regions, cluster_regions, order_regions)
+from region_set import RegionSet  # noqa: E402
+from synthetic import synthetic_slide  # noqa: E402
+
+STAGES = ('threshold', 'closing', 'labeling', 'size_filter', 'prune_regions', 'cluster_regions', 'order_regions')
+
+
+def measure(fn, *args):
+    '''
+    (result, seconds, peak bytes) of one call.
+    '''
+    tracemalloc.start()
+    tic = time.perf_counter()
+    result = fn(*args)
+    seconds = time.perf_counter() - tic
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def run_stages(image, method, closing, size_thresh, scale_factor, repeat):
+    '''
+    Runs create_rois stage by stage; returns {stage: (best seconds, peak bytes)} and the number of candidate boxes.
+    '''
+    from skimage.measure import label, regionprops
+
+    def threshold(image):
+        im = inverted_gray(image)
+        return im > threshold_value(im, method)
+
+    def labeling(mask):
+        return label(mask)
+
+    def size_filter(im_lab):
+        im_lab = filter_small_regions(im_lab.copy(), size_thresh / (scale_factor ** 2))
+        return RegionSet([r.bbox for r in regionprops(im_lab)])
+
+    steps = [('threshold', threshold), ('closing', lambda mask: diamond_closing(mask, closing)),
+             ('labeling', labeling), ('size_filter', size_filter), ('prune_regions', prune_regions)]
+    results = {}
+    value = image
+    for name, fn in steps:
+        best = None
+        for _ in range(repeat):
+            out, seconds, peak = measure(fn, value)
+            best = (seconds, peak) if best is None else (min(best[0], seconds), max(best[1], peak))
+        results[name] = best
+        if name == 'size_filter':
+            candidates = out
+        value = out
+
+    # clustering and ordering on their own, on the same inputs create_rois gives them
+    elongated = candidates.elongated(4)
+    for name, fn, arg in [('cluster_regions', cluster_regions, candidates[~elongated]),
+                          ('order_regions', order_regions, value)]:
+        timings = [measure(fn, arg) for _ in range(repeat)]
+        results[name] = (min(t[1] for t in timings), max(t[2] for t in timings))
+    return results, len(candidates)
+
+
+def slope(xs, ys):
+    '''
+    Log-log slope: ~1 means linear in x, ~2 quadratic, ~0 flat.
+    '''
+    xs, ys = np.log(np.asarray(xs, float)), np.log(np.maximum(np.asarray(ys, float), 1e-6))
+    if len(xs) < 2 or np.ptp(xs) == 0:
+        return float('nan')
+    return float(np.polyfit(xs, ys, 1)[0])
+
+
+def print_table(title, column, rows):
+    print('\n' + title)
+    print('{:>12} {:>10} '.format(column, 'boxes') + ' '.join('{:>16}'.format(s) for s in STAGES))
+    for row in rows:
+        cells = ['{:>8.1f}ms/{:>4.0f}M'.format(row['stages'][s][0] * 1000, row['stages'][s][1] / 2 ** 20) for s in STAGES]
+        print('{:>12} {:>10} '.format(row[column], row['boxes']) + ' '.join(cells))
+    xs = [row['scaling_x'] for row in rows]
+    print('{:>23} '.format('time ~ x^') + ' '.join(
+        '{:>16.2f}'.format(slope(xs, [row['stages'][s][0] for row in rows])) for s in STAGES))
+
+
+def random_boxes(n, seed=0, size=60):
+    # boxes scattered over a square with about one box starting per pixel row, like test_create_rois' random_boxes
+    rng = np.random.RandomState(seed)
+    y1, x1 = rng.randint(0, n, size=(2, n))
+    h, w = rng.randint(1, size, size=(2, n))
+    return RegionSet(np.stack([y1, x1, y1 + h, x1 + w], axis=1))
+
+
+def tma_boxes(rows, cols, seed=0, size=30, pitch=45, jitter=6):
+    # a tissue microarray: a grid of cores with some positional noise, like test_create_rois' tma_grid
+    rng = np.random.RandomState(seed)
+    r, c = np.divmod(np.arange(rows * cols), cols)
+    y = 100 + r * pitch + rng.randint(-jitter, jitter + 1, size=rows * cols)
+    x = 100 + c * pitch + rng.randint(-jitter, jitter + 1, size=rows * cols)
+    return RegionSet(np.stack([y, x, y + size, x + size], axis=1)[::-1])
+
+
+def box_sweep(title, fn, inputs, repeat):
+    '''
+    Best time of fn on each (number of boxes, boxes) input, printed with the log-log slope against the number of boxes.
+    '''
+    rows = []
+    for n, boxes in inputs:
+        rows.append({'boxes': n, 'seconds': min(measure(fn, boxes)[1] for _ in range(repeat))})
+    print('\n' + title)
+    for row in rows:
+        print('{:>12} {:>10.1f}ms'.format(row['boxes'], row['seconds'] * 1000))
+    print('{:>12} {:>12.2f}'.format('time ~ x^', slope([r['boxes'] for r in rows], [r['seconds'] for r in rows])))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-stage benchmark of create_rois')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048, 4096],
+                        help='image widths for the image-size sweep (height is 3/4 of it)')
+    parser.add_argument('--grids', type=int, nargs='+', default=[2, 5, 10, 20, 40],
+                        help='n for the n x n grid region-count sweep')
+    parser.add_argument('--grid-width', type=int, default=2048, help='image width for the region-count sweep')
+    parser.add_argument('--cluster-boxes', type=int, nargs='+', default=[1000, 5000, 20000],
+                        help='numbers of random boxes for the cluster_regions sweep')
+    parser.add_argument('--tma-grids', type=int, nargs='+', default=[10, 30, 60, 100],
+                        help='n for the n x n tissue microarray order_regions sweep')
+    parser.add_argument('--specks-per-mpx', type=int, default=2000)
+    parser.add_argument('--method', default='triangle')
+    parser.add_argument('--closing', type=int, default=5)
+    parser.add_argument('--size-thresh', type=float, default=200)
+    parser.add_argument('--scale-factor', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file written by --save')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='with --compare, fail if a stage is this many times slower than the baseline')
+    args = parser.parse_args()
+
+    def bench(width, grid):
+        shape = (width * 3 // 4, width)
+        specks = int(args.specks_per_mpx * shape[0] * shape[1] / 1e6)
+        image, _ = synthetic_slide(shape, grid=grid, specks=specks, seed=0)
+        stages, boxes = run_stages(image, args.method, args.closing, args.size_thresh, args.scale_factor, args.repeat)
+        return {'width': width, 'grid': '{}x{}'.format(*grid), 'boxes': boxes, 'stages': stages}
+
+    by_size = []
+    for width in args.sizes:
+        row = bench(width, (4, 6))
+        row['scaling_x'] = width * width
+        by_size.append(row)
+    print_table('Image size sweep (4x6 grid; time ~ x^ is against the pixel count)', 'width', by_size)
+
+    by_count = []
+    for n in args.grids:
+        row = bench(args.grid_width, (n, n))
+        row['scaling_x'] = n * n
+        by_count.append(row)
+    print_table('Region count sweep (width {}; time ~ x^ is against the number of sections)'.format(args.grid_width),
+                'grid', by_count)
+
+    by_boxes = box_sweep('cluster_regions on random boxes', cluster_regions,
+                         [(n, random_boxes(n)) for n in args.cluster_boxes], args.repeat)
+
+    by_cores = box_sweep('order_regions on tissue microarrays', order_regions,
+                         [(n * n, tma_boxes(n, n)) for n in args.tma_grids], args.repeat)
+
+    results = {'image_size': by_size, 'region_count': by_count, 'cluster_boxes': by_boxes, 'order_cores': by_cores}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = []
+        for sweep, key in [('image_size', 'width'), ('region_count', 'grid')]:
+            old_rows = {row[key]: row for row in baseline.get(sweep, [])}
+            for row in results[sweep]:
+                old = old_rows.get(row[key])
+                if old is None:
+                    continue
+                for stage in STAGES:
+                    before, now = old['stages'][stage][0], row['stages'][stage][0]
+                    # ignore sub-millisecond noise
+                    if now > args.tolerance * before and now - before > 1e-3:
+                        regressions.append('{} {}={}: {} {:.1f}ms -> {:.1f}ms'.format(
+                            sweep, key, row[key], stage, before * 1000, now * 1000))
+        for sweep in ('cluster_boxes', 'order_cores'):
+            old_rows = {row['boxes']: row for row in baseline.get(sweep, [])}
+            for row in results[sweep]:
+                old = old_rows.get(row['boxes'])
+                if old is not None and row['seconds'] > args.tolerance * old['seconds'] and row['seconds'] - old['seconds'] > 1e-3:
+                    regressions.append('{} boxes={}: {:.1f}ms -> {:.1f}ms'.format(
+                        sweep, row['boxes'], old['seconds'] * 1000, row['seconds'] * 1000))
+        if regressions:
+            print('\nRegressions:\n  ' + '\n  '.join(regressions))
+            sys.exit(1)
+        print('\nNo regressions against {}'.format(args.compare))
@@ -0,0 +1,125 @@
+'''
+End-to-end load test against the local OMERO stand-in (src/omero_standin.py): login, image listing, thumbnail
+downloads, create_rois and ROI saves through run_batch, at several concurrency levels, reporting images/minute.
+Latency, errors and a server capacity can be injected to see how the pipeline (and --retries/--adaptive-limit)
+copes with a slow or struggling server.
+
+    python benchmarks/load_test.py [--images 64] [--concurrency 1 2 4 8 16] [--latency 0.05] [--capacity 8]
+
+Saves go through save_rois on the stand-in's fake Blitz gateway when omero-py is installed; without it they are
+simulated (one Blitz round trip per image, regions counted but not built), which the output says.
+'''
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from batch import run_batch  # noqa: E402
+from client_policy import policy_from_args  # noqa: E402
+from create_session import create_json_session  # noqa: E402
+from omero_standin import FakeBlitzGateway, StandInServer  # noqa: E402
+from retrieve_image import ImageClient, get_image  # noqa: E402
+
+
+def have_omero():
+    try:
+        import omero.model  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def run_level(standin, concurrency, args):
+    '''
+    One run of the whole dataset with concurrency fetch and upload threads; returns the row of the report.
+    '''
+    policy = policy_from_args(args.retries, args.adaptive_limit)
+    call = policy.call if policy is not None else (lambda fn, *a, **kw: fn(*a, **kw))
+    real_saves = have_omero()
+    if real_saves:
+        from save_rois import save_rois
+
+    standin.hits.clear()
+    standin.rois.clear()
+    tic = time.perf_counter()
+    login_rsp, session, base_url = call(create_json_session, standin.host, standin.username, standin.password)
+    client = ImageClient(session, base_url, pool_size=concurrency, policy=policy)
+    image_ids = client.prefetch_dataset(1)
+
+    local = threading.local()
+
+    def fetch_image(image_id):
+        return client.retrieve(image_id, args.scale_factor, args.grayscale)
+
+    def save_regions(image_id, regions):
+        if not hasattr(local, 'conn'):
+            local.conn = FakeBlitzGateway(standin)
+            call(local.conn.connect)
+        image = call(get_image, local.conn, image_id)
+        if real_saves:
+            call(save_rois, image, regions, args.scale_factor, True)
+
+    params = {'size_thresh': args.size_thresh, 'method_thresh': args.method,
+              'closing': args.closing, 'scale_factor': args.scale_factor}
+    results = run_batch(image_ids, fetch_image, save_regions, params, fetch_workers=concurrency,
+                        detect_workers=args.detect_workers, upload_workers=concurrency)
+    seconds = time.perf_counter() - tic
+
+    ok = [r for r in results if r.status == 'ok']
+    latencies = np.array([r.seconds for r in ok]) if ok else np.zeros(1)
+    return {'concurrency': concurrency, 'images': len(results), 'ok': len(ok), 'failed': len(results) - len(ok),
+            'seconds': seconds, 'images_per_minute': 60 * len(ok) / seconds,
+            'p50': float(np.percentile(latencies, 50)), 'p95': float(np.percentile(latencies, 95)),
+            'requests': sum(standin.hits.values()), 'retries': policy.retries if policy is not None else 0,
+            'limits': policy.limiter.limits() if policy is not None and policy.limiter is not None else None}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='End-to-end load test against a local OMERO stand-in')
+    parser.add_argument('--images', type=int, default=64, help='number of images in the dataset')
+    parser.add_argument('--image-width', type=int, default=32768, help='full-resolution width of the images')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                        help='fetch/upload threads for each run')
+    parser.add_argument('--detect-workers', type=int, default=None)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every request and Blitz call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random latency, up to this many seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls failing with a 503')
+    parser.add_argument('--capacity', type=int, default=None, help='requests the server handles at once')
+    parser.add_argument('--scale-factor', type=int, default=64)
+    parser.add_argument('--size-thresh', type=float, default=200)
+    parser.add_argument('--method', default='triangle')
+    parser.add_argument('--closing', type=int, default=5)
+    parser.add_argument('--grayscale', action='store_true')
+    parser.add_argument('--retries', type=int, default=0)
+    parser.add_argument('--adaptive-limit', type=int, default=0, metavar='MAX')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    images = {i: (args.image_width, args.image_width * 3 // 4) for i in range(1, args.images + 1)}
+    standin = StandInServer(images, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                            capacity=args.capacity)
+    rows = []
+    with standin:
+        # render every thumbnail once up front, so the first run doesn't pay for the stand-in's own work
+        for i, (size_x, size_y) in images.items():
+            width = round(size_x / args.scale_factor)
+            standin.slide(i, width, max(1, round(width * size_y / size_x)))
+        print('{} images, latency {}s (+{}s jitter), error rate {}, capacity {}{}'.format(
+            args.images, args.latency, args.jitter, args.error_rate, args.capacity or 'unlimited',
+            '' if have_omero() else ' - omero-py not installed, saves simulated'))
+        print('{:>11} {:>8} {:>7} {:>9} {:>10} {:>8} {:>8} {:>9} {:>8}'.format(
+            'concurrency', 'ok', 'failed', 'seconds', 'images/min', 'p50', 'p95', 'requests', 'retries'))
+        for concurrency in args.concurrency:
+            row = run_level(standin, concurrency, args)
+            rows.append(row)
+            print('{concurrency:>11} {ok:>8} {failed:>7} {seconds:>9.2f} {images_per_minute:>10.1f} '
+                  '{p50:>8.3f} {p95:>8.3f} {requests:>9} {retries:>8}'.format(**row))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'args': vars(args), 'runs': rows}, f, indent=2)
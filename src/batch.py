@@ -0,0 +1,292 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    from .create_rois import create_rois
+    from .result_store import thumbnail_checksum
+    from . import metrics
+except ImportError:
+    from create_rois import create_rois
+    from result_store import thumbnail_checksum
+    import metrics
+
+
+class ImageResult(object):
+    '''
+    Outcome of running the pipeline on one image. status is 'ok', 'skipped' (unchanged since the last run) or 'failed';
+    for failures, stage says where it broke ('fetch', 'detect' or 'upload') and error holds the exception message.
+    '''
+    __slots__ = ('image_id', 'status', 'stage', 'error', 'n_regions', 'seconds')
+
+    def __init__(self, image_id, status, stage=None, error=None, n_regions=None, seconds=None):
+        self.image_id = image_id
+        self.status = status
+        self.stage = stage
+        self.error = error
+        self.n_regions = n_regions
+        self.seconds = seconds
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __repr__(self):
+        return 'ImageResult({})'.format(', '.join('{}={!r}'.format(k, getattr(self, k)) for k in self.__slots__))
+
+
+def run_batch(image_ids, fetch_image, save_regions, detection_params,
+              fetch_workers=4, detect_workers=None, upload_workers=2, max_pending=None, store=None):
+    '''
+    Runs retrieve -> detect -> save over many images, with the three stages overlapping: thumbnails are fetched by a
+    bounded thread pool, create_rois runs in a process pool and uploads go through their own bounded thread pool.
+    At most max_pending images are in flight at once (fetched but not yet uploaded), so a slow stage holds back the
+    ones before it instead of piling up images in memory.
+    With instrumentation on (metrics.enable), every stage measured while processing an image is attributed to it.
+
+            Parameters:
+                    image_ids (iterable): OMERO image IDs to process
+                    fetch_image (callable): fetch_image(image_id) -> image array (e.g. a wrapped retrieve_image)
+                    save_regions (callable): save_regions(image_id, regions) uploads the ROIs (e.g. a wrapped save_rois)
+                    detection_params (dict): keyword arguments for create_rois (size_thresh, method_thresh, closing, scale_factor, ...)
+                    fetch_workers (int): concurrent thumbnail downloads
+                    detect_workers (int): processes running create_rois (defaults to the number of CPUs)
+                    upload_workers (int): concurrent uploads
+                    max_pending (int): images in flight at once (defaults to the sum of the stage concurrencies)
+                    store (ResultStore): if given, images whose thumbnail checksum and parameters match the last saved
+                    run are skipped without detection or upload, and every successful upload is recorded
+
+            Returns:
+                    results (list): one ImageResult per image ID, in input order
+    '''
+    if max_pending is None:
+        # ProcessPoolExecutor(None) runs one process per CPU
+        max_pending = fetch_workers + (detect_workers or os.cpu_count() or 1) + upload_workers
+    fetch_slots = threading.BoundedSemaphore(fetch_workers)
+    upload_slots = threading.BoundedSemaphore(upload_workers)
+
+    # with instrumentation on (metrics.enable), detection is measured in the worker process and merged back here
+    recorder = metrics.active()
+
+    with ProcessPoolExecutor(detect_workers) as detect_pool:
+
+        def detect(image_id, image):
+            if recorder is None:
+                return detect_pool.submit(create_rois, image, **detection_params).result()
+            regions, records = detect_pool.submit(_measured_create_rois, image, detection_params, recorder.memory).result()
+            for r in records:
+                recorder.record(r['stage'], image_id, r['seconds'], r['bytes'], r['peak_bytes'], r['ok'])
+            return regions
+
+        def process(image_id):
+            with metrics.image(image_id):
+                return run_one(image_id)
+
+        def run_one(image_id):
+            tic = time.perf_counter()
+            stage = 'fetch'
+            try:
+                with fetch_slots:
+                    image = fetch_image(image_id)
+                if store is not None:
+                    checksum = thumbnail_checksum(image)
+                    previous = store.lookup(image_id, checksum, detection_params)
+                    if previous is not None:
+                        return ImageResult(image_id, 'skipped', n_regions=len(previous), seconds=time.perf_counter() - tic)
+                stage = 'detect'
+                regions = detect(image_id, image)
+                del image
+                stage = 'upload'
+                with upload_slots:
+                    save_regions(image_id, regions)
+                if store is not None:
+                    store.record(image_id, checksum, detection_params, regions)
+            except Exception as e:
+                return ImageResult(image_id, 'failed', stage=stage, error='{}: {}'.format(type(e).__name__, e),
+                                   seconds=time.perf_counter() - tic)
+            return ImageResult(image_id, 'ok', n_regions=len(regions), seconds=time.perf_counter() - tic)
+
+        # one driver thread per image in flight - the pool's own queue provides the backpressure
+        with ThreadPoolExecutor(max_pending) as drivers:
+            return list(drivers.map(process, image_ids))
+
+
+def _measured_create_rois(image, detection_params, memory):
+    # runs in the detection worker processes, which don't share the parent's recorder
+    recorder = metrics.enable(metrics.Recorder(memory))
+    try:
+        regions = create_rois(image, **detection_params)
+    finally:
+        metrics.disable()
+    return regions, recorder.records
+
+
+def summarize(results):
+    '''
+    Small text report: totals plus one line per failed image.
+    '''
+    failed = [r for r in results if r.status == 'failed']
+    skipped = [r for r in results if r.status == 'skipped']
+    lines = ['{} images, {} ok, {} skipped, {} failed'.format(
+        len(results), len(results) - len(failed) - len(skipped), len(skipped), len(failed))]
+    for r in failed:
+        lines.append('  image {} failed during {}: {}'.format(r.image_id, r.stage, r.error))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import sys
+
+    from create_session import create_json_session, create_blitz_session
+    from retrieve_image import ImageClient, get_image
+    from save_rois import save_rois, sync_rois
+    from result_store import ResultStore
+    from thumbnail_cache import ThumbnailCache
+    from offline import DetectionStore
+    from client_policy import policy_from_args
+
+    parser = argparse.ArgumentParser(description='Detect and save ROIs for many images at once')
+    targets = parser.add_mutually_exclusive_group(required=True)
+    targets.add_argument('--images', type=int, nargs='+', help='image IDs to process')
+    targets.add_argument('--dataset', type=int, help='process every image in this dataset')
+    targets.add_argument('--project', type=int, help='process every image in this project')
+    parser.add_argument('--scale-factor', type=int, default=64)
+    parser.add_argument('--size-thresh', type=float, default=200)
+    parser.add_argument('--method', default='triangle')
+    parser.add_argument('--closing', type=int, default=5)
+    parser.add_argument('--fetch-workers', type=int, default=4)
+    parser.add_argument('--detect-workers', type=int, default=None)
+    parser.add_argument('--upload-workers', type=int, default=2)
+    parser.add_argument('--max-pending', type=int, default=None)
+    parser.add_argument('--grayscale', action='store_true',
+                        help='decode thumbnails straight to 8-bit grayscale (less memory, slightly different grey levels)')
+    parser.add_argument('--thumbnail-cache', metavar='DIR',
+                        help='keep downloaded thumbnails in this directory, so reruns with other parameters skip the downloads')
+    parser.add_argument('--cache-mb', type=int, default=2048, help='size limit of the thumbnail cache')
+    parser.add_argument('--session-file', metavar='FILE',
+                        help='keep the JSON API session in this file (mode 0600) and reuse it while it is valid')
+    parser.add_argument('--report', help='write the per-image report to this JSON file')
+    parser.add_argument('--rerun',
+                        dest='rerun',
+                        action='store_true',
+                        help='Set this flag if it is a rerun (WILL delete ALL existing ROIs)')
+    # the result store records images as saved to OMERO, which detect-only runs never do
+    saving = parser.add_mutually_exclusive_group()
+    saving.add_argument('--incremental',
+                        metavar='STORE',
+                        help='Rerun incrementally, remembering results in this SQLite file: unchanged images are skipped '
+                             'and only ROIs that differ are deleted/added')
+    saving.add_argument('--detect-only',
+                        metavar='STORE',
+                        help="Don't touch OMERO's ROIs, write the detections to this store directory instead (images "
+                             "already in it are skipped); commit them later with offline.py STORE")
+    parser.add_argument('--retries', type=int, default=0,
+                        help='retry OMERO calls that fail with a transient error up to this many times, with jittered '
+                             'exponential backoff (uploads only when they replace the ROIs, i.e. --rerun/--incremental)')
+    parser.add_argument('--adaptive-limit', type=int, default=0, metavar='MAX',
+                        help='adapt the number of concurrent OMERO calls (JSON and Blitz together) to the latency and '
+                             'error rate the server shows, up to MAX')
+    parser.add_argument('--metrics', metavar='JSONL',
+                        help='record per-stage, per-image timings and transfer sizes, appended to this JSON lines file')
+    parser.add_argument('--prometheus', metavar='FILE',
+                        help='write per-stage totals to this Prometheus textfile (e.g. for node_exporter)')
+    parser.add_argument('--metrics-memory', action='store_true',
+                        help='with --metrics/--prometheus, also measure peak memory per stage (slower)')
+    args = parser.parse_args(sys.argv[1:])
+
+    recorder = None
+    if args.metrics or args.prometheus:
+        recorder = metrics.enable(metrics.Recorder(memory=args.metrics_memory))
+
+    WEB_HOSTNAME = os.environ['OMERO_WEB_HOSTNAME']
+    HOSTNAME = os.environ['OMERO_HOSTNAME']
+    USERNAME = os.environ['OMERO_ADMIN_USER']
+    PASSWORD = os.environ['OMERO_ADMIN_PASSWORD']
+
+    # one policy for both APIs, they hit the same server (the limiter keeps a limit per kind of call)
+    policy = policy_from_args(args.retries, args.adaptive_limit)
+    call = policy.call if policy is not None else (lambda fn, *a, **kw: fn(*a, **kw))
+
+    login_rsp, session, base_url = call(create_json_session, WEB_HOSTNAME, USERNAME, PASSWORD, verify=False,
+                                         session_file=args.session_file)
+    # Blitz connections aren't meant to be shared between threads, so every upload thread gets its own
+    local = threading.local()
+    conns = []
+    conns_lock = threading.Lock()
+
+    # discovers the API URLs once; the image sizes come in bulk - with the listing for datasets/projects, with a
+    # Blitz query for --images - so every image then costs a single request (the thumbnail)
+    cache = ThumbnailCache(args.thumbnail_cache, args.cache_mb * 2 ** 20) if args.thumbnail_cache else None
+    client = ImageClient(session, base_url, pool_size=args.fetch_workers, cache=cache, policy=policy)
+    # a Blitz connection for the lookups the JSON API can't do in bulk: sizes for --images, update stamps for the
+    # thumbnail cache (only queries, so detect-only runs with a cache use one too)
+    lookup = None
+    if (args.images and not args.detect_only) or cache is not None:
+        lookup = call(create_blitz_session, HOSTNAME, USERNAME, PASSWORD)
+        conns.append(lookup)
+    if args.images and lookup is not None:
+        image_ids = client.prefetch_images(lookup, args.images)
+    elif args.images:
+        # detect-only without a cache: every image also costs a metadata request
+        image_ids = args.images
+    elif args.dataset is not None:
+        image_ids = client.prefetch_dataset(args.dataset)
+    else:
+        image_ids = client.prefetch_project(args.project)
+    if cache is not None and not args.images:
+        client.prefetch_stamps(lookup, image_ids)
+
+    def fetch_image(image_id):
+        return client.retrieve(image_id, args.scale_factor, args.grayscale)
+
+    def save_regions(image_id, regions):
+        if detections is not None:
+            detections.add(image_id, regions, args.scale_factor, params)
+            return
+        if not hasattr(local, 'conn'):
+            local.conn = call(create_blitz_session, HOSTNAME, USERNAME, PASSWORD)
+            with conns_lock:
+                conns.append(local.conn)
+        image = call(get_image, local.conn, image_id)
+        if store is not None:
+            call(sync_rois, image, regions, args.scale_factor)
+        elif args.rerun:
+            call(save_rois, image, regions, args.scale_factor, True)
+        elif policy is not None:
+            # saving without replacing twice would duplicate the ROIs
+            policy.call_once(save_rois, image, regions, args.scale_factor, False)
+        else:
+            save_rois(image, regions, args.scale_factor, False)
+
+    store = ResultStore(args.incremental) if args.incremental else None
+    detections = None
+    if args.detect_only:
+        detections = DetectionStore(args.detect_only)
+        done = detections.images()
+        image_ids = [i for i in image_ids if i not in done]
+    params = {'size_thresh': args.size_thresh, 'method_thresh': args.method,
+              'closing': args.closing, 'scale_factor': args.scale_factor}
+    try:
+        results = run_batch(image_ids, fetch_image, save_regions, params,
+                            fetch_workers=args.fetch_workers, detect_workers=args.detect_workers,
+                            upload_workers=args.upload_workers, max_pending=args.max_pending, store=store)
+    finally:
+        if store is not None:
+            store.close()
+        if detections is not None:
+            detections.flush()
+        for conn in conns:
+            conn.close()
+
+    print(summarize(results))
+    if recorder is not None:
+        if args.metrics:
+            recorder.write_jsonl(args.metrics)
+        if args.prometheus:
+            recorder.write_prometheus(args.prometheus)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump([r.as_dict() for r in results], f, indent=2)
+    sys.exit(0 if all(r.status != 'failed' for r in results) else 1)
@@ -0,0 +1,249 @@
+import random
+import threading
+import time
+
+# HTTP statuses worth trying again: rate limiting, and the server (or the proxy in front of it) struggling
+TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+# Ice/OMERO exceptions (by class name, so omero doesn't have to be importable) that mean "try again later"
+TRANSIENT_ICE_ERRORS = ('ConnectionLostException', 'ConnectionRefusedException', 'ConnectFailedException',
+                        'ConnectTimeoutException', 'TimeoutException', 'CloseTimeoutException',
+                        'TooManyUsersSessionException', 'TryAgain', 'ConcurrencyException')
+# and the ones that mean the session is gone, so only a new login helps
+SESSION_ICE_ERRORS = ('SessionException', 'RemovedSessionException', 'SessionTimeoutException',
+                      'ObjectNotExistException')
+
+
+def is_transient(error):
+    '''
+    Whether an exception from a JSON API or Blitz call is worth retrying: connection problems and timeouts, HTTP
+    408/429/5xx responses (see retrieve_image.ResponseError) and Ice's connection/timeout exceptions.
+    '''
+    import requests
+
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in TRANSIENT_STATUSES
+    return any(cls.__name__ in TRANSIENT_ICE_ERRORS for cls in type(error).__mro__)
+
+
+def is_session_expired(error):
+    '''
+    Whether an exception from a JSON API or Blitz call means the session has expired (or was closed on the server):
+    HTTP 401/403 responses and Ice's session exceptions. Nothing else is fixed by logging in again.
+    '''
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in (401, 403)
+    return any(cls.__name__ in SESSION_ICE_ERRORS for cls in type(error).__mro__)
+
+
+class _Limit(object):
+    '''
+    AIMD state of one kind of call.
+    '''
+    __slots__ = ('limit', 'baseline', 'in_flight', 'completed', 'last_decrease')
+
+    def __init__(self, initial):
+        self.limit = float(initial)
+        self.baseline = None
+        self.in_flight = 0
+        self.completed = 0
+        self.last_decrease = 0
+
+
+class AdaptiveLimiter(object):
+    '''
+    AIMD concurrency limit: at most limit calls are let through at once. Every call that succeeds within the latency
+    target adds 1/limit to the limit (so +1 per round of calls, as long as at least half of the limit is in use), and
+    a failed or slow call multiplies it by backoff (at most once per round, so a burst of errors from one overloaded
+    moment counts once). Throughput climbs to what the server sustains and backs off as soon as latency or errors
+    say it's struggling.
+
+    The latency target is tolerance times the baseline latency, a slowly rising minimum of the observed latencies,
+    unless a fixed target_latency is given.
+
+    Every kind of call (ClientPolicy uses the name of the function called: a thumbnail download, a Blitz query, a
+    ROI save) gets its own limit and baseline - a save that normally takes ten times as long as a thumbnail isn't a
+    sign of congestion.
+
+            Parameters:
+                    initial, minimum, maximum (int): starting limit and its bounds (for every kind)
+                    backoff (float): multiplicative decrease
+                    tolerance (float): how much slower than the baseline a call may be before it counts as slow
+                    target_latency (float): fixed latency target in seconds, instead of the adaptive one
+    '''
+
+    def __init__(self, initial=4, minimum=1, maximum=32, backoff=0.5, tolerance=3.0, target_latency=None):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.target_latency = target_latency
+        self._limits = {}
+        self._cond = threading.Condition()
+
+    def _state(self, kind):
+        if kind not in self._limits:
+            self._limits[kind] = _Limit(self.initial)
+        return self._limits[kind]
+
+    @property
+    def limit(self):
+        '''
+        Limit of the calls made without a kind.
+        '''
+        with self._cond:
+            return self._state(None).limit
+
+    @property
+    def in_flight(self):
+        '''
+        Calls in flight, of all kinds.
+        '''
+        with self._cond:
+            return sum(state.in_flight for state in self._limits.values())
+
+    def limits(self):
+        '''
+        {kind: limit} for every kind of call seen so far.
+        '''
+        with self._cond:
+            return {kind: state.limit for kind, state in self._limits.items()}
+
+    def acquire(self, kind=None):
+        with self._cond:
+            state = self._state(kind)
+            while state.in_flight >= int(state.limit):
+                self._cond.wait()
+            state.in_flight += 1
+
+    def release(self, latency=None, ok=True, kind=None):
+        '''
+        Frees a slot; latency (seconds) and ok feed the limit (a call that says nothing about the server's health,
+        e.g. a 404, should pass latency=None).
+        '''
+        with self._cond:
+            state = self._state(kind)
+            state.in_flight -= 1
+            if latency is not None:
+                self._update(state, latency, ok)
+            self._cond.notify_all()
+
+    def _update(self, state, latency, ok):
+        state.completed += 1
+        if ok:
+            # the baseline follows the fastest calls down at once, and creeps up so it can recover from an outlier
+            if state.baseline is None or latency < state.baseline:
+                state.baseline = latency
+            else:
+                state.baseline += 0.01 * (latency - state.baseline)
+        target = self.target_latency
+        if target is None and state.baseline is not None:
+            target = self.tolerance * state.baseline
+        if ok and (target is None or latency <= target):
+            # only grow while the limit is actually being used, or a quiet spell would inflate it for nothing
+            if 2 * (state.in_flight + 1) >= state.limit:
+                state.limit = min(self.maximum, state.limit + 1.0 / state.limit)
+        elif state.completed - state.last_decrease >= state.limit:
+            state.limit = max(self.minimum, state.limit * self.backoff)
+            state.last_decrease = state.completed
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class ClientPolicy(object):
+    '''
+    What every call to OMERO (JSON API or Blitz) goes through when a policy is set: an AdaptiveLimiter slot, and
+    retries with jittered exponential backoff when the call fails with a transient error (is_transient). Share one
+    policy between all the threads (and both APIs) talking to the same server.
+
+    Only hand it calls that can safely run twice - GETs, save_rois(..., replace=True), sync_rois - since a call
+    that timed out may still have gone through.
+
+            Parameters:
+                    limiter (AdaptiveLimiter): concurrency limit (None for no limit)
+                    attempts (int): tries per call, the first one included
+                    base_delay (float): backoff before the first retry, doubling every time, in seconds
+                    max_delay (float): cap on the backoff
+                    is_transient (callable): is_transient(exception) -> whether to retry
+    '''
+
+    def __init__(self, limiter=None, attempts=5, base_delay=0.5, max_delay=30.0, is_transient=is_transient):
+        self.limiter = limiter
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.is_transient = is_transient
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def delay(self, attempt, error=None):
+        '''
+        "Full jitter" backoff: uniformly random up to base_delay * 2**attempt (capped), but at least as long as a
+        Retry-After the server sent.
+        '''
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = getattr(error, 'retry_after', None)
+        return max(delay, min(retry_after, self.max_delay)) if retry_after is not None else delay
+
+    def call(self, fn, *args, **kwargs):
+        # calls to different functions are limited separately (see AdaptiveLimiter)
+        kind = getattr(fn, '__name__', None)
+        for attempt in range(self.attempts):
+            if self.limiter is not None:
+                self.limiter.acquire(kind)
+            tic = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                transient = self.is_transient(e)
+                if self.limiter is not None:
+                    self.limiter.release(time.perf_counter() - tic if transient else None, ok=not transient,
+                                         kind=kind)
+                if not transient or attempt == self.attempts - 1:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                time.sleep(self.delay(attempt, e))
+                continue
+            if self.limiter is not None:
+                self.limiter.release(time.perf_counter() - tic, ok=True, kind=kind)
+            return result
+
+    def call_once(self, fn, *args, **kwargs):
+        '''
+        For calls that mustn't be repeated (e.g. save_rois without replace, which would duplicate ROIs): takes a
+        limiter slot and feeds the limiter, but never retries.
+        '''
+        if self.limiter is None:
+            return fn(*args, **kwargs)
+        kind = getattr(fn, '__name__', None)
+        self.limiter.acquire(kind)
+        tic = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            transient = self.is_transient(e)
+            self.limiter.release(time.perf_counter() - tic if transient else None, ok=not transient, kind=kind)
+            raise
+        self.limiter.release(time.perf_counter() - tic, ok=True, kind=kind)
+        return result
+
+
+def policy_from_args(retries, adaptive_limit):
+    '''
+    The ClientPolicy for the --retries / --adaptive-limit command line options, None if neither is used.
+    '''
+    if not retries and not adaptive_limit:
+        return None
+    limiter = AdaptiveLimiter(initial=min(4, adaptive_limit), maximum=adaptive_limit) if adaptive_limit else None
+    return ClientPolicy(limiter, attempts=1 + retries)
@@ -1,62 +1,132 @@
-def create_rois(image, size_thresh, method_thresh, closing, scale_factor):
+try:
+    from .region_set import RegionSet
+    from .metrics import instrumented
+except ImportError:
+    from region_set import RegionSet
+    from metrics import instrumented
+
+
+@instrumented('detect')
+def create_rois(image, size_thresh, method_thresh, closing, scale_factor, order_strategy='rows'):
     '''
     Main entry-point function for generating ROIs automatically. 
     Does thresholding, clever merging of intersecting ROIs and ordering left-right-top-bottom.
 
             Parameters:
-                    image (np.array): 3-dimensional (2d + RGB) numpy array with pixel data for retrieved jpeg from OMERO
+                    image (np.array): 3-dimensional (2d + RGB) numpy array with pixel data for retrieved jpeg from OMERO, or a
+                    2d uint8 grayscale one (retrieve_image(..., grayscale=True)), which keeps the whole pipeline in uint8/bool
                     size_thresh (num): Minimum size (in full-resolution pixels) for an ROI to be considered an ROI
                     method_thresh (str): Thresholding method. Current options are 'otsu', 'triangle', 'yen' and 'li'.
                     closing (int): radius for the diamond-shaped structuring element used for closing operation.
                     scale_factor (int): scaling that was used to generate the downsampled image. Used to re-scale minimum size threshold.
+                    order_strategy (str): how to put the ROIs in reading order, see order_regions. Current options are 'rows' and 'weighted'.
 
             Returns:
-                    regions (list): list of pruned, ordered tuples of the form (y1,x1,y2,x2) representing the ROIs to be saved back to OMERO.
+                    regions (RegionSet): pruned, ordered boxes of the form (y1,x1,y2,x2) representing the ROIs to be saved back to OMERO.
     '''
-    from skimage.color import rgb2gray
-    from skimage.filters import threshold_otsu, threshold_triangle, threshold_yen, threshold_li
-    from skimage.util import invert
-    from skimage.morphology import diamond, binary_closing
     from skimage.measure import regionprops, label
-    import numpy as np
 
 
-    # we're assuming the image is RGB and dark features on light background
-    im = rgb2gray(image)
-    im = invert(im)
-    
-    # ugly thresholding choice here - I'm assuming the inputs to be well-behaved
-    if method_thresh == 'otsu':
-        im_thresh = im > threshold_otsu(im)
-    elif method_thresh == 'triangle':
-        im_thresh = im > threshold_triangle(im)
-    elif method_thresh == 'yen':
-        im_thresh = im > threshold_yen(im)
-    elif method_thresh == 'li':
-        im_thresh = im > threshold_li(im)
+    im = inverted_gray(image)
+    im_thresh = im > threshold_value(im, method_thresh)
 
     # do a bit of closing to already merge regions that are almost touching
     # how much? up to you, it's an input parameter
-    im_thresh = binary_closing(im_thresh, diamond(closing))
+    im_thresh = diamond_closing(im_thresh, closing)
     im_lab = label(im_thresh)
 
     # get rid of ROIs smaller than required size threshold
-    for i in range(1, im_lab.max()+1):
-        coords = np.where(im_lab == i)
-        if len(coords[0]) < (size_thresh / (scale_factor ** 2)):
-            im_lab[coords] = 0
+    im_lab = filter_small_regions(im_lab, size_thresh / (scale_factor ** 2))
       
     regionproperties = regionprops(im_lab)
-    regions = []
 
     # at least for now we only care about the bounding boxes for ROIs
-    for r in regionproperties:
-        regions.append(r.bbox)
+    regions = RegionSet([r.bbox for r in regionproperties])
     regions = prune_regions(regions)
-    regions = order_regions(regions)
+    regions = order_regions(regions, order_strategy)
     #return []
     return regions
 
+def inverted_gray(image):
+    '''
+    Grayscale, inverted version of the image - we're assuming dark features on light background. RGB images go
+    through rgb2gray (float); images that are already grayscale are just inverted, so uint8 stays uint8.
+    '''
+    from skimage.color import rgb2gray
+    from skimage.util import invert
+    if image.ndim == 2:
+        return invert(image)
+    return invert(rgb2gray(image))
+
+def threshold_value(im, method_thresh):
+    '''
+    Threshold computed by the given method ('otsu', 'triangle', 'yen' or 'li') on an inverted_gray image.
+    '''
+    from skimage.filters import threshold_otsu, threshold_triangle, threshold_yen, threshold_li
+
+    # ugly thresholding choice here - I'm assuming the inputs to be well-behaved
+    if method_thresh == 'otsu':
+        return threshold_otsu(im)
+    elif method_thresh == 'triangle':
+        return threshold_triangle(im)
+    elif method_thresh == 'yen':
+        return threshold_yen(im)
+    elif method_thresh == 'li':
+        return threshold_li(im)
+    raise ValueError("Unknown thresholding method '{}'".format(method_thresh))
+
+def diamond_closing(mask, radius):
+    '''
+    Binary closing with a diamond-shaped structuring element, same result as binary_closing(mask, diamond(radius)),
+    but in a time that doesn't depend on the radius: a diamond of radius r is the set of points within taxicab
+    (L1) distance r, so the dilation is "distance to the foreground <= r" and the erosion of that is
+    "distance to the background > r". Both distances come from a linear-time chamfer distance transform.
+    Pixels outside the image don't count, like binary_closing's default.
+
+    Parameters:
+                    mask (np.array): 2-dimensional boolean image
+                    radius (int): radius of the diamond
+
+            Returns:
+                    closed (np.array): boolean image of the same shape
+    '''
+    from scipy.ndimage import distance_transform_cdt
+    import numpy as np
+
+    mask = np.asarray(mask, dtype=bool)
+    if not mask.any():
+        return mask.copy()
+    # distance of every pixel to the nearest foreground pixel
+    dilated = distance_transform_cdt(~mask, metric='taxicab') <= radius
+    if dilated.all():
+        return dilated
+    # distance of every pixel to the nearest pixel outside the dilation
+    return distance_transform_cdt(dilated, metric='taxicab') > radius
+
+def filter_small_regions(im_lab, min_pixels):
+    '''
+    Zero out every labelled region with fewer than min_pixels pixels. Does a single pass over the label image
+    (one bincount for the sizes, one lookup for the mask) instead of scanning the whole image once per label.
+
+    Parameters:
+                    im_lab (np.array): 2-dimensional integer label image, 0 being background
+                    min_pixels (num): minimum number of (downsampled) pixels for a region to be kept
+
+            Returns:
+                    im_lab (np.array): the same label image, with the small regions set to 0 (modified in place)
+
+    '''
+    import numpy as np
+
+    # counts[i] is the number of pixels with label i
+    counts = np.bincount(im_lab.ravel())
+    small = counts < min_pixels
+    # never touch the background
+    small[0] = False
+    if small.any():
+        im_lab[small[im_lab]] = 0
+    return im_lab
+
 def distance(p1, p2):
     '''
     Basic L2 distance. I will not bother writing a detailed docstring for this.
@@ -80,100 +150,126 @@ def generate_centroids(regions):
     Generate centroids of the region bounding boxes. 
 
     Parameters:
-                    regions (list): tuples of the form (y1,x1,y2,x2) representing the ROI bounding boxes
+                    regions (RegionSet or list): boxes of the form (y1,x1,y2,x2) representing the ROI bounding boxes
                     
             Returns:
                     centroids (list): list of tuples of the form (X, Y) with centroids (because I hate the original tuple coordinate ordering)
                                     
     '''
-   
-    centroids = []
-    if regions != []:
-        for region in regions:
-            centroids.append(((region[1]+ region[3])/2, (region[0]+ region[2])/2))
-    return centroids
+    return [tuple(c) for c in RegionSet.from_regions(regions).centroids().tolist()]
 
-def order_regions(regions):
+def order_regions(regions, strategy='rows'):
     '''
-    This function is an absolute nightmare that will require a lot of in-line commenting to make any sense of. But basically it gets
-    a list of region bounding boxes and returns the same list, but ordered left-right and top-bottom (i.e. writing order). 
+    Gets a set of region bounding boxes and returns the same boxes, but ordered left-right and top-bottom (i.e. writing order).
+
+    Two strategies are available:
+        'rows' (default): groups the boxes into rows with a 1-D clustering of their Y extents (boxes whose central halves
+            overlap vertically share a row, chains of them included), then sorts each row by centroid X.
+            Vectorised, O(n log n), and deterministic.
+        'weighted': the original heuristic, see order_regions_weighted.
 
     Parameters:
-                    regions (list): tuples of the form (y1,x1,y2,x2) representing the ROI bounding boxes
-                    
+                    regions (RegionSet or list): boxes of the form (y1,x1,y2,x2) representing the ROI bounding boxes
+                    strategy (str): 'rows' or 'weighted'
+
             Returns:
-                    a mess (list): also tuples of the form (y1,x1,y2,x2) representing the ROI bounding boxes, but ordered
-                                    
+                    regions (RegionSet): also boxes of the form (y1,x1,y2,x2) representing the ROI bounding boxes, but ordered
+
     '''
+    if strategy not in ORDER_STRATEGIES:
+        raise ValueError("Unknown ordering strategy '{}', expected one of {}".format(strategy, sorted(ORDER_STRATEGIES)))
+    return ORDER_STRATEGIES[strategy](RegionSet.from_regions(regions))
 
+def order_regions_rows(regions):
+    '''
+    Row-clustering reading order (the 'rows' strategy of order_regions).
+    '''
+    import numpy as np
 
+    regions = RegionSet.from_regions(regions)
+    if len(regions) == 0:
+        return regions
+    boxes = regions.boxes
+    centroids = regions.centroids()
+    index = np.arange(len(regions))
+
+    # only the central half of every box counts for row membership, so neighbouring rows that touch (or overlap a
+    # little because of jitter) don't get glued together
+    quarter = (boxes[:, 2] - boxes[:, 0]) / 4
+    top = centroids[:, 1] - quarter
+    bottom = centroids[:, 1] + quarter
+
+    # classic interval merging: walk the boxes top to bottom (ties broken by position, so the result is stable run
+    # to run) and start a new row whenever a box starts below everything seen so far
+    by_y = np.lexsort((index, top))
+    reach = np.maximum.accumulate(bottom[by_y])
+    new_row = np.zeros(len(regions), dtype=bool)
+    new_row[1:] = top[by_y][1:] > reach[:-1]
+    rows = np.empty(len(regions), dtype=np.int64)
+    rows[by_y] = np.cumsum(new_row)
+
+    # then left to right inside each row
+    return regions[np.lexsort((index, centroids[:, 1], centroids[:, 0], rows))]
+
+def order_regions_weighted(regions):
+    '''
+    The original heuristic (the 'weighted' strategy of order_regions): sort by a weighted distance to the top-left ROI,
+    where Y counts 20 times more than X, and split lines wherever that distance jumps. It used to be an absolute
+    nightmare of lists being sorted and mutated; the same logic is now done with array masks and sorts, but the
+    in-line comments still apply.
+    '''
     import numpy as np
-    if regions != []:
-        
-        #while regions != []:
-        centroids = generate_centroids(regions)
-
-        # detecting top-left ROI: lowest sum of coordinates
-        sums = [c[0]+c[1] for c in centroids]
-        topleft = sums.index(min(sums))
-        # I won't need to order that one (it's the first), so I get rid of it
-        c_topleft = centroids[topleft]
-        r_topleft = regions[topleft]
-        regions.remove(r_topleft)
-        centroids.remove(c_topleft)
-
-        # calculate weighted distances to the top left ROI, where Y distances are weighted at
-        # 20 (!!!) times the X distances - this sucks and I still can't figure out a better way to 
-        # make sure I'm getting lines correctly!
-        dists = [weighted_distance(x,c_topleft,20) for x in centroids]
-        
-        # basically I sort everything based on the weighted distances
-        # If I did things right, the first elements are on the top line, then there's a big
-        # jump in weighted distances, then second line, big jump, third line, and so on
-        centroids = [x for _,x in sorted(zip(dists,centroids))]
-        regions = [x for _,x in sorted(zip(dists,regions))]
-        dists = [x for x in sorted(dists)]
-
-        # detecting "big jumps" as anything bigger than 1.5 times the st dev of differences
-        differences = [dists[i+1]-dists[i] for i in range(len(dists)-1)]
-        line_dividers = differences > 1.5*np.std(differences)
-        line_dividers = np.insert(line_dividers,0,False)
-
-
-        # create list of lists where each element is a list containing a line of ROIs
-        lines = []
-        lines.append([r_topleft])
-        for i in range(len(regions)):
-            if line_dividers[i]:
-                lines.append([])
-            lines[-1].append(regions[i])
-            
-        results = []
-
-        # sort each line left-to-right by comparing x values
-        for line in lines:
-            line_centr = generate_centroids(line)
-            xvals = [x[0] for x in line_centr]  
-            results.append([x for _,x in sorted(zip(xvals,line))])  
-
-        # return statement is just unraveling the list of lists as a single list
-        return [item for sublist in results for item in sublist]
-    else:
-        return []
+
+    regions = RegionSet.from_regions(regions)
+    if len(regions) == 0:
+        return regions
+    boxes = regions.boxes
+    centroids = regions.centroids()
+
+    # detecting top-left ROI: lowest sum of coordinates
+    # I won't need to order that one (it's the first), so I get rid of it
+    topleft = np.argmin(centroids.sum(axis=1))
+    rest = np.flatnonzero(np.arange(len(regions)) != topleft)
+    c_topleft = centroids[topleft]
+
+    # calculate weighted distances to the top left ROI, where Y distances are weighted at
+    # 20 (!!!) times the X distances - this sucks and I still can't figure out a better way to 
+    # make sure I'm getting lines correctly!
+    dists = weighted_distance(centroids[rest].T, c_topleft, 20)
+
+    # basically I sort everything based on the weighted distances (ties broken by the box coordinates)
+    # If I did things right, the first elements are on the top line, then there's a big
+    # jump in weighted distances, then second line, big jump, third line, and so on
+    by_distance = np.lexsort((boxes[rest, 3], boxes[rest, 2], boxes[rest, 1], boxes[rest, 0], dists))
+    rest = rest[by_distance]
+    dists = dists[by_distance]
+
+    # detecting "big jumps" as anything bigger than 1.5 times the st dev of differences
+    differences = np.diff(dists)
+    line_dividers = np.zeros(len(rest), dtype=bool)
+    if len(differences):
+        line_dividers[1:] = differences > 1.5 * np.std(differences)
+
+    # line number for every ROI: the top-left one starts the first line
+    order = np.concatenate([[topleft], rest])
+    lines = np.cumsum(np.concatenate([[False], line_dividers]))
+
+    # sort each line left-to-right by comparing x values
+    xvals = centroids[order, 0]
+    ordered = order[np.lexsort((boxes[order, 3], boxes[order, 2], boxes[order, 1], boxes[order, 0], xvals, lines))]
+    return regions[ordered]
+
+ORDER_STRATEGIES = {
+    'rows': order_regions_rows,
+    'weighted': order_regions_weighted,
+}
 
 def prune_regions(regions):
     '''
     Get rid of any regions with aspect ratios bigger than 4. Why 4? Good question.
     '''
-    restart = True
-    while restart:
-        restart = False
-        for region in regions:   
-            if check_aspect_ratio(region, 4):
-                regions.remove(region)
-                restart = True
-                break
-            
+    regions = RegionSet.from_regions(regions)
+    regions = regions[~regions.elongated(4)]
     regions = cluster_regions(regions)
     
   
@@ -183,55 +279,140 @@ def prune_regions(regions):
 def cluster_regions(regions):
 
     '''
-    This function does some clever graph stuff to merge ROIs hierarchically based on intersection areas. By defining merge 
-    priorities a priori instead of iteratively, we get really good quality ROIs that can even overlap without becoming a single
-    huge bounding box.
+    This function merges ROIs hierarchically based on intersection areas. By defining merge priorities a priori instead
+    of iteratively, we get really good quality ROIs that can even overlap without becoming a single huge bounding box.
+
+    Every region is linked to the region it intersects the most (same rule as check_intersections), and each connected
+    component of those links becomes a single bounding box (same result as merge_cluster). Everything is done on an
+    N x 4 box array: a sort-and-sweep over Y finds the overlapping pairs and a union-find gives the components, so
+    this scales to tens of thousands of boxes.
 
     Parameters:
-                    regions (list): tuples of the form (y1,x1,y2,x2) representing the ROI bounding boxes
+                    regions (RegionSet or list): boxes of the form (y1,x1,y2,x2) representing the ROI bounding boxes
                     
             Returns:
-                    results (list): also tuples of the form (y1,x1,y2,x2) (but fewer of them) representing the ROI bounding boxes, but merged
+                    results (RegionSet): also boxes of the form (y1,x1,y2,x2) (but fewer of them) representing the ROI bounding boxes, but merged
                                     
     '''
-    import networkx as nx
-    willmerge = []
-    mergee = []
-    results = []
-
-    # we do a pass through all regions and generate two new lists: a boolean saying whether that region needs merging
-    # (i.e. it intersects with another one) and an integer one with the index of the region that should be merged with
-    # that one
-    for region in regions:
-        intersection = check_intersections(region,regions)
-        if intersection != -1:
-            willmerge.append(True)
-            mergee.append(intersection)
-            
-    # if a region doesn't have intersections, go ahead and add it to the results list        
-        else:
-            willmerge.append(False)
-            mergee.append(intersection)
-            results.append(region)
-    
-    # create a graph and add an edge for each combination of regions that need to be merged.
-    G = nx.Graph()
-    edges = []
-    count = 0
-    for roi in range(len(mergee)):
-        if willmerge[count] == True:
-            edges.append((count,mergee[count]))
-        count = count + 1
-    G.add_edges_from(edges)
-
-
-    # the resulting graph will have one connected component per final ROI, and the final ROI is the bounding box
-    # around all ROIs in this connected component
-    for a in nx.connected_components(G):
-        roi = merge_cluster(list(a), regions)
-        results.append(roi)
-    
-    return results
+    import numpy as np
+
+    regions = RegionSet.from_regions(regions)
+    if len(regions) == 0:
+        return regions
+    # int64 so that intersection areas can't overflow
+    boxes = regions.boxes.astype(np.int64)
+    n = len(boxes)
+
+    first, second, areas = _overlapping_pairs(boxes)
+    mergee = _max_intersection_partners(n, first, second, areas)
+    willmerge = mergee != -1
+
+    # regions without intersections go straight to the results, in their original order
+    results = [boxes[~willmerge]]
+
+    # one final ROI per connected component: the bounding box around all of its members
+    nodes = np.flatnonzero(willmerge)
+    if len(nodes):
+        roots = _connected_components(n, nodes, mergee[nodes])[nodes]
+        # components come out ordered by their lowest region index
+        component_roots, component = np.unique(roots, return_inverse=True)
+        merged = np.empty((len(component_roots), 4), dtype=np.int64)
+        merged[:, :2] = np.iinfo(np.int64).max
+        merged[:, 2:] = np.iinfo(np.int64).min
+        np.minimum.at(merged[:, 0], component, boxes[nodes, 0])
+        np.minimum.at(merged[:, 1], component, boxes[nodes, 1])
+        np.maximum.at(merged[:, 2], component, boxes[nodes, 2])
+        np.maximum.at(merged[:, 3], component, boxes[nodes, 3])
+        results.append(merged)
+
+    return RegionSet(np.concatenate(results))
+
+
+def _overlapping_pairs(boxes):
+    '''
+    Sort-and-sweep over an N x 4 box array: sort by y1, and for each box only look at the boxes that start before it ends.
+    Returns (first, second, areas) with one entry per unordered pair of boxes with a non-zero intersection area.
+    Identical boxes are not paired up, same as check_intersections (which can't tell them apart from the region itself).
+    '''
+    import numpy as np
+
+    order, start, counts = _sweep_candidates(boxes)
+
+    first_pos = np.repeat(np.arange(len(order)), counts)
+    # offsets inside each run of candidates
+    run_starts = np.cumsum(counts) - counts
+    second_pos = np.arange(counts.sum()) - np.repeat(run_starts, counts) + np.repeat(start, counts)
+
+    first = order[first_pos]
+    second = order[second_pos]
+    a = boxes[first]
+    b = boxes[second]
+    heights = np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0])
+    widths = np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1])
+    areas = np.where((heights > 0) & (widths > 0), heights * widths, 0)
+    keep = (areas > 0) & ~(a == b).all(axis=1)
+    return first[keep], second[keep], areas[keep]
+
+
+def _sweep_candidates(boxes):
+    '''
+    The sweep part of _overlapping_pairs: the boxes sorted by y1 (order), and for the box at sorted position p the
+    number of candidate partners (counts[p]), at sorted positions start[p] .. start[p]+counts[p]-1. counts.sum() is
+    the number of pairs examined.
+    '''
+    import numpy as np
+
+    order = np.argsort(boxes[:, 0], kind='stable')
+    y1_sorted = boxes[order, 0]
+    stop = np.searchsorted(y1_sorted, boxes[order, 2], side='left')
+    start = np.arange(len(order)) + 1
+    return order, start, np.maximum(stop - start, 0)
+
+
+def _max_intersection_partners(n, first, second, areas):
+    '''
+    For every box, the index of the box it intersects the most (the lowest index wins ties, like list.index(max(...)))
+    or -1 if it doesn't intersect anything.
+    '''
+    import numpy as np
+
+    nodes = np.concatenate([first, second])
+    partners = np.concatenate([second, first])
+    both_areas = np.concatenate([areas, areas])
+    # sort by node, then by decreasing area, then by increasing partner index - the first entry per node is the winner
+    order = np.lexsort((partners, -both_areas, nodes))
+    nodes = nodes[order]
+    partners = partners[order]
+    is_first = np.ones(len(nodes), dtype=bool)
+    is_first[1:] = nodes[1:] != nodes[:-1]
+
+    mergee = np.full(n, -1, dtype=np.int64)
+    mergee[nodes[is_first]] = partners[is_first]
+    return mergee
+
+
+def _connected_components(n, first, second):
+    '''
+    Vectorised union-find over n nodes and the edges (first[i], second[i]): hook the larger root onto the smaller one,
+    then compress paths by pointer jumping, until every edge has both ends on the same root.
+    Returns the root of every node, which is the lowest node index in its component.
+    '''
+    import numpy as np
+
+    parent = np.arange(n)
+    while True:
+        root_a = parent[first]
+        root_b = parent[second]
+        pending = root_a != root_b
+        if not pending.any():
+            return parent
+        np.minimum.at(parent, np.maximum(root_a, root_b)[pending], np.minimum(root_a, root_b)[pending])
+        # path compression
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
 
 
 def merge_cluster(indices, regions):
@@ -1,12 +1,50 @@
+import json
+import os
+
 import requests
 
+try:
+    from .metrics import instrumented
+except ImportError:
+    from metrics import instrumented
+
+
+@instrumented('login')
+def create_json_session(web_host, username, password, verify=True, session_file=None):
+    '''
+    Logs in to the OMERO JSON API.
+
+    With session_file, the logged in session (cookies, CSRF token, API URLs, login response - never the password) is
+    kept in that file, readable by the owner only. The next call for the same host and user checks the stored
+    session with one cheap request and reuses it, and only logs in again (rewriting the file) when it has expired.
+    Short jobs and parallel workers then skip the five round trips of a full login.
+
+            Parameters:
+                    web_host (str): OMERO.web address, e.g. https://omero.example.org
+                    username, password (str): credentials
+                    verify (bool): verify the server's TLS certificate
+                    session_file (str): where to keep the session between runs (None: always log in)
+
+            Returns:
+                    login_rsp (dict): the login response (with the eventContext)
+                    session (requests.Session): the logged in session
+                    base_url (str): the JSON API base URL
+    '''
+    if session_file is not None:
+        stored = load_json_session(session_file, web_host, username, verify)
+        if stored is not None:
+            return stored
+    login_rsp, session, base_url, urls = _login(web_host, username, password, verify)
+    if session_file is not None:
+        save_json_session(session_file, web_host, username, login_rsp, session, base_url, urls)
+    return login_rsp, session, base_url
+
 
-def create_json_session(web_host, username, password, verify=True):
+def _login(web_host, username, password, verify):
     session = requests.Session()
     # Start by getting supported versions from the base url...
     api_url = '%s/api/' % web_host
     r = session.get(api_url, verify=verify)
-    print(api_url,r)
     # we get a list of versions
     versions = r.json()['data']
     # use most recent version...
@@ -22,7 +60,6 @@ def create_json_session(web_host, username, password, verify=True):
     # To login we need to get CSRF token
     token_url = urls['url:token']
     token = session.get(token_url).json()['data']
-    print('CSRF token', token)
     # We add this to our session header
     # Needed for all POST, PUT, DELETE requests
     session.headers.update({'X-CSRFToken': token,
@@ -50,9 +87,55 @@ def create_json_session(web_host, username, password, verify=True):
     
     # Can get our 'default' group
 
-    return login_rsp, session, base_url
+    return login_rsp, session, base_url, urls
+
+
+def save_json_session(path, web_host, username, login_rsp, session, base_url, urls):
+    '''
+    Writes a logged in JSON API session to path (mode 0600, replaced atomically so parallel workers never read half
+    a file).
+    '''
+    state = {'web_host': web_host, 'username': username, 'base_url': base_url, 'urls': urls,
+             'login_rsp': login_rsp, 'headers': {k: session.headers[k] for k in ('X-CSRFToken', 'Referer')},
+             'cookies': [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path}
+                         for c in session.cookies]}
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def load_json_session(path, web_host, username, verify=True):
+    '''
+    The session stored in path, as (login_rsp, session, base_url), if it is for this host and user and the server
+    still accepts it; None otherwise.
+    '''
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('web_host') != web_host or state.get('username') != username:
+        return None
+
+    try:
+        session = requests.Session()
+        session.headers.update(state['headers'])
+        for c in state['cookies']:
+            session.cookies.set(c['name'], c['value'], domain=c['domain'], path=c['path'])
+        # one cheap request that needs a valid session: our own experimenter
+        check_url = '{}{}/'.format(state['urls']['url:experimenters'], state['login_rsp']['eventContext']['userId'])
+    except (KeyError, TypeError):
+        # written by something else, or an older version
+        return None
+    r = session.get(check_url, verify=verify, allow_redirects=False)
+    if r.status_code != 200:
+        return None
+    return state['login_rsp'], session, state['base_url']
 
 
+@instrumented('login')
 def create_blitz_session(hostname, username, password):
     from omero.gateway import BlitzGateway
     conn = BlitzGateway(username, password, port=4064, host=hostname)
@@ -0,0 +1,291 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+# the active Recorder, None when instrumentation is off - see enable()
+_recorder = None
+
+# stages measuring memory right now, in any thread of this process: tracemalloc's peak is process-wide, so a stage
+# starting has to fold the peak so far into all of them before resetting it
+_memory_lock = threading.Lock()
+_memory_stages = []
+
+
+def _reset_memory_stages():
+    # a forked child (e.g. run_batch's detection workers) doesn't run the parent's stages, and the lock may have
+    # been held by one of the parent's threads at the time of the fork
+    global _memory_lock, _memory_stages
+    _memory_lock = threading.Lock()
+    _memory_stages = []
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_memory_stages)
+
+# tracemalloc.reset_peak is Python 3.9+; before that the peak can only be reset together with all the traces, which
+# would throw off the stages still running - so we remember the all-time peak at the last "reset" instead
+_high = [0]
+
+
+def _traced_memory():
+    # (current, peak since the last _reset_peak()); call with _memory_lock held
+    current, peak = tracemalloc.get_traced_memory()
+    if hasattr(tracemalloc, 'reset_peak'):
+        return current, peak
+    # a new all-time high is the peak since the reset; otherwise all we know is the current size, so without
+    # reset_peak a stage's peak below an earlier high is underestimated (only sampled when stages start and stop)
+    return current, peak if peak > _high[0] else current
+
+
+def _reset_peak():
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        _high[0] = tracemalloc.get_traced_memory()[1]
+
+
+class Recorder(object):
+    '''
+    Collects per-stage measurements: one record per instrumented call, with the stage name, the image it was for
+    (see image()), wall time, bytes transferred, peak memory and whether it raised. Thread-safe.
+
+            Parameters:
+                    memory (bool): also measure peak memory with tracemalloc (slows everything down noticeably).
+                    tracemalloc can't tell threads apart, so a stage that overlapped with a stage in another thread
+                    of the same process gets no peak (None); nested stages in one thread are fine. run_batch measures
+                    detection in its worker processes, one image at a time, so detect always gets its peak.
+                    Before Python 3.9 (no tracemalloc.reset_peak) a peak below an earlier high is only sampled
+                    at stage boundaries, so it can be underestimated
+    '''
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def current_image(self):
+        return getattr(self._local, 'image_id', None)
+
+    def stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def start(self, name, image_id=None):
+        entry = {'stage': name, 'image_id': image_id if image_id is not None else self.current_image(),
+                 'bytes': 0, 'tic': time.perf_counter()}
+        if self.memory:
+            thread = threading.get_ident()
+            with _memory_lock:
+                current, peak = _traced_memory()
+                for other in _memory_stages:
+                    other['peak'] = max(other['peak'], peak)
+                    if other['thread'] != thread:
+                        other['shared'] = entry['shared'] = True
+                _reset_peak()
+                entry.update(mem=current, peak=current, thread=thread, shared=entry.get('shared', False))
+                _memory_stages.append(entry)
+        self.stack().append(entry)
+        return entry
+
+    def stop(self, entry, ok=True):
+        seconds = time.perf_counter() - entry['tic']
+        self.stack().pop()
+        peak = None
+        if self.memory:
+            with _memory_lock:
+                peak = max(entry['peak'], _traced_memory()[1])
+                # by identity, entries of different stages can compare equal
+                _memory_stages[:] = [e for e in _memory_stages if e is not entry]
+            peak = None if entry['shared'] else peak - entry['mem']
+        self.record(entry['stage'], entry['image_id'], seconds, entry['bytes'], peak, ok)
+
+    def record(self, stage, image_id, seconds, nbytes=0, peak_bytes=None, ok=True):
+        '''
+        Adds one measurement (what stage() does on exit - also used to merge measurements taken elsewhere, e.g. in
+        a worker process).
+        '''
+        with self._lock:
+            self.records.append({'stage': stage, 'image_id': image_id, 'seconds': seconds, 'bytes': nbytes,
+                                 'peak_bytes': peak_bytes, 'ok': ok, 'time': time.time()})
+
+    def add_bytes(self, n):
+        stack = self.stack()
+        if stack:
+            stack[-1]['bytes'] += n
+
+    def totals(self):
+        '''
+        {stage: {'calls', 'errors', 'seconds', 'bytes', 'peak_bytes'}} over all the records, peak_bytes being the
+        largest peak seen.
+        '''
+        totals = OrderedDict()
+        with self._lock:
+            records = list(self.records)
+        for r in records:
+            t = totals.setdefault(r['stage'], {'calls': 0, 'errors': 0, 'seconds': 0.0, 'bytes': 0, 'peak_bytes': None})
+            t['calls'] += 1
+            t['errors'] += not r['ok']
+            t['seconds'] += r['seconds']
+            t['bytes'] += r['bytes']
+            if r['peak_bytes'] is not None:
+                t['peak_bytes'] = max(t['peak_bytes'] or 0, r['peak_bytes'])
+        return totals
+
+    def write_jsonl(self, path):
+        '''
+        One JSON object per record, appended to path.
+        '''
+        with self._lock:
+            records = list(self.records)
+        with open(path, 'a') as f:
+            for r in records:
+                f.write(json.dumps(r) + '\n')
+
+    def write_prometheus(self, path, prefix='detect_rois'):
+        '''
+        Per-stage totals in the Prometheus text format, for node_exporter's textfile collector. Written to a
+        temporary file and renamed so the collector never sees half a file. Per-image numbers are left to
+        write_jsonl - image IDs as labels would make far too many series.
+        '''
+        totals = self.totals()
+        metrics = [('calls_total', 'counter', 'Instrumented calls', 'calls'),
+                   ('errors_total', 'counter', 'Instrumented calls that raised', 'errors'),
+                   ('seconds_total', 'counter', 'Wall time spent in the stage', 'seconds'),
+                   ('bytes_total', 'counter', 'Bytes transferred by the stage', 'bytes'),
+                   ('peak_bytes', 'gauge', 'Largest peak memory (tracemalloc) of a single call', 'peak_bytes')]
+        lines = []
+        for suffix, kind, help_text, key in metrics:
+            name = '{}_stage_{}'.format(prefix, suffix)
+            values = [(stage, t[key]) for stage, t in totals.items() if t[key] is not None]
+            if not values:
+                continue
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for stage, value in values:
+                lines.append('{}{{stage="{}"}} {}'.format(name, stage, value))
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
+
+
+class _Stage(object):
+    __slots__ = ('recorder', 'name', 'image_id', 'entry')
+
+    def __init__(self, recorder, name, image_id):
+        self.recorder = recorder
+        self.name = name
+        self.image_id = image_id
+
+    def __enter__(self):
+        self.entry = self.recorder.start(self.name, self.image_id)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.recorder.stop(self.entry, ok=exc_type is None)
+        return False
+
+
+class _Image(object):
+    __slots__ = ('recorder', 'image_id', 'previous')
+
+    def __init__(self, recorder, image_id):
+        self.recorder = recorder
+        self.image_id = image_id
+
+    def __enter__(self):
+        self.previous = self.recorder.current_image()
+        self.recorder._local.image_id = self.image_id
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.recorder._local.image_id = self.previous
+        return False
+
+
+class _Nothing(object):
+    # what stage() and image() hand out while instrumentation is off
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOTHING = _Nothing()
+
+
+def enable(recorder=None):
+    '''
+    Turns instrumentation on for the whole process, recording into recorder (a new Recorder if not given).
+    Returns the recorder.
+    '''
+    global _recorder
+    _recorder = recorder if recorder is not None else Recorder()
+    return _recorder
+
+
+def disable():
+    '''
+    Turns instrumentation off again; returns the recorder that was active, if any.
+    '''
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def active():
+    return _recorder
+
+
+def stage(name, image_id=None):
+    '''
+    Context manager measuring the enclosed block as one call of the given stage. A shared do-nothing object while
+    instrumentation is off.
+    '''
+    if _recorder is None:
+        return _NOTHING
+    return _Stage(_recorder, name, image_id)
+
+
+def image(image_id):
+    '''
+    Context manager attributing every stage measured in this thread (without an image_id of its own) to image_id.
+    '''
+    if _recorder is None:
+        return _NOTHING
+    return _Image(_recorder, image_id)
+
+
+def add_bytes(n):
+    '''
+    Counts n bytes transferred towards the innermost stage open in this thread.
+    '''
+    if _recorder is not None:
+        _recorder.add_bytes(n)
+
+
+def instrumented(name):
+    '''
+    Decorator measuring every call of the function as one call of stage name. With instrumentation off, the only
+    cost is the check of a global.
+    '''
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return fn(*args, **kwargs)
+            with _Stage(_recorder, name, None):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
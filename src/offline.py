@@ -0,0 +1,249 @@
+import glob
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+try:
+    from .region_set import RegionSet
+except ImportError:
+    from region_set import RegionSet
+
+
+class DetectionStore(object):
+    '''
+    Compact columnar store for detection results, so detection can run without any Blitz connection and the ROIs
+    be committed to OMERO later (see commit_detections).
+
+    The store is a directory of part files (.npz), each holding the columns image_id, order, y1, x1, y2, x2, scale
+    and params (an index into the part's table of JSON-encoded detection parameters) for every ROI, plus the list
+    of images it covers - so images where nothing was found are remembered too. Parts are written to a temporary
+    name and renamed, so a crash never leaves half a part behind, and whatever was flushed before it is kept. An
+    image detected again (e.g. with other parameters) is taken from the newest part. Safe to share between threads.
+
+            Parameters:
+                    path (str): store directory (created if missing)
+                    flush_every (int): number of images buffered in memory before a part is written
+    '''
+    COLUMNS = ('image_id', 'order', 'y1', 'x1', 'y2', 'x2', 'scale', 'params')
+
+    def __init__(self, path, flush_every=100):
+        self.path = path
+        self.flush_every = flush_every
+        self._buffer = []
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, image_id, regions, scale, params):
+        '''
+        Buffers the regions detected on one image (at the given scale, with the given create_rois parameters).
+        '''
+        regions = RegionSet.from_regions(regions)
+        with self._lock:
+            self._buffer.append((image_id, regions, scale, json.dumps(params, sort_keys=True)))
+            full = len(self._buffer) >= self.flush_every
+        if full:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the buffered images out as a new part.
+        '''
+        with self._lock:
+            buffered, self._buffer = self._buffer, []
+        if not buffered:
+            return
+        # an image added twice before a flush keeps its last result
+        latest = {b[0]: b for b in buffered}
+        buffered = [b for b in buffered if latest[b[0]] is b]
+        table = sorted(set(b[3] for b in buffered))
+        counts = [len(b[1]) for b in buffered]
+        boxes = np.concatenate([b[1].boxes for b in buffered] + [np.zeros((0, 4), np.int32)])
+        columns = {
+            'images': np.array([b[0] for b in buffered], dtype=np.int64),
+            'image_id': np.repeat([b[0] for b in buffered], counts).astype(np.int64),
+            'order': np.concatenate([np.arange(1, n + 1, dtype=np.int32) for n in counts] + [np.zeros(0, np.int32)]),
+            'y1': boxes[:, 0], 'x1': boxes[:, 1], 'y2': boxes[:, 2], 'x2': boxes[:, 3],
+            'scale': np.repeat([float(b[2]) for b in buffered], counts),
+            'params': np.repeat([table.index(b[3]) for b in buffered], counts).astype(np.int32),
+            'param_table': np.array(table),
+        }
+        name = os.path.join(self.path, 'part-{:.6f}-{}-{}.npz'.format(time.time(), os.getpid(), threading.get_ident()))
+        with open(name + '.tmp', 'wb') as f:
+            np.savez_compressed(f, **columns)
+        os.replace(name + '.tmp', name)
+
+    def parts(self):
+        # oldest first, so newer parts overwrite older ones when reading
+        return sorted(glob.glob(os.path.join(self.path, 'part-*.npz')),
+                      key=lambda p: float(os.path.basename(p).split('-')[1]))
+
+    def images(self):
+        '''
+        IDs of all the images in the store (flushed parts only).
+        '''
+        ids = set()
+        for part in self.parts():
+            with np.load(part) as data:
+                ids.update(data['images'].tolist())
+        return ids
+
+    def read(self):
+        '''
+        {image_id: (regions, scale, params, part)} for every image in the store, regions in their saved order and
+        part the name of the part file they came from (what the commit journal goes by).
+        '''
+        results = {}
+        for part in self.parts():
+            with np.load(part) as data:
+                columns = {k: data[k] for k in self.COLUMNS}
+                table = [json.loads(p) for p in data['param_table'].tolist()]
+                images = data['images']
+            # rows of one image are contiguous and in order, so split at the image boundaries
+            bounds = np.flatnonzero(np.diff(columns['image_id'])) + 1
+            groups = np.split(np.arange(len(columns['image_id'])), bounds)
+            rows = {int(columns['image_id'][g[0]]): g for g in groups if len(g)}
+            for image_id in images.tolist():
+                g = rows.get(image_id, np.zeros(0, np.int64))
+                boxes = np.stack([columns[c][g] for c in ('y1', 'x1', 'y2', 'x2')], axis=1).reshape(-1, 4)
+                scale = float(columns['scale'][g[0]]) if len(g) else None
+                params = table[columns['params'][g[0]]] if len(g) else None
+                results[image_id] = (RegionSet(boxes), scale, params, os.path.basename(part))
+        return results
+
+
+class CommitJournal(object):
+    '''
+    Append-only record of the images whose ROIs made it into OMERO - one "image_id part" line per image, flushed to
+    disk after every line - so an interrupted commit picks up where it stopped. Going by the part the results came
+    from means an image detected again after being committed gets committed again.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.committed = {}
+        if os.path.exists(path):
+            with open(path, 'r+') as f:
+                lines = f.read().split('\n')
+                # a crash can leave a half-written last line, cut it off before appending after it
+                if lines[-1]:
+                    f.truncate(sum(len(line) + 1 for line in lines[:-1]))
+                for line in lines[:-1]:
+                    if line.strip():
+                        image_id, part = line.split()
+                        self.committed[int(image_id)] = part
+        self._file = open(path, 'a')
+
+    def done(self, image_id, part):
+        return self.committed.get(image_id) == part
+
+    def record(self, image_id, part):
+        with self._lock:
+            self._file.write('{} {}\n'.format(image_id, part))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.committed[image_id] = part
+
+    def close(self):
+        self._file.close()
+
+
+def commit_detections(store, journal, save_regions, workers=1):
+    '''
+    Replays a DetectionStore into OMERO, skipping the images the journal already has. An image that was saved but not
+    yet journaled when a commit got interrupted is saved again, so save_regions must be safe to repeat: either
+    sync_rois(..., delete=False), which only adds the ROIs the image doesn't have yet and leaves all others alone, or
+    save_rois(..., replace=True) for a rerun that should delete every ROI already on the images.
+
+            Parameters:
+                    store (DetectionStore): detection results
+                    journal (CommitJournal): images already committed
+                    save_regions (callable): save_regions(image_id, regions, scale)
+                    workers (int): images committed in parallel
+
+            Returns:
+                    (committed, skipped, failed) (tuple): numbers of images committed now, skipped because already
+                    done, and failed ({image_id: error message})
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    results = store.read()
+    pending = [(image_id, results[image_id]) for image_id in sorted(results)
+               if not journal.done(image_id, results[image_id][3])]
+    skipped = len(results) - len(pending)
+    failed = {}
+
+    def commit(item):
+        image_id, (regions, scale, params, part) = item
+        try:
+            save_regions(image_id, regions, scale if scale is not None else 1)
+        except Exception as e:
+            failed[image_id] = '{}: {}'.format(type(e).__name__, e)
+            return False
+        journal.record(image_id, part)
+        return True
+
+    with ThreadPoolExecutor(workers) as pool:
+        committed = sum(pool.map(commit, pending))
+    return committed, skipped, failed
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from create_session import create_blitz_session
+    from retrieve_image import get_image
+    from save_rois import save_rois, sync_rois
+    from client_policy import policy_from_args
+
+    parser = argparse.ArgumentParser(description='Commit ROIs detected with batch.py --detect-only to OMERO')
+    parser.add_argument('store', help='detection store directory')
+    parser.add_argument('--journal', help='commit journal (defaults to committed.txt in the store)')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--rerun',
+                        dest='rerun',
+                        action='store_true',
+                        help='Set this flag if it is a rerun (WILL delete ALL existing ROIs)')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='retry OMERO calls that fail with a transient error up to this many times, with backoff')
+    parser.add_argument('--adaptive-limit', type=int, default=0, metavar='MAX',
+                        help='adapt the number of concurrent OMERO calls to the server latency and errors, up to MAX')
+    args = parser.parse_args(sys.argv[1:])
+
+    HOSTNAME = os.environ['OMERO_HOSTNAME']
+    USERNAME = os.environ['OMERO_ADMIN_USER']
+    PASSWORD = os.environ['OMERO_ADMIN_PASSWORD']
+
+    # Blitz connections aren't meant to be shared between threads
+    local = threading.local()
+    conns = []
+
+    policy = policy_from_args(args.retries, args.adaptive_limit)
+    call = policy.call if policy is not None else (lambda fn, *a, **kw: fn(*a, **kw))
+
+    def save_regions(image_id, regions, scale):
+        if not hasattr(local, 'conn'):
+            local.conn = call(create_blitz_session, HOSTNAME, USERNAME, PASSWORD)
+            conns.append(local.conn)
+        image = call(get_image, local.conn, image_id)
+        # both are safe to retry: replacing ends up the same, and syncing without deleting adds only what's missing
+        if args.rerun:
+            call(save_rois, image, regions, scale, True)
+        else:
+            call(sync_rois, image, regions, scale, delete=False)
+
+    journal = CommitJournal(args.journal or os.path.join(args.store, 'committed.txt'))
+    try:
+        committed, skipped, failed = commit_detections(DetectionStore(args.store), journal, save_regions, args.workers)
+    finally:
+        journal.close()
+        for conn in conns:
+            conn.close()
+    print('{} images committed, {} already done, {} failed'.format(committed, skipped, len(failed)))
+    for image_id, error in sorted(failed.items()):
+        print('  image {}: {}'.format(image_id, error))
+    sys.exit(1 if failed else 0)
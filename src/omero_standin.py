@@ -0,0 +1,422 @@
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+try:
+    from .synthetic import synthetic_slide
+except ImportError:
+    from synthetic import synthetic_slide
+
+
+class TryAgain(Exception):
+    '''
+    What the fake Blitz gateway raises for injected errors - named like the transient omero exception, so
+    client_policy.is_transient treats it the same way.
+    '''
+
+
+class StandInServer(object):
+    '''
+    Local stand-in for OMERO, for tests and load tests without a real server: the subset of the JSON API used by
+    create_json_session, retrieve_image and ImageClient (version discovery, CSRF token, server list, login, image
+    and dataset listings, image metadata), birds-eye view jpegs, pyramid descriptions (imgData) and tiles of
+    synthetic slides (see synthetic.py), and - through FakeBlitzGateway - the update/ROI services save_rois and sync_rois use.
+
+    Everything except version discovery, token, server list and login needs a logged in session. Latency and errors
+    can be injected, and capacity makes it behave like a server that can only work on so many requests at once.
+
+            Parameters:
+                    images (dict): {image_id: (SizeX, SizeY)} of the full-resolution images
+                    datasets (dict): {dataset_id: [image_id, ...]}
+                    projects (dict): {project_id: [dataset_id, ...]}
+                    username, password (str): the only account
+                    latency (num): seconds added to every request (and Blitz call)
+                    jitter (num): extra random latency, up to that many seconds
+                    error_rate (float): fraction of requests (and Blitz calls) answered with a 503 (TryAgain)
+                    capacity (int): requests handled at once, the others wait (None for no limit)
+                    pyramid_factor (int): size ratio between pyramid levels
+                    seed (int): for the injected errors and jitter
+    '''
+
+    def __init__(self, images=None, datasets=None, projects=None, username='root', password='omero',
+                 latency=0.0, jitter=0.0, error_rate=0.0, capacity=None, pyramid_factor=2, seed=0):
+        self.images = dict(images if images is not None else {i: (8192 + 256 * i, 6144) for i in range(1, 9)})
+        self.datasets = dict(datasets if datasets is not None else {1: sorted(self.images)})
+        self.projects = dict(projects if projects is not None else {1: sorted(self.datasets)})
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.pyramid_factor = pyramid_factor
+        self.fail_next = 0
+        self.hits = Counter()
+        self.sessions = set()
+        self.rois = {}
+        self._next_roi = 1
+        self._renders = OrderedDict()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(capacity) if capacity else None
+        self._httpd = None
+
+    # server life cycle
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.standin = self
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    @property
+    def host(self):
+        '''
+        What create_json_session takes as web_host.
+        '''
+        return 'http://%s:%d' % self._httpd.server_address
+
+    @property
+    def base_url(self):
+        return self.host + '/api/v0/'
+
+    # behaviour shared by the HTTP and the Blitz side
+
+    def misbehave(self):
+        '''
+        Sleeps for the injected latency and says whether this call should fail.
+        '''
+        with self._lock:
+            delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0)
+            fail = self.fail_next > 0 or (self.error_rate and self._rng.random() < self.error_rate)
+            self.fail_next -= self.fail_next > 0
+        if delay:
+            time.sleep(delay)
+        return fail
+
+    def expire_sessions(self):
+        '''
+        Logs every session out, as if they had timed out.
+        '''
+        with self._lock:
+            self.sessions.clear()
+
+    def image_json(self, image_id):
+        # the shape OMERO.web gives an image: permissions and owner in omero:details, but no update event
+        size_x, size_y = self.images[image_id]
+        return {'@id': image_id, '@type': 'http://www.openmicroscopy.org/Schemas/OME/2016-06#Image',
+                'Name': 'slide_{}.svs'.format(image_id),
+                'Pixels': {'@id': image_id, 'SizeX': size_x, 'SizeY': size_y, 'SizeZ': 1, 'SizeC': 3, 'SizeT': 1},
+                'omero:details': {'@type': 'TBD#Details', 'owner': {'@id': 0, 'UserName': self.username},
+                                  'group': {'@id': 0, 'Name': 'system'},
+                                  'permissions': {'perm': 'rwra--', 'canEdit': True, 'canAnnotate': True}}}
+
+    def zoom_levels(self, image_id):
+        '''
+        {level: scale} of the image's pyramid, like imgData's zoomLevelScaling: levels down to 256 pixels wide.
+        '''
+        size_x = self.images[image_id][0]
+        levels = {0: 1.0}
+        while -(-size_x // self.pyramid_factor ** len(levels)) >= 256:
+            width = -(-size_x // self.pyramid_factor ** len(levels))
+            levels[len(levels)] = width / size_x
+        return levels
+
+    def slide(self, image_id, width, height):
+        '''
+        Synthetic slide of an image, rendered at width x height (the same sections at every size).
+        '''
+        key = (image_id, width, height)
+        with self._lock:
+            if key in self._renders:
+                self._renders.move_to_end(key)
+                return self._renders[key]
+        image, _ = synthetic_slide((height, width), grid=(2 + image_id % 3, 3 + image_id % 2),
+                                   specks=int(width * height / 2000), seed=image_id)
+        with self._lock:
+            self._renders[key] = image
+            while len(self._renders) > 64:
+                self._renders.popitem(last=False)
+        return image
+
+    def saved_boxes(self, image_id):
+        '''
+        (x, y, width, height, label) of every rectangle saved on an image through FakeBlitzGateway.
+        '''
+        boxes = []
+        for roi in self.rois.get(image_id, []):
+            for shape in roi.copyShapes():
+                text = shape.getTextValue()
+                boxes.append(tuple(v.getValue() for v in (shape.getX(), shape.getY(), shape.getWidth(), shape.getHeight()))
+                             + (text.getValue() if text is not None else None,))
+        return boxes
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, status=200, content_type='application/json', headers=()):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def session_id(self):
+        for part in self.headers.get('Cookie', '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == 'sessionid':
+                return value
+        return None
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        standin = self.server.standin
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        standin.hits[parts[0] + '/' + parts[1] if parts[:1] == ['webgateway'] else url.path] += 1
+
+        slots = standin._slots
+        if slots is not None:
+            slots.acquire()
+        try:
+            if standin.misbehave():
+                self.reply({'message': 'Service temporarily unavailable'}, 503, headers=[('Retry-After', '0')])
+                return
+            self.route(standin, method, url, parts)
+        finally:
+            if slots is not None:
+                slots.release()
+
+    def route(self, standin, method, url, parts):
+        query = parse_qs(url.query)
+        base = standin.base_url
+        if url.path == '/api/':
+            self.reply({'data': [{'version': '0', 'url:base': base}]})
+        elif url.path == '/api/v0/':
+            self.reply({'url:experimenters': base + 'm/experimenters/', 'url:projects': base + 'm/projects/',
+                        'url:datasets': base + 'm/datasets/', 'url:images': base + 'm/images/',
+                        'url:token': base + 'token/', 'url:servers': base + 'servers/', 'url:login': base + 'login/',
+                        'url:save': base + 'm/save/', 'url:schema': 'http://www.openmicroscopy.org/Schemas/OME/2016-06'})
+        elif url.path == '/api/v0/token/':
+            self.reply({'data': 'csrf-' + uuid.uuid4().hex}, headers=[('Set-Cookie', 'csrftoken=x; Path=/')])
+        elif url.path == '/api/v0/servers/':
+            self.reply({'data': [{'id': 1, 'host': 'localhost', 'port': 4064, 'server': 'omero'}]})
+        elif url.path == '/api/v0/login/' and method == 'POST':
+            self.login(standin)
+        elif self.session_id() not in standin.sessions:
+            self.reply({'message': 'Not logged in'}, 403)
+        elif url.path == '/api/v0/m/images/':
+            ids = standin.datasets.get(int(query['dataset'][0]), []) if 'dataset' in query else sorted(standin.images)
+            self.page([standin.image_json(i) for i in ids], query)
+        elif url.path == '/api/v0/m/datasets/':
+            ids = standin.projects.get(int(query['project'][0]), []) if 'project' in query else sorted(standin.datasets)
+            self.page([{'@id': d, 'Name': 'dataset {}'.format(d)} for d in ids], query)
+        elif parts[:4] == ['api', 'v0', 'm', 'images'] and len(parts) == 5:
+            image_id = int(parts[4])
+            if image_id not in standin.images:
+                self.reply({'message': 'Image {} not found'.format(image_id)}, 404)
+            else:
+                self.reply({'data': standin.image_json(image_id)})
+        elif parts[:4] == ['api', 'v0', 'm', 'experimenters'] and len(parts) == 5:
+            self.reply({'data': {'@id': int(parts[4]), 'UserName': standin.username}})
+        elif parts[:2] == ['webgateway', 'render_birds_eye_view']:
+            image_id, width = int(parts[2]), int(parts[3])
+            size_x, size_y = standin.images[image_id]
+            self.jpeg(standin.slide(image_id, width, max(1, round(width * size_y / size_x))))
+        elif parts[:2] == ['webgateway', 'imgData']:
+            image_id = int(parts[2])
+            size_x, size_y = standin.images[image_id]
+            self.reply({'id': image_id, 'size': {'width': size_x, 'height': size_y}, 'tiles': True,
+                        'tile_size': {'width': 256, 'height': 256}, 'levels': len(standin.zoom_levels(image_id)),
+                        'zoomLevelScaling': standin.zoom_levels(image_id)})
+        elif parts[:2] == ['webgateway', 'render_image_region']:
+            self.tile(standin, int(parts[2]), query['tile'][0])
+        else:
+            self.reply({'message': 'Not found'}, 404)
+
+    def login(self, standin):
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        if not self.headers.get('X-CSRFToken'):
+            self.reply({'message': 'CSRF verification failed'}, 403)
+            return
+        if form.get('username') != [standin.username] or form.get('password') != [standin.password]:
+            self.reply({'message': 'Login failed. Reason: Incorrect username or password'}, 403)
+            return
+        session = uuid.uuid4().hex
+        with standin._lock:
+            standin.sessions.add(session)
+        self.reply({'success': True, 'eventContext': {'userName': standin.username, 'sessionUuid': session,
+                                                      'groupId': 0, 'userId': 0}},
+                   headers=[('Set-Cookie', 'sessionid={}; Path=/; HttpOnly'.format(session))])
+
+    def page(self, objects, query):
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['200'])[0])
+        self.reply({'data': objects[offset:offset + limit],
+                    'meta': {'offset': offset, 'limit': limit, 'totalCount': len(objects)}})
+
+    def tile(self, standin, image_id, tile):
+        level, col, row, width, height = [int(v) for v in tile.split(',')]
+        size_x, size_y = standin.images[image_id]
+        downsample = standin.pyramid_factor ** level
+        full_w, full_h = -(-size_x // downsample), -(-size_y // downsample)
+        # levels too big to render whole come from a smaller slide, blown up (nearest neighbour)
+        factor = max(1, -(-full_w // 4096))
+        image = standin.slide(image_id, -(-full_w // factor), -(-full_h // factor))
+        ys = np.arange(row * height, min((row + 1) * height, full_h)) // factor
+        xs = np.arange(col * width, min((col + 1) * width, full_w)) // factor
+        self.jpeg(image[ys[:, None], xs])
+
+    def jpeg(self, image):
+        from PIL import Image
+        buf = BytesIO()
+        Image.fromarray(image).save(buf, format='JPEG', quality=90)
+        self.reply(buf.getvalue(), content_type='image/jpeg')
+
+
+class FakeBlitzGateway(object):
+    '''
+    Just enough of omero.gateway.BlitzGateway for get_image, save_rois, sync_rois and remove_all_rois, keeping the
+    ROIs in the StandInServer (saved_boxes shows what ended up there). Calls go through the server's injected
+    latency and errors. Saving needs omero-py for the model objects, like save_rois itself.
+    '''
+
+    def __init__(self, standin, username=None, password=None):
+        self.standin = standin
+        self.username = username if username is not None else standin.username
+        self.password = password if password is not None else standin.password
+        self.connected = False
+
+    def connect(self):
+        self._call()
+        self.connected = self.username == self.standin.username and self.password == self.standin.password
+        return self.connected
+
+    def isConnected(self):
+        return self.connected
+
+    def keepAlive(self):
+        return self.connected
+
+    def close(self):
+        self.connected = False
+
+    def _call(self):
+        if self.standin.misbehave():
+            raise TryAgain('injected error')
+
+    def getObject(self, obj_type, obj_id):
+        self._call()
+        if obj_type != 'Image' or obj_id not in self.standin.images:
+            return None
+        return _FakeImage(self, obj_id)
+
+    def getUpdateService(self):
+        return _FakeUpdateService(self)
+
+    def getRoiService(self):
+        return _FakeRoiService(self)
+
+    def deleteObjects(self, graph_spec, obj_ids, wait=False):
+        self._call()
+        obj_ids = set(obj_ids)
+        with self.standin._lock:
+            for image_id, rois in self.standin.rois.items():
+                self.standin.rois[image_id] = [r for r in rois if r.getId().getValue() not in obj_ids]
+
+
+class _FakeImage(object):
+    def __init__(self, conn, image_id):
+        self._conn = conn
+        self.image_id = image_id
+        try:
+            from omero.model import ImageI
+            self._obj = ImageI(image_id, False)
+        except ImportError:
+            self._obj = None
+
+    def getId(self):
+        return self.image_id
+
+    def getDetails(self):
+        return _FakeDetails()
+
+
+class _FakeDetails(object):
+    # only the group is asked for: getDetails().getGroup().getId()
+    def getGroup(self):
+        return self
+
+    def getId(self):
+        return 0
+
+
+class _FakeUpdateService(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def saveAndReturnArray(self, rois, ctx):
+        from omero.rtypes import rlong
+        self.conn._call()
+        standin = self.conn.standin
+        with standin._lock:
+            for roi in rois:
+                roi.setId(rlong(standin._next_roi))
+                standin._next_roi += 1
+                standin.rois.setdefault(roi.getImage().getId().getValue(), []).append(roi)
+        return list(rois)
+
+    def saveArray(self, rois, ctx):
+        self.saveAndReturnArray(rois, ctx)
+
+    def saveAndReturnObject(self, roi, ctx):
+        return self.saveAndReturnArray([roi], ctx)[0]
+
+
+class _FakeRoiService(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def findByImage(self, image_id, options):
+        self.conn._call()
+
+        class Result(object):
+            rois = list(self.conn.standin.rois.get(image_id, []))
+        return Result()
@@ -0,0 +1,218 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    from .create_rois import diamond_closing, create_rois, inverted_gray, threshold_value, prune_regions, order_regions
+    from .region_set import RegionSet
+except ImportError:
+    from create_rois import diamond_closing, create_rois, inverted_gray, threshold_value, prune_regions, order_regions
+    from region_set import RegionSet
+
+
+def create_rois_refined(client, img_id, size_thresh, method_thresh, closing, coarse_scale=128, fine_scale=16,
+                        margin=2, fine_closing=0, tile_size=512, workers=4, order_strategy='rows', stats=None,
+                        grayscale=True):
+    '''
+    Coarse-to-fine detection: run create_rois on a very small birds-eye view (coarse_scale), then only fetch the
+    fine_scale pyramid tiles around each candidate box and refine its edges there (see refine_regions). Downloads
+    and processes a small fraction of the pixels a whole-slide run at fine_scale would, with fine_scale accuracy.
+
+            Parameters:
+                    client (ImageClient): client for the JSON API / webgateway
+                    img_id (int): OMERO image ID
+                    size_thresh, method_thresh, closing, order_strategy: same as create_rois (closing at the coarse scale)
+                    coarse_scale (int): scale factor for the first, whole-slide pass
+                    fine_scale (int): scale factor the boxes are refined at - tiles come from the pyramid level that
+                    is the image scaled down by fine_scale; without one, create_rois runs on the whole fine_scale
+                    birds-eye view instead
+                    margin (num): how far around each coarse box to look, in coarse pixels
+                    fine_closing (int): closing radius used when refining, at the fine scale
+                    tile_size (int): size of the fine-scale tiles requested from the server
+                    workers (int): boxes refined in parallel
+                    stats (dict): if given, filled with the number of tiles and pixels fetched at the fine scale
+                    grayscale (bool): decode the jpegs straight to uint8 grayscale (see fetch_jpeg)
+
+            Returns:
+                    regions (RegionSet): pruned, ordered boxes in fine_scale coordinates - save them with save_rois(image, regions, fine_scale, ...)
+    '''
+    try:
+        from .tiled import pyramid_level
+    except ImportError:
+        from tiled import pyramid_level
+
+    size_x, size_y = client.image_size(img_id)
+    levels = client.zoom_levels(img_id)
+    level = pyramid_level(levels, size_x, fine_scale)
+    if level is None:
+        # no pyramid level at the fine scale: detect on the whole fine birds-eye view
+        return create_rois(client.retrieve(img_id, fine_scale, grayscale), size_thresh, method_thresh, closing,
+                           fine_scale, order_strategy)
+
+    coarse = client.retrieve(img_id, coarse_scale, grayscale)
+    threshold = threshold_value(inverted_gray(coarse), method_thresh)
+    regions = create_rois(coarse, size_thresh, method_thresh, closing, coarse_scale, order_strategy)
+    del coarse
+
+    shape = (int(round(size_y * levels[level])), int(round(size_x * levels[level])))
+
+    def fetch_tile(row, col):
+        return client.render_tile(img_id, level, col, row, tile_size, tile_size, grayscale=grayscale)
+
+    regions = refine_regions(regions, coarse_scale / fine_scale, TileReader(fetch_tile, tile_size, shape), threshold,
+                             margin=margin, closing=fine_closing, workers=workers, stats=stats)
+    # two coarse boxes can refine onto the same section (or one that grew into its neighbour's), so the refined
+    # boxes get the same merging and ordering as create_rois' own
+    regions = prune_regions(regions)
+    return order_regions(regions, order_strategy)
+
+
+def refine_regions(regions, ratio, reader, threshold, margin=2, closing=0, workers=4, stats=None, max_grow=4):
+    '''
+    Refine coarse boxes at a finer scale. Every box is scaled up by ratio and grown by margin coarse pixels; that
+    crop is read at the fine scale, thresholded with the (global) threshold, closed and labelled, and the box becomes
+    the bounding box of the components that belong to the scaled-up coarse box: those with at least half of their
+    pixels in it, or their centroid. A neighbouring section that only pokes into the box (coarse boxes are a coarse
+    pixel off either way) is left to its own box. When one of those components runs into the edge of the crop, the
+    crop is grown on that side and the box refined again, up to max_grow times. Boxes where nothing is found keep
+    their scaled-up coarse coordinates. Order is preserved, one refined box per coarse box - so refined boxes can
+    overlap or coincide (create_rois_refined runs them through prune_regions).
+
+            Parameters:
+                    regions (RegionSet or list): coarse boxes of the form (y1,x1,y2,x2)
+                    ratio (num): coarse scale factor / fine scale factor
+                    reader (TileReader): gives crops of the fine-scale image
+                    threshold (float): threshold for inverted_gray crops (e.g. computed on the coarse image)
+                    margin (num): how far around each box to look, in coarse pixels
+                    closing (int): closing radius at the fine scale
+                    workers (int): boxes refined in parallel
+                    stats (dict): if given, filled with the number of tiles and pixels read
+                    max_grow (int): how many times a crop may be grown to take in the whole of a component
+
+            Returns:
+                    regions (RegionSet): refined boxes in fine-scale coordinates
+    '''
+    regions = RegionSet.from_regions(regions)
+    height, width = reader.shape
+    scaled = np.round(regions.scaled(ratio)).astype(np.int64)
+    pad = int(np.ceil(margin * ratio))
+    windows = scaled + np.array([-pad, -pad, pad, pad])
+    windows[:, [0, 2]] = np.clip(windows[:, [0, 2]], 0, height)
+    windows[:, [1, 3]] = np.clip(windows[:, [1, 3]], 0, width)
+
+    def refine(i):
+        window = windows[i].copy()
+        if window[2] <= window[0] or window[3] <= window[1]:
+            return tuple(scaled[i])
+        for _ in range(max_grow + 1):
+            box, cut = _refine_box(reader.read(*window), window, scaled[i], threshold, closing)
+            # sides at the edge of the image can't grow
+            cut &= window != (0, 0, height, width)
+            if not cut.any():
+                break
+            # double the crop on the sides a component was cut off at
+            grow = np.array([window[2] - window[0], window[3] - window[1]] * 2)
+            window = np.where(cut, window + np.array([-1, -1, 1, 1]) * grow, window)
+            window[[0, 2]] = np.clip(window[[0, 2]], 0, height)
+            window[[1, 3]] = np.clip(window[[1, 3]], 0, width)
+        return box
+
+    with ThreadPoolExecutor(workers) as pool:
+        refined = list(pool.map(refine, range(len(regions))))
+    if stats is not None:
+        stats['tiles'] = reader.tiles_fetched
+        stats['pixels'] = reader.pixels_fetched
+    return RegionSet(np.array(refined, dtype=np.int64).reshape(-1, 4))
+
+
+def _refine_box(crop, window, box, threshold, closing):
+    '''
+    The refined box (in image coordinates), and which sides of the crop (top, left, bottom, right) the components
+    kept for it touch.
+    '''
+    from skimage.measure import label
+
+    im_thresh = inverted_gray(crop) > threshold
+    if closing:
+        im_thresh = diamond_closing(im_thresh, closing)
+    im_lab = label(im_thresh)
+    n = im_lab.max()
+    no_cut = np.zeros(4, dtype=bool)
+    if n == 0:
+        return tuple(box), no_cut
+
+    # the (scaled-up) coarse box, in crop coordinates
+    by1, bx1 = max(box[0] - window[0], 0), max(box[1] - window[1], 0)
+    by2, bx2 = box[2] - window[0], box[3] - window[1]
+    inside = np.bincount(im_lab[by1:by2, bx1:bx2].ravel(), minlength=n + 1)
+    total = np.bincount(im_lab.ravel(), minlength=n + 1)
+    h, w = im_lab.shape
+    cy = np.bincount(im_lab.ravel(), weights=np.repeat(np.arange(h), w), minlength=n + 1) / np.maximum(total, 1)
+    cx = np.bincount(im_lab.ravel(), weights=np.tile(np.arange(w), h), minlength=n + 1) / np.maximum(total, 1)
+
+    # components that belong to the box: mostly inside it, or centred in it
+    centred = (cy >= by1) & (cy < by2) & (cx >= bx1) & (cx < bx2)
+    wanted = np.nonzero((inside > 0) & ((2 * inside >= total) | centred))[0]
+    wanted = wanted[wanted > 0]
+    if len(wanted) == 0:
+        return tuple(box), no_cut
+    mask = np.isin(im_lab, wanted)
+    ys, xs = np.nonzero(mask)
+    cut = np.array([mask[0].any(), mask[:, 0].any(), mask[-1].any(), mask[:, -1].any()])
+    return (window[0] + ys.min(), window[1] + xs.min(), window[0] + ys.max() + 1, window[1] + xs.max() + 1), cut
+
+
+class TileReader(object):
+    '''
+    Reads arbitrary crops of a tiled image, fetching only the tiles it needs and keeping the most recent ones
+    (neighbouring boxes often share tiles). Thread-safe.
+
+            Parameters:
+                    fetch_tile (callable): fetch_tile(row, col) -> array of tile (row, col); edge tiles may be smaller
+                    tile_size (int): nominal tile width and height
+                    shape (tuple): (height, width) of the whole image at this scale
+                    cache_tiles (int): how many tiles to keep around
+    '''
+
+    def __init__(self, fetch_tile, tile_size, shape, cache_tiles=64):
+        self.fetch_tile = fetch_tile
+        self.tile_size = tile_size
+        self.shape = tuple(shape)
+        self.cache_tiles = cache_tiles
+        self.tiles_fetched = 0
+        self.pixels_fetched = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def tile(self, row, col):
+        with self._lock:
+            if (row, col) in self._cache:
+                self._cache.move_to_end((row, col))
+                return self._cache[(row, col)]
+        tile = self.fetch_tile(row, col)
+        with self._lock:
+            self.tiles_fetched += 1
+            self.pixels_fetched += tile.shape[0] * tile.shape[1]
+            self._cache[(row, col)] = tile
+            while len(self._cache) > self.cache_tiles:
+                self._cache.popitem(last=False)
+        return tile
+
+    def read(self, y1, x1, y2, x2):
+        '''
+        The (y1:y2, x1:x2) crop of the image.
+        '''
+        ts = self.tile_size
+        out = None
+        for row in range(y1 // ts, -(-y2 // ts)):
+            for col in range(x1 // ts, -(-x2 // ts)):
+                tile = self.tile(row, col)
+                if out is None:
+                    out = np.empty((y2 - y1, x2 - x1) + tile.shape[2:], dtype=tile.dtype)
+                # overlap between the tile and the crop, in image coordinates
+                ty1, tx1 = max(y1, row * ts), max(x1, col * ts)
+                ty2, tx2 = min(y2, row * ts + tile.shape[0]), min(x2, col * ts + tile.shape[1])
+                out[ty1 - y1:ty2 - y1, tx1 - x1:tx2 - x1] = tile[ty1 - row * ts:ty2 - row * ts, tx1 - col * ts:tx2 - col * ts]
+        return out
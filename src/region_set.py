@@ -0,0 +1,124 @@
+import numpy as np
+
+
+class RegionSet(object):
+    '''
+    Compact container for ROI bounding boxes: a contiguous N x 4 int32 array with rows of the form (y1,x1,y2,x2),
+    same convention as skimage regionprops bboxes.
+
+    It behaves like the old lists of tuples (len, iteration, indexing and == all work with tuples), so code that
+    used to receive a list of regions keeps working. Boolean masks, index arrays and slices give back a RegionSet.
+    '''
+    __slots__ = ('_boxes',)
+
+    def __init__(self, boxes=()):
+        boxes = np.ascontiguousarray(boxes, dtype=np.int32)
+        if boxes.size == 0:
+            boxes = boxes.reshape(0, 4)
+        if boxes.ndim != 2 or boxes.shape[1] != 4:
+            raise ValueError("Expected an N x 4 array of (y1,x1,y2,x2) boxes, got shape {}".format(boxes.shape))
+        self._boxes = boxes
+
+    @classmethod
+    def from_regions(cls, regions):
+        '''
+        Conversion layer: accepts a RegionSet (returned as-is), a list of (y1,x1,y2,x2) tuples or an N x 4 array.
+        '''
+        if isinstance(regions, cls):
+            return regions
+        return cls(list(regions) if not isinstance(regions, np.ndarray) else regions)
+
+    @classmethod
+    def concatenate(cls, region_sets):
+        arrays = [cls.from_regions(r).boxes for r in region_sets]
+        if not arrays:
+            return cls()
+        return cls(np.concatenate(arrays))
+
+    @property
+    def boxes(self):
+        '''
+        Read-only N x 4 int32 view of the underlying array.
+        '''
+        view = self._boxes.view()
+        view.flags.writeable = False
+        return view
+
+    @property
+    def heights(self):
+        return self._boxes[:, 2] - self._boxes[:, 0]
+
+    @property
+    def widths(self):
+        return self._boxes[:, 3] - self._boxes[:, 1]
+
+    def centroids(self):
+        '''
+        N x 2 float array of (X, Y) centroids (same ordering as the old generate_centroids).
+        '''
+        centroids = np.empty((len(self), 2))
+        centroids[:, 0] = (self._boxes[:, 1] + self._boxes[:, 3]) / 2
+        centroids[:, 1] = (self._boxes[:, 0] + self._boxes[:, 2]) / 2
+        return centroids
+
+    def aspect_ratios(self):
+        '''
+        Height / width of every box, as floats.
+        '''
+        return self.heights / self.widths
+
+    def elongated(self, threshold):
+        '''
+        Boolean mask of boxes whose aspect ratio exceeds threshold (either way) - vectorised check_aspect_ratio.
+        '''
+        ratios = self.aspect_ratios()
+        return (ratios > threshold) | (ratios < (1 / threshold))
+
+    def scaled(self, scale):
+        '''
+        N x 4 float array with all coordinates multiplied by scale (e.g. to go back to full-resolution pixels).
+        '''
+        return self._boxes * float(scale)
+
+    def tolist(self):
+        return [tuple(box) for box in self._boxes.tolist()]
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return tuple(self._boxes[key].tolist())
+        return RegionSet(self._boxes[key])
+
+    def __array__(self, dtype=None, copy=None):
+        # np.asarray(regions) gets the read-only view, so it can't change the boxes behind the RegionSet's back;
+        # ask for a copy (np.array(regions)) to get a writable array
+        if copy:
+            return self._boxes.astype(dtype if dtype is not None else self._boxes.dtype)
+        if dtype is not None and np.dtype(dtype) != self._boxes.dtype:
+            if copy is False:
+                raise ValueError('RegionSet boxes are int32, converting to {} needs a copy'.format(np.dtype(dtype)))
+            return self._boxes.astype(dtype)
+        return self.boxes
+
+    def __eq__(self, other):
+        if isinstance(other, (RegionSet, list, tuple, np.ndarray)):
+            try:
+                other = RegionSet.from_regions(other)
+            except ValueError:
+                return False
+            return np.array_equal(self._boxes, other._boxes)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'RegionSet({})'.format(self.tolist())
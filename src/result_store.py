@@ -0,0 +1,88 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+try:
+    from .region_set import RegionSet
+except ImportError:
+    from region_set import RegionSet
+
+
+def thumbnail_checksum(image):
+    '''
+    SHA-1 of the decoded thumbnail pixels (and its shape/dtype, so a resized thumbnail never collides).
+    '''
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha1('{}{}'.format(image.shape, image.dtype.str).encode())
+    digest.update(image.data)
+    return digest.hexdigest()
+
+
+class ResultStore(object):
+    '''
+    Local SQLite record of the last detection run on every image: the thumbnail checksum, the detection parameters
+    and the ROIs that were saved. Lets reruns skip images where neither the thumbnail nor the parameters changed.
+
+    The key columns are (image_id, checksum, method_thresh, closing, size_thresh, scale_factor); any other
+    create_rois keyword arguments (e.g. order_strategy) are compared too, as JSON. Safe to share between threads.
+
+            Parameters:
+                    path (str): SQLite database file (created if missing)
+    '''
+    KEY_PARAMS = ('method_thresh', 'closing', 'size_thresh', 'scale_factor')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS results (
+                    image_id INTEGER PRIMARY KEY,
+                    checksum TEXT NOT NULL,
+                    method_thresh TEXT NOT NULL,
+                    closing INTEGER NOT NULL,
+                    size_thresh REAL NOT NULL,
+                    scale_factor REAL NOT NULL,
+                    extra TEXT NOT NULL,
+                    regions BLOB NOT NULL,
+                    updated REAL NOT NULL
+                )''')
+
+    def _key(self, params):
+        key = tuple(params[k] for k in self.KEY_PARAMS)
+        extra = json.dumps({k: v for k, v in params.items() if k not in self.KEY_PARAMS}, sort_keys=True)
+        return key + (extra,)
+
+    def lookup(self, image_id, checksum, params):
+        '''
+        The RegionSet saved for this image if it was computed from the same thumbnail with the same parameters,
+        None otherwise.
+        '''
+        with self._lock:
+            row = self._db.execute(
+                'SELECT checksum, method_thresh, closing, size_thresh, scale_factor, extra, regions '
+                'FROM results WHERE image_id = ?', (image_id,)).fetchone()
+        if row is None or row[0] != checksum or tuple(row[1:6]) != self._key(params):
+            return None
+        return RegionSet(np.frombuffer(row[6], dtype=np.int32).reshape(-1, 4))
+
+    def record(self, image_id, checksum, params, regions):
+        '''
+        Remember the result of a (successfully saved) run on an image, replacing any previous one.
+        '''
+        regions = RegionSet.from_regions(regions)
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (image_id, checksum) + self._key(params) + (regions.boxes.tobytes(), time.time()))
+
+    def forget(self, image_id):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM results WHERE image_id = ?', (image_id,))
+
+    def close(self):
+        self._db.close()
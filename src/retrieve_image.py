@@ -1,30 +1,338 @@
-def retrieve_image(session, base_url, img_id, scale):
-    from PIL import Image
-    from io import BytesIO
-    import numpy as np
+try:
+    from .metrics import instrumented, add_bytes
+except ImportError:
+    from metrics import instrumented, add_bytes
+
+
+class ResponseError(Exception):
+    '''
+    Non-200 response from OMERO.web. status_code (and retry_after, the Retry-After header in seconds if the server
+    sent one) let a ClientPolicy tell whether it's worth trying again.
+    '''
+
+    def __init__(self, response):
+        super(ResponseError, self).__init__("Received response {} with content: {}".format(response.status_code, response.content))
+        self.status_code = response.status_code
+        retry_after = response.headers.get('Retry-After', '')
+        self.retry_after = float(retry_after) if retry_after.isdigit() else None
+
+
+@instrumented('retrieve')
+def retrieve_image(session, base_url, img_id, scale, grayscale=False, reduce=1, cache=None, policy=None, stamp=None):
+    '''
+    Retrieves the birds-eye view jpeg of an image, scaled down by scale, as a numpy array: 2d + RGB by default, or
+    2d uint8 grayscale decoded straight from the jpeg with grayscale=True (see fetch_jpeg). With a ThumbnailCache
+    and the image's update stamp (see update_stamps), a thumbnail that was downloaded before (same width, image not
+    updated since) is read from disk instead; without a stamp the cache is left alone, since there'd be no telling
+    a stale entry. With a ClientPolicy, transient failures are retried and the calls count towards its concurrency
+    limit.
+    '''
+    if policy is not None:
+        return policy.call(_retrieve_image, session, base_url, img_id, scale, grayscale, reduce, cache, stamp)
+    return _retrieve_image(session, base_url, img_id, scale, grayscale, reduce, cache, stamp)
+
+
+def _retrieve_image(session, base_url, img_id, scale, grayscale, reduce, cache, stamp):
     # just some magical code to get the correct address from the json api session and image id
     r = session.get(base_url)
+    if r.status_code != 200:
+        raise ResponseError(r)
     host = base_url.split("/api")[0]
     # which lists a bunch of urls as starting points
     urls = r.json()
     images_url = urls['url:images']
     single_image_url = images_url+str(img_id)+"/"
-    thisjson = session.get(single_image_url).json()
+    r = session.get(single_image_url)
+    if r.status_code != 200:
+        raise ResponseError(r)
+    thisjson = r.json()
 
     # calculate width to be requested based on metadata and the specified scale factor
-    width = int(thisjson['data']['Pixels']['SizeX'])
-    scaled = round(width/scale)
-    img_address = host+"/webgateway/render_birds_eye_view/"+str(img_id)+"/"+str(scaled)+"/"
-    jpeg = session.get(img_address, stream=True)
+    width = round(int(thisjson['data']['Pixels']['SizeX'])/scale)
+    if cache is not None and stamp is not None:
+        return cache.get_or_fetch(img_id, width, stamp,
+                                  lambda: fetch_birds_eye_view(session, host, img_id, width, grayscale, reduce),
+                                  grayscale, reduce)
+    return fetch_birds_eye_view(session, host, img_id, width, grayscale, reduce)
+
+
+def update_stamps(conn, image_ids, chunk_size=1000):
+    '''
+    {image_id: stamp} for many images, with one Blitz query (HQL projection) per chunk_size images: the latest of
+    the image's update event and its rendering settings' update events (times in ms), so the stamp changes whenever
+    the rendered thumbnail can. The JSON API doesn't include update events in the image objects, so this is the
+    only source of stamps for the ThumbnailCache.
+    '''
+    from omero.rtypes import unwrap
+    from omero.sys import ParametersI
+
+    query = ('select i.id, e.time, max(re.time) from Image i join i.details.updateEvent e join i.pixels p '
+             'left outer join p.settings r left outer join r.details.updateEvent re '
+             'where i.id in (:ids) group by i.id, e.time')
+    image_ids = list(image_ids)
+    stamps = {}
+    for start in range(0, len(image_ids), chunk_size):
+        params = ParametersI()
+        params.addIds(image_ids[start:start + chunk_size])
+        for row in unwrap(conn.getQueryService().projection(query, params, {'omero.group': '-1'})):
+            stamps[row[0]] = max(row[1], row[2] or 0)
+    return stamps
+
+
+def fetch_birds_eye_view(session, host, img_id, width, grayscale=False, reduce=1):
+    '''
+    Downloads the render_birds_eye_view jpeg of an image at the given width and returns it as a numpy array.
+    '''
+    img_address = host+"/webgateway/render_birds_eye_view/"+str(img_id)+"/"+str(width)+"/"
+    return fetch_jpeg(session, img_address, grayscale=grayscale, reduce=reduce)
+
+
+class _BodyReader(object):
+    '''
+    Read-only file over a streamed response body, for PIL. PIL needs to seek back to the start twice: after sniffing
+    the format, and when the decoder starts (a jpeg is decoded from its first byte). So everything read while
+    recording - the headers, read by Image.open - is kept and replayed, and after stop_recording() the rest goes from
+    the connection to the decoder a block at a time, without the body ever being held in memory as a whole (PIL
+    reads the whole of a stream it can't seek into memory first).
+    '''
+
+    def __init__(self, raw):
+        self.raw = raw
+        # the bytes kept for replaying, from offset start on
+        self.head = b''
+        self.start = 0
+        self.pos = 0
+        self.recording = True
+
+    def stop_recording(self):
+        self.recording = False
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        if whence == 2 or not self.start <= pos <= self.start + len(self.head):
+            import io
+            raise io.UnsupportedOperation('can only seek within what was read while recording')
+        self.pos = pos
+        return pos
+
+    def read(self, size=-1):
+        offset = self.pos - self.start
+        data = self.head[offset:offset + size] if size >= 0 else self.head[offset:]
+        self.pos += len(data)
+        if not self.recording and self.pos == self.start + len(self.head):
+            # replayed, not needed again
+            self.head = b''
+            self.start = self.pos
+        if size < 0 or len(data) < size:
+            more = self.raw.read(size - len(data) if size >= 0 else None)
+            if self.recording:
+                self.head += more
+            self.pos += len(more)
+            data += more
+        return data
+
+
+def fetch_jpeg(session, img_address, params=None, grayscale=False, reduce=1):
+    '''
+    GETs a rendered jpeg and returns it as a numpy array.
+
+    The response body is decoded as it comes in (see _BodyReader), so the compressed jpeg is never held in memory
+    as a whole on top of the decoded image. With grayscale=True, the jpeg decoder's draft mode decodes the luma
+    channel only, giving a 2d uint8 array without ever building the RGB image; reduce=2, 4 or 8 also makes the
+    decoder skip detail, returning an image that many times smaller (about - jpeg scaling works in whole DCT blocks)
+    at a fraction of the decoding cost.
+    '''
+    from PIL import Image
+    import numpy as np
+
+    jpeg = session.get(img_address, params=params, stream=True)
 
     if jpeg.status_code != 200:
-        raise Exception("Received response {} with content: {}".format(jpeg.status_code, jpeg.content))
+        raise ResponseError(jpeg)
+
+    jpeg.raw.decode_content = True
+    try:
+        body = _BodyReader(jpeg.raw)
+        i = Image.open(body)
+        if grayscale or reduce > 1:
+            i.draft('L' if grayscale else 'RGB', (i.size[0] // reduce, i.size[1] // reduce))
+        body.stop_recording()
+        if grayscale and i.mode != 'L':
+            # draft mode only applies to jpegs, anything else still gets converted
+            i = i.convert('L')
+        return np.asarray(i)
+    finally:
+        # bytes actually read off the wire, compressed
+        add_bytes(jpeg.raw.tell())
+        jpeg.close()
+
+
+class ImageClient(object):
+    '''
+    Keeps what retrieve_image keeps rediscovering: the API URLs (fetched once, on first use) and the image sizes
+    (fetched in bulk for a whole dataset or project with prefetch_dataset/prefetch_project, or for a list of image
+    IDs with prefetch_images over Blitz). Once an image's size is known, retrieve() costs exactly one request, the
+    thumbnail download; an image whose size isn't known yet costs one more, for its metadata.
+
+    With pool_size, the client mounts a keep-alive connection pool sized for pool_size concurrent requests on the
+    session (replacing its adapters for http:// and https://), so threads sharing the client reuse connections
+    instead of opening new ones. Without it the session is left as it is - requests' default pool keeps 10.
+
+            Parameters:
+                    session, base_url: outputs from create_json_session
+                    pool_size (int): maximum number of kept-alive connections to the server (None: don't touch the
+                    session's connection pool)
+                    page_size (int): number of objects requested per list call
+                    cache (ThumbnailCache): if given, retrieve() reads thumbnails it has already downloaded from disk
+                    (for images whose stamps were looked up with prefetch_stamps, or passed to retrieve)
+                    policy (ClientPolicy): if given, every request goes through it (retries, adaptive concurrency limit)
+    '''
+
+    def __init__(self, session, base_url, pool_size=None, page_size=500, cache=None, policy=None):
+        from requests.adapters import HTTPAdapter
+        import threading
+
+        self.session = session
+        self.base_url = base_url
+        self.host = base_url.split("/api")[0]
+        self.page_size = page_size
+        self.cache = cache
+        self.policy = policy
+        if pool_size is not None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self._urls = None
+        self._sizes = {}
+        self._stamps = {}
+        self._lock = threading.Lock()
+
+    @property
+    def urls(self):
+        with self._lock:
+            if self._urls is None:
+                self._urls = self._call(self._get_json, self.base_url)
+            return self._urls
+
+    def _call(self, fn, *args, **kwargs):
+        if self.policy is None:
+            return fn(*args, **kwargs)
+        return self.policy.call(fn, *args, **kwargs)
+
+    def _get_json(self, url, params=None):
+        r = self.session.get(url, params=params)
+        if r.status_code != 200:
+            raise ResponseError(r)
+        return r.json()
+
+    def _remember(self, images):
+        ids = []
+        for img in images:
+            pixels = img['Pixels']
+            self._sizes[img['@id']] = (int(pixels['SizeX']), int(pixels['SizeY']))
+            ids.append(img['@id'])
+        return ids
+
+    def prefetch_dataset(self, dataset_id):
+        '''
+        Lists all images of a dataset with paged calls, keeping their sizes in memory. Returns the image IDs.
+        '''
+        images = _paged(self.session, self.urls['url:images'], {'dataset': dataset_id}, self.page_size, self._call)
+        return self._remember(images)
+
+    def prefetch_project(self, project_id):
+        '''
+        Same as prefetch_dataset, for every dataset in a project. Returns the image IDs (without duplicates).
+        '''
+        datasets = _paged(self.session, self.urls['url:datasets'], {'project': project_id}, self.page_size, self._call)
+        image_ids = []
+        seen = set()
+        for d in list(datasets):
+            for img_id in self.prefetch_dataset(d['@id']):
+                if img_id not in seen:
+                    seen.add(img_id)
+                    image_ids.append(img_id)
+        return image_ids
+
+    def prefetch_images(self, conn, image_ids):
+        '''
+        Looks up the sizes of a list of images in bulk, with one Blitz query per thousand images (see image_sizes) -
+        the JSON API can only list whole datasets. Returns the image IDs.
+        '''
+        image_ids = list(image_ids)
+        self._sizes.update(self._call(image_sizes, conn, image_ids))
+        if self.cache is not None:
+            self.prefetch_stamps(conn, image_ids)
+        return image_ids
+
+    def prefetch_stamps(self, conn, image_ids):
+        '''
+        Looks up the update stamps of a list of images over Blitz (see update_stamps), for the thumbnail cache.
+        Images without a stamp bypass the cache.
+        '''
+        self._stamps.update(self._call(update_stamps, conn, list(image_ids)))
+
+    def image_size(self, img_id):
+        '''
+        (SizeX, SizeY) of an image, from the prefetched metadata or with a single JSON call otherwise.
+        '''
+        if img_id not in self._sizes:
+            self._remember([self._call(self._get_json, self.urls['url:images']+str(img_id)+"/")['data']])
+        return self._sizes[img_id]
 
-    # using PIL and BytesIO to open the request content as an image
-    i = Image.open(BytesIO(jpeg.content))
-    jpeg.close()
-    return np.array(i)
-    
+    def zoom_levels(self, img_id):
+        '''
+        {level: scale} of the image's pyramid, from webgateway's imgData: level 0 is the full resolution (levels are
+        numbered as for render_tile) and scale is the level's width over the full width. Pyramids don't all halve the
+        size from one level to the next. An image without a pyramid only has {0: 1.0}.
+        '''
+        data = self._call(self._get_json, self.host+"/webgateway/imgData/"+str(img_id)+"/")
+        if not data.get('tiles') or not data.get('zoomLevelScaling'):
+            return {0: 1.0}
+        return {int(level): float(scale) for level, scale in data['zoomLevelScaling'].items()}
+
+    def forget(self, img_id):
+        '''
+        Drops the metadata kept for an image, so the next call looks it up again (e.g. because it was updated).
+        '''
+        self._sizes.pop(img_id, None)
+        self._stamps.pop(img_id, None)
+
+    @instrumented('retrieve')
+    def retrieve(self, img_id, scale, grayscale=False, reduce=1, stamp=None):
+        '''
+        Same as retrieve_image: the birds-eye view jpeg scaled down by scale, as a numpy array. With a cache, the
+        image's update stamp is the one given, or the one looked up with prefetch_stamps; without either, the cache
+        is bypassed.
+        '''
+        width = round(self.image_size(img_id)[0]/scale)
+        if stamp is None:
+            stamp = self._stamps.get(img_id)
+        if self.cache is not None and stamp is not None:
+            return self.cache.get_or_fetch(
+                img_id, width, stamp,
+                lambda: self._call(fetch_birds_eye_view, self.session, self.host, img_id, width, grayscale, reduce),
+                grayscale, reduce)
+        return self._call(fetch_birds_eye_view, self.session, self.host, img_id, width, grayscale, reduce)
+
+    @instrumented('retrieve')
+    def render_tile(self, img_id, level, col, row, width, height, z=0, t=0, grayscale=False):
+        '''
+        One tile of the image pyramid (render_image_region with tile=level,col,row,width,height) as a numpy array.
+        level is a key of zoom_levels(img_id), 0 being the full-resolution image - look its scale up there, as
+        pyramids don't all halve the size from one level to the next. col and row count tiles of width x height
+        pixels at that level. Tiles on the right/bottom edges come back cropped to the image.
+        '''
+        img_address = self.host+"/webgateway/render_image_region/"+str(img_id)+"/"+str(z)+"/"+str(t)+"/"
+        tile = "{},{},{},{},{}".format(level, col, row, width, height)
+        return self._call(fetch_jpeg, self.session, img_address, {'tile': tile}, grayscale=grayscale)
 
 
 def get_image(conn, image_id):
@@ -35,4 +343,69 @@ def get_image(conn, image_id):
         image = conn.getObject("Image", image_id)
         return image
     else:
-        return None
\ No newline at end of file
+        return None
+
+def image_sizes(conn, image_ids, chunk_size=1000):
+    '''
+    {image_id: (SizeX, SizeY)} of many images, with one Blitz query (HQL projection) per chunk_size images. Images
+    that don't exist (or can't be seen) are left out.
+    '''
+    from omero.rtypes import unwrap
+    from omero.sys import ParametersI
+
+    query = 'select i.id, p.sizeX, p.sizeY from Image i join i.pixels p where i.id in (:ids)'
+    image_ids = list(image_ids)
+    sizes = {}
+    for start in range(0, len(image_ids), chunk_size):
+        params = ParametersI()
+        params.addIds(image_ids[start:start + chunk_size])
+        # all the groups the user can see
+        for row in unwrap(conn.getQueryService().projection(query, params, {'omero.group': '-1'})):
+            sizes[row[0]] = (int(row[1]), int(row[2]))
+    return sizes
+
+
+def list_images(session, base_url, dataset_id=None, project_id=None, page_size=500):
+    '''
+    Lists the IDs of all images in a dataset or in a project (all of its datasets) using the JSON API, one page at a time.
+
+            Parameters:
+                    session, base_url: outputs from create_json_session
+                    dataset_id (int): dataset to list, or
+                    project_id (int): project to list
+                    page_size (int): number of objects requested per call
+
+            Returns:
+                    image_ids (list): image IDs in the order OMERO lists them, without duplicates
+    '''
+    client = ImageClient(session, base_url, page_size=page_size)
+    if dataset_id is not None:
+        return client.prefetch_dataset(dataset_id)
+    elif project_id is not None:
+        return client.prefetch_project(project_id)
+    else:
+        raise ValueError("Need either a dataset_id or a project_id")
+
+
+def _paged(session, url, params, page_size, call=None):
+    '''
+    Generator over all objects of a JSON API list call, following offset/limit paging until totalCount is reached.
+    Every page is fetched through call (e.g. a ClientPolicy's) if given.
+    '''
+    def get_page(query):
+        r = session.get(url, params=query)
+        if r.status_code != 200:
+            raise ResponseError(r)
+        return r.json()
+
+    offset = 0
+    while True:
+        query = dict(params, offset=offset, limit=page_size)
+        page = call(get_page, query) if call is not None else get_page(query)
+        data = page['data']
+        for obj in data:
+            yield obj
+        offset += len(data)
+        total = page.get('meta', {}).get('totalCount')
+        if not data or (total is not None and offset >= total):
+            return
@@ -1,51 +1,124 @@
 from omero.rtypes import rdouble, rint, rstring
 
-def save_rois(image, regions, scale, replace):
+try:
+    from .region_set import RegionSet
+    from .metrics import instrumented
+except ImportError:
+    from region_set import RegionSet
+    from metrics import instrumented
+
+@instrumented('save')
+def save_rois(image, regions, scale, replace, chunk_size=500, return_objects=True):
     '''
     Main entry point - given a (BlitzGateway-based) omero image, regions and a scaling factor (that should be the same used for ROI creation),
     saves the regions as ROIs in OMERO
 
     Parameters:
                     image (OMERO image): return of a BlitzGateway.getObject() call, where ROIs will be saved to
-                    regions (list): list of tuples of the form (y1,x1,y2,x2) representing the ROIs to be saved
+                    regions (RegionSet or list): boxes of the form (y1,x1,y2,x2) representing the ROIs to be saved
                     scale (int? I guess it could be float...): scaling factor that will be applied to the regions (should be the same as the
                     one used when creating the ROIs)
                     replace(bool): whether to delete ALL existing ROIs from the image before saving the newly created ones or not. Use when rerunning 
                     the code on the same image.
+                    chunk_size (int): maximum number of ROIs sent in a single save call
+                    return_objects (bool): if False, use the fire-and-forget saveArray call, which doesn't send the saved objects back
     
+            Returns:
+                    rois (list): the saved ROI objects (None if return_objects is False or there was nothing to save)
                                     
     '''
 
 
     if replace:
         remove_all_rois(image)
+    regions = RegionSet.from_regions(regions)
     if regions and image:
         conn = image._conn
-        counter = 1
-        for region in regions:
-            bbox = region
-            
-            shape = create_rectangle(bbox, counter, scale)
+        rois = []
+        # scale everything up to the full-size image in one go
+        for counter, bbox in enumerate(regions.scaled(scale), 1):
+            shape = create_rectangle(bbox, counter, 1)
             if shape is not None:
-                roi = create_roi(conn, image, [shape])
-            counter = counter + 1
+                rois.append(build_roi(image, [shape]))
+        return save_roi_batch(conn, image, rois, chunk_size, return_objects)
             
     else:
         return None
 
 
+@instrumented('save')
+def sync_rois(image, regions, scale, chunk_size=500, delete=True):
+    '''
+    Incremental alternative to save_rois(..., replace=True): compares the ROIs already on the image with the ones that
+    would be saved and only touches the difference. ROIs that match a new one exactly (same rectangle, same "ROI n"
+    label) are left alone, everything else on the image is deleted with a single deleteObjects call and only the
+    missing ROIs are saved. With delete=False nothing is deleted - only the missing ROIs are added, so ROIs drawn by
+    hand (or left by an earlier run) stay, and running it twice adds nothing the second time.
+
+    Parameters:
+                    image (OMERO image): return of a BlitzGateway.getObject() call
+                    regions (RegionSet or list): boxes of the form (y1,x1,y2,x2) representing the ROIs that should end up on the image
+                    scale (num): scaling factor that will be applied to the regions
+                    chunk_size (int): maximum number of ROIs sent in a single save call
+                    delete (bool): whether to delete the ROIs that aren't one of the new ones
+
+            Returns:
+                    (added, deleted) (tuple): number of ROIs saved and deleted
+    '''
+    conn = image._conn
+    regions = RegionSet.from_regions(regions)
+    wanted = {}
+    for counter, bbox in enumerate(regions.scaled(scale), 1):
+        shape = create_rectangle(bbox, counter, 1)
+        wanted[rectangle_key(shape)] = shape
+
+    # anything on the image that isn't exactly one of the wanted rectangles goes
+    stale = []
+    roi_service = conn.getRoiService()
+    for roi in roi_service.findByImage(image.getId(), None).rois:
+        shapes = roi.copyShapes()
+        key = rectangle_key(shapes[0]) if len(shapes) == 1 else None
+        if key in wanted:
+            del wanted[key]
+        elif delete:
+            stale.append(roi.getId().getValue())
+    if stale:
+        conn.deleteObjects("Roi", stale, wait=True)
+
+    rois = [build_roi(image, [shape]) for shape in wanted.values()]
+    save_roi_batch(conn, image, rois, chunk_size, return_objects=False)
+    return len(rois), len(stale)
+
+
+def rectangle_key(shape):
+    '''
+    Hashable (x, y, width, height, label) summary of a rectangle shape, None for any other kind of shape.
+    '''
+    from omero.model import RectangleI
+    if not isinstance(shape, RectangleI):
+        return None
+    text = shape.getTextValue()
+    values = [shape.getX(), shape.getY(), shape.getWidth(), shape.getHeight()]
+    return tuple(round(v.getValue(), 3) for v in values) + (text.getValue() if text is not None else None,)
+
+
 def remove_all_rois(image):
+    '''
+    Delete every ROI on the image, with a single deleteObjects call covering all of them.
+    '''
     conn = image._conn
     roi_service = conn.getRoiService()
     result = roi_service.findByImage(image.getId(), None)
-    for roi in result.rois:
-        conn.deleteObjects("Roi", [roi.getId().getValue()])
+    roi_ids = [roi.getId().getValue() for roi in result.rois]
+    if roi_ids:
+        # wait for the delete to finish so that it can't race with the ROIs saved right after it
+        conn.deleteObjects("Roi", roi_ids, wait=True)
     return
 
 
 def create_rectangle(data, order, scale):
     '''
-    Generate shape from bounding box data and scaling factor.
+    Generate shape from bounding box data (a (y1,x1,y2,x2) tuple or a row of RegionSet.scaled()) and scaling factor.
                                     
     '''
     from omero.model import RectangleI
@@ -54,10 +127,10 @@ def create_rectangle(data, order, scale):
     t_index = 0
 
     # scale up to full-size image
-    y1 = data[0] * scale
-    x1 = data[1] * scale
-    h = (data[2] - data[0]) * scale
-    w = (data[3] - data[1]) * scale
+    y1 = float(data[0] * scale)
+    x1 = float(data[1] * scale)
+    h = float((data[2] - data[0]) * scale)
+    w = float((data[3] - data[1]) * scale)
     shape = RectangleI()
     
     shape.x = rdouble(x1)
@@ -79,17 +152,49 @@ def create_roi(conn, img, shapes):
     Generic function to save ROI(s) to OMERO using updateService    
                                     
     '''
-    from omero.model import RoiI
     updateService = conn.getUpdateService()
+    roi = build_roi(img, shapes)
+    return updateService.saveAndReturnObject(roi, group_context(img))
+
+
+def build_roi(img, shapes):
+    '''
+    Unsaved RoiI on the image, holding the given shapes.
+    '''
+    from omero.model import RoiI
     roi = RoiI()
-    
     roi.setImage(img._obj)
-    # I could be calling this function just once by creating a list of shapes beforehand, but whatever
     for shape in shapes:
         roi.addShape(shape)
-    # setting group is always necessary here - using same group as the image's 
+    return roi
+
+
+def group_context(img):
+    '''
+    Call context for saving things next to the image - setting group is always necessary here, using same group as the image's.
+    '''
     group_id = img.getDetails().getGroup().getId()
-    ctx = {'omero.group': str(group_id)}
-    return updateService.saveAndReturnObject(roi, ctx)
+    return {'omero.group': str(group_id)}
+
+
+def save_roi_batch(conn, img, rois, chunk_size=500, return_objects=True):
+    '''
+    Save many ROIs with one updateService call per chunk of chunk_size ROIs (instead of one call per ROI).
+    saveAndReturnArray gives the saved objects back; with return_objects=False the lighter saveArray is used instead
+    and nothing is returned.
+    '''
+    if not rois:
+        return [] if return_objects else None
+    updateService = conn.getUpdateService()
+    # group lookup once for the whole batch
+    ctx = group_context(img)
+    saved = []
+    for start in range(0, len(rois), chunk_size):
+        chunk = rois[start:start + chunk_size]
+        if return_objects:
+            saved.extend(updateService.saveAndReturnArray(chunk, ctx))
+        else:
+            updateService.saveArray(chunk, ctx)
+    return saved if return_objects else None
 
 
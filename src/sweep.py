@@ -0,0 +1,135 @@
+import itertools
+
+import numpy as np
+
+try:
+    from .create_rois import diamond_closing, inverted_gray, threshold_value, prune_regions, order_regions
+    from .region_set import RegionSet
+except ImportError:
+    from create_rois import diamond_closing, inverted_gray, threshold_value, prune_regions, order_regions
+    from region_set import RegionSet
+
+
+def sweep_parameters(image, methods, closings, size_threshs, scale_factor, order_strategy='rows'):
+    '''
+    Runs create_rois for every combination of methods x closings x size_threshs on the same image, computing every
+    intermediate only once along the way:
+        - one grayscale conversion and one histogram, shared by all the thresholding methods;
+        - one thresholded mask per distinct threshold value (two methods landing on the same value share it);
+        - one closing and one labelling per (threshold, closing radius) pair;
+        - the size filter is then just a mask over the per-label pixel counts and bounding boxes, so every size
+          threshold reuses the same labelling.
+    Gives exactly the regions create_rois would give for each combination.
+
+            Parameters:
+                    image (np.array): same as create_rois
+                    methods (list): thresholding methods ('otsu', 'triangle', 'yen', 'li')
+                    closings (list): closing radii
+                    size_threshs (list): minimum sizes, in full-resolution pixels
+                    scale_factor (int): scaling that was used to generate the downsampled image
+                    order_strategy (str): see order_regions
+
+            Returns:
+                    rows (list): one dict per combination, with keys method_thresh, closing, size_thresh, threshold,
+                    n_regions and regions (RegionSet) - see format_table
+    '''
+    from skimage.measure import label
+    from scipy.ndimage import find_objects
+
+    im = inverted_gray(image)
+    thresholds = histogram_thresholds(im, methods)
+
+    labelled = {}
+    rows = []
+    for method, closing in itertools.product(methods, closings):
+        threshold = thresholds[method]
+        key = (threshold, closing)
+        if key not in labelled:
+            im_lab = label(diamond_closing(im > threshold, closing))
+            counts = np.bincount(im_lab.ravel())[1:]
+            boxes = np.array([(s[0].start, s[1].start, s[0].stop, s[1].stop) for s in find_objects(im_lab)],
+                             dtype=np.int64).reshape(-1, 4)
+            labelled[key] = (counts, boxes)
+        counts, boxes = labelled[key]
+
+        for size_thresh in size_threshs:
+            # same rule as filter_small_regions, boxes stay in label order like regionprops
+            regions = RegionSet(boxes[counts >= size_thresh / (scale_factor ** 2)])
+            regions = order_regions(prune_regions(regions), order_strategy)
+            rows.append({'method_thresh': method, 'closing': closing, 'size_thresh': size_thresh,
+                         'threshold': float(threshold), 'n_regions': len(regions), 'regions': regions})
+    return rows
+
+
+def histogram_thresholds(im, methods):
+    '''
+    Threshold for each method, from a single histogram of the image. Otsu, Yen and triangle are computed from that
+    histogram; Li is iterative on the pixel values rather than histogram based, so it still looks at the image.
+    Values are the same as threshold_value(im, method).
+    '''
+    from skimage.exposure import histogram
+    from skimage.filters import threshold_otsu, threshold_yen
+
+    hist = histogram(im.reshape(-1), 256, source_range='image')
+    if np.count_nonzero(hist[0]) <= 1:
+        # constant image, the thresholding functions have their own special cases for that
+        return {method: threshold_value(im, method) for method in methods}
+
+    thresholds = {}
+    for method in methods:
+        if method in ('otsu', 'yen'):
+            try:
+                thresholds[method] = {'otsu': threshold_otsu, 'yen': threshold_yen}[method](hist=hist)
+            except TypeError:
+                # scikit-image < 0.19 can't take a histogram
+                thresholds[method] = threshold_value(im, method)
+        elif method == 'triangle':
+            thresholds[method] = _triangle_from_histogram(*hist)
+        else:
+            thresholds[method] = threshold_value(im, method)
+    return thresholds
+
+
+def _triangle_from_histogram(hist, bin_centers):
+    '''
+    skimage's threshold_triangle, taking the histogram instead of the image.
+    '''
+    nbins = len(hist)
+
+    # find peak, lowest and highest gray levels
+    arg_peak_height = np.argmax(hist)
+    peak_height = hist[arg_peak_height]
+    arg_low_level, arg_high_level = np.flatnonzero(hist)[[0, -1]]
+
+    # flip is True if left tail is shorter
+    flip = arg_peak_height - arg_low_level < arg_high_level - arg_peak_height
+    if flip:
+        hist = hist[::-1]
+        arg_low_level = nbins - arg_high_level - 1
+        arg_peak_height = nbins - arg_peak_height - 1
+
+    # set up the coordinate system, normalize and maximize the length
+    width = arg_peak_height - arg_low_level
+    x1 = np.arange(width)
+    y1 = hist[x1 + arg_low_level]
+    norm = np.sqrt(peak_height ** 2 + width ** 2)
+    peak_height = peak_height / norm
+    width = width / norm
+    length = peak_height * x1 - width * y1
+    arg_level = np.argmax(length) + arg_low_level
+
+    if flip:
+        arg_level = nbins - arg_level - 1
+    return bin_centers[arg_level]
+
+
+def format_table(rows):
+    '''
+    Plain-text table of sweep_parameters results, one line per combination.
+    '''
+    header = ('method', 'closing', 'size_thresh', 'threshold', 'n_regions')
+    lines = ['{:>10} {:>8} {:>12} {:>10} {:>10}'.format(*header)]
+    for row in rows:
+        lines.append('{:>10} {:>8} {:>12} {:>10.4f} {:>10}'.format(
+            row['method_thresh'], row['closing'], row['size_thresh'], row['threshold'], row['n_regions']))
+    return '\n'.join(lines)
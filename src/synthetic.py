@@ -0,0 +1,74 @@
+'''
+Fake slide scans for the tests, the benchmarks (benchmarks/bench_stages.py) and the local OMERO stand-in
+(omero_standin.py). Nothing in the detection pipeline uses it; it only lives next to omero_standin because the
+stand-in renders its images with it.
+'''
+import numpy as np
+
+
+def synthetic_slide(shape=(600, 800), sections=6, grid=None, overlap=0.0, specks=200, seed=0, rgb=True):
+    '''
+    Deterministic fake slide-scan thumbnail: dark, slightly textured elliptical "sections" on a light background,
+    sprinkled with dark specks of dust. Same arguments always give the same image.
+
+            Parameters:
+                    shape (tuple): (height, width) of the image
+                    sections (int): number of sections (ignored if grid is given)
+                    grid (tuple): (rows, cols) to lay the sections out on a regular grid, TMA style, with a bit of jitter;
+                    without it, sections are scattered at random
+                    overlap (float): on a grid, how much neighbouring sections overlap, as a fraction of the cell size
+                    (0 leaves a gap between them, 0.2 makes every section spill 20% into the next cell)
+                    specks (int): number of 1-2 pixel specks
+                    seed (int): random seed
+                    rgb (bool): 2d + RGB uint8 image if True, 2d uint8 grayscale otherwise
+
+            Returns:
+                    image (np.array): the slide
+                    boxes (list): ground truth (y1,x1,y2,x2) box of every section, in reading order for grids
+    '''
+    rng = np.random.RandomState(seed)
+    height, width = shape
+    image = np.full(shape, 235, dtype=np.int16)
+
+    if grid is not None:
+        rows, cols = grid
+        cell_h, cell_w = height / rows, width / cols
+        centres = [((r + 0.5) * cell_h, (c + 0.5) * cell_w) for r in range(rows) for c in range(cols)]
+        # without overlap, sections fill 70% of their cell
+        half_h, half_w = (0.35 + overlap) * cell_h, (0.35 + overlap) * cell_w
+        jitter = 0.05 * min(cell_h, cell_w)
+        sizes = [(half_h, half_w)] * len(centres)
+        centres = [(y + rng.uniform(-jitter, jitter), x + rng.uniform(-jitter, jitter)) for y, x in centres]
+    else:
+        sizes = []
+        centres = []
+        for _ in range(sections):
+            half_h = rng.uniform(0.04, 0.12) * height
+            half_w = rng.uniform(0.04, 0.12) * width
+            sizes.append((half_h, half_w))
+            centres.append((rng.uniform(half_h, height - half_h), rng.uniform(half_w, width - half_w)))
+
+    yy, xx = np.ogrid[:height, :width]
+    boxes = []
+    for (cy, cx), (half_h, half_w) in zip(centres, sizes):
+        y1, y2 = max(int(cy - half_h), 0), min(int(np.ceil(cy + half_h)) + 1, height)
+        x1, x2 = max(int(cx - half_w), 0), min(int(np.ceil(cx + half_w)) + 1, width)
+        inside = ((yy[y1:y2] - cy) / half_h) ** 2 + ((xx[:, x1:x2] - cx) / half_w) ** 2 <= 1
+        if not inside.any():
+            continue
+        tissue = rng.randint(60, 120) + rng.randint(-15, 16, size=inside.shape)
+        image[y1:y2, x1:x2][inside] = tissue[inside]
+        ys, xs = np.nonzero(inside)
+        boxes.append((y1 + int(ys.min()), x1 + int(xs.min()), y1 + int(ys.max()) + 1, x1 + int(xs.max()) + 1))
+
+    ys = rng.randint(0, height - 1, size=specks)
+    xs = rng.randint(0, width - 1, size=specks)
+    big = rng.rand(specks) < 0.3
+    image[ys, xs] = 40
+    image[ys[big] + 1, xs[big]] = 40
+
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    if rgb:
+        # a faint pink tint, like H&E on glass
+        image = np.stack([image, np.clip(image.astype(np.int16) - 12, 0, 255).astype(np.uint8), image], axis=-1)
+    return image, boxes
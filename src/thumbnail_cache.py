@@ -0,0 +1,175 @@
+import os
+import re
+import threading
+
+import numpy as np
+
+
+class ThumbnailCache(object):
+    '''
+    On-disk cache of decoded thumbnails, so reruns with different detection parameters don't download anything.
+
+    Entries are keyed by (image ID, requested width, image update stamp), plus the decoding options (grayscale,
+    reduce), and stored as .npy files that are read back memory-mapped - no copy, and the OS page cache is shared by
+    every process reading the same thumbnail. An image whose update stamp changed simply misses, and its stale
+    entries are dropped when the new one is written.
+
+    The total size is kept under max_bytes by evicting the least recently used files (every hit refreshes the file's
+    modification time, which serves as the LRU clock). The directory is only scanned once up front and whenever the
+    running total goes over max_bytes, and eviction then goes down to evict_to of the budget, so filling the cache
+    with n thumbnails costs O(n) rather than a scan per thumbnail. Several processes can share one cache directory:
+    files are written to a temporary name and renamed into place, and readers treat a file that vanished under them
+    as a miss. Each process only counts its own writes between scans, so a shared cache can go over budget by what
+    the others wrote since.
+
+            Parameters:
+                    path (str): cache directory (created if missing)
+                    max_bytes (int): byte budget for all the cached thumbnails
+                    evict_to (float): fraction of max_bytes eviction goes down to
+    '''
+
+    def __init__(self, path, max_bytes=2 * 2 ** 30, evict_to=0.9):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evict_to = evict_to
+        self.hits = 0
+        self.misses = 0
+        self.scans = 0
+        self._lock = threading.Lock()
+        # running total of the cached bytes, and {key prefix: {path: size}} to find an image's stale entries,
+        # both from the last scan plus our own writes since
+        self._total = None
+        self._index = {}
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def _prefix(img_id, width, grayscale, reduce):
+        return '{}_{}_{}_{}_'.format(int(img_id), int(width), 'gray' if grayscale else 'rgb', int(reduce))
+
+    def key_path(self, img_id, width, stamp=None, grayscale=False, reduce=1):
+        # the stamp ends up in a file name, keep it to safe characters
+        stamp = re.sub(r'[^0-9A-Za-z.-]', '-', str(stamp))
+        return os.path.join(self.path, self._prefix(img_id, width, grayscale, reduce) + stamp + '.npy')
+
+    def get(self, img_id, width, stamp=None, grayscale=False, reduce=1):
+        '''
+        The cached thumbnail as a read-only memory-mapped array, or None.
+        '''
+        image = self._load(self.key_path(img_id, width, stamp, grayscale, reduce))
+        with self._lock:
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return image
+
+    @staticmethod
+    def _load(path):
+        try:
+            image = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except (OSError, ValueError):
+            # missing, evicted in the meantime by another process or (very unlikely) truncated
+            return None
+        return image
+
+    def put(self, img_id, width, stamp, image, grayscale=False, reduce=1):
+        '''
+        Stores a thumbnail (replacing entries of the same image, width and decoding options with another stamp),
+        evicts old entries if the cache got too big, and returns the stored copy, memory-mapped.
+        '''
+        path = self.key_path(img_id, width, stamp, grayscale, reduce)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(image))
+        os.replace(tmp, path)
+
+        size = os.path.getsize(path)
+        with self._lock:
+            if self._total is None:
+                self._scan()
+            entries = self._index.setdefault(self._prefix(img_id, width, grayscale, reduce), {})
+            for other in [p for p in entries if p != path]:
+                self._remove(other)
+                self._total -= entries.pop(other)
+            self._total += size - entries.get(path, 0)
+            entries[path] = size
+            full = self._total > self.max_bytes
+        if full:
+            self.evict()
+        stored = self._load(path)
+        return stored if stored is not None else image
+
+    def get_or_fetch(self, img_id, width, stamp, fetch, grayscale=False, reduce=1):
+        '''
+        The cached thumbnail if there is one, otherwise fetch() (e.g. the download), stored for next time.
+        '''
+        image = self.get(img_id, width, stamp, grayscale, reduce)
+        if image is None:
+            image = self.put(img_id, width, stamp, fetch(), grayscale, reduce)
+        return image
+
+    def entries(self):
+        '''
+        (modification time, size, path) of every cached file, least recently used first.
+        '''
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npy'):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return sorted(entries)
+
+    def _scan(self):
+        # with self._lock held
+        entries = self.entries()
+        self.scans += 1
+        self._index = {}
+        for mtime, size, path in entries:
+            # the stamp is the last part of the name, and can't contain '_'
+            prefix = os.path.basename(path).rsplit('_', 1)[0] + '_'
+            self._index.setdefault(prefix, {})[path] = size
+        self._total = sum(e[1] for e in entries)
+        return entries
+
+    def size(self):
+        return sum(e[1] for e in self.entries())
+
+    def evict(self):
+        '''
+        If the cache is over max_bytes, deletes least recently used files until it's down to evict_to of it. Returns
+        the number of files deleted.
+        '''
+        with self._lock:
+            entries = self._scan()
+            deleted = 0
+            if self._total <= self.max_bytes:
+                return deleted
+            for mtime, size, path in entries:
+                if self._total <= self.evict_to * self.max_bytes:
+                    break
+                if self._remove(path):
+                    deleted += 1
+                self._total -= size
+                prefix = os.path.basename(path).rsplit('_', 1)[0] + '_'
+                self._index.get(prefix, {}).pop(path, None)
+            return deleted
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            # already gone (another process evicted it), or still mapped somewhere on Windows
+            return False
+        return True
+
+    def clear(self):
+        with self._lock:
+            for mtime, size, path in self.entries():
+                self._remove(path)
+            self._total = None
+            self._index = {}
@@ -0,0 +1,221 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    from .create_rois import (create_rois, diamond_closing, inverted_gray, threshold_value, prune_regions,
+                              order_regions, _connected_components)
+    from .refine import TileReader
+    from .region_set import RegionSet
+except ImportError:
+    from create_rois import (create_rois, diamond_closing, inverted_gray, threshold_value, prune_regions,
+                             order_regions, _connected_components)
+    from refine import TileReader
+    from region_set import RegionSet
+
+
+def create_rois_tiled(client, img_id, size_thresh, method_thresh, closing, scale_factor,
+                      tile_size=1024, workers=4, threshold_scale=None, order_strategy='rows', grayscale=True):
+    '''
+    Tiled version of retrieve_image + create_rois, for detecting at scale factors where the whole downsampled image
+    would be too big to download and process in one go. The threshold is computed once on a small birds-eye view,
+    then the image is streamed tile by tile (render_image_region) at the detection scale, see detect_tiled.
+
+    Tiles come from the level of the image's pyramid that is the image scaled down by scale_factor (see
+    ImageClient.zoom_levels). If there is no such level - the pyramid doesn't halve the size at every level, or the
+    image has no pyramid - this falls back to create_rois on the whole birds-eye view.
+
+            Parameters:
+                    client (ImageClient): client for the JSON API / webgateway
+                    img_id (int): OMERO image ID
+                    size_thresh, method_thresh, closing: same as create_rois
+                    scale_factor (int): downsampling of the tiles
+                    tile_size (int): tile width and height, in downsampled pixels
+                    workers (int): tiles fetched and processed in parallel
+                    threshold_scale (int): scale of the birds-eye view used for the global threshold
+                    (defaults to 8 times scale_factor, but at least 64)
+                    order_strategy (str): see order_regions
+                    grayscale (bool): decode the jpegs straight to uint8 grayscale (see fetch_jpeg)
+
+            Returns:
+                    regions (RegionSet): same as create_rois, in the coordinates of the scale_factor-downsampled image
+    '''
+    size_x, size_y = client.image_size(img_id)
+    levels = client.zoom_levels(img_id)
+    level = pyramid_level(levels, size_x, scale_factor)
+    if level is None:
+        return create_rois(client.retrieve(img_id, scale_factor, grayscale), size_thresh, method_thresh, closing,
+                           scale_factor, order_strategy)
+    if threshold_scale is None:
+        threshold_scale = max(8 * scale_factor, 64)
+
+    # global threshold from a cheap overview, so every tile is cut at the same grey level
+    threshold = threshold_value(inverted_gray(client.retrieve(img_id, threshold_scale, grayscale)), method_thresh)
+
+    shape = (int(round(size_y * levels[level])), int(round(size_x * levels[level])))
+
+    def fetch_tile(row, col):
+        return client.render_tile(img_id, level, col, row, tile_size, tile_size, grayscale=grayscale)
+
+    return detect_tiled(fetch_tile, shape, tile_size, threshold, size_thresh, closing, scale_factor,
+                        workers=workers, order_strategy=order_strategy)
+
+
+def pyramid_level(levels, size_x, scale_factor):
+    '''
+    The pyramid level that is the image scaled down by scale_factor (to within a pixel), or None if there is none.
+
+            Parameters:
+                    levels (dict): {level: scale}, see ImageClient.zoom_levels
+                    size_x (int): full-resolution width
+                    scale_factor (num): downsampling wanted
+
+            Returns:
+                    level (int): the level, or None
+    '''
+    for level, scale in sorted(levels.items()):
+        if abs(size_x * scale - size_x / scale_factor) <= 1:
+            return level
+    return None
+
+
+def detect_tiled(fetch_tile, shape, tile_size, threshold, size_thresh, closing, scale_factor,
+                 workers=4, order_strategy='rows'):
+    '''
+    Streaming detection over a grid of tiles. Every tile is thresholded with the same (global) threshold, closed and
+    labelled on its own; only the per-component areas and bounding boxes plus the labels along the tile edges are
+    kept. Components touching across tile seams are joined with a union-find (8-connectivity, like label()), and the
+    result goes through the usual size filter, prune_regions and order_regions.
+
+    Closing is a dilation then an erosion, so whether a pixel ends up closed depends on everything up to 2 * closing
+    pixels away. Every tile is therefore read with a halo of that many pixels of its neighbours (none past the edges
+    of the image), closed, and cropped back, which gives exactly the closing of the whole image - gaps that straddle
+    a tile seam are bridged too.
+
+    Tiles are processed one row of the grid at a time (the tiles of a row in parallel). The tiles of the rows the
+    halos reach into are kept (see TileReader), so every tile is fetched once, and peak memory is a few rows of tiles
+    plus one image-wide strip of edge labels, whatever the size of the image.
+
+            Parameters:
+                    fetch_tile (callable): fetch_tile(row, col) -> RGB or grayscale array of tile (row, col); edge tiles may be smaller
+                    shape (tuple): (height, width) of the whole image at the detection scale
+                    tile_size (int): nominal tile width and height
+                    threshold (float): global threshold, applied to inverted_gray(tile)
+                    size_thresh, closing, scale_factor, order_strategy: same as create_rois
+
+            Returns:
+                    regions (RegionSet): pruned, ordered boxes in whole-image coordinates
+    '''
+    n_rows = -(-shape[0] // tile_size)
+    n_cols = -(-shape[1] // tile_size)
+    halo = 2 * closing
+    # rows of tiles a halo reaches into, above and below; one more row is kept so the oldest one is always
+    # the one to go
+    reach = -(-halo // tile_size)
+    reader = TileReader(fetch_tile, tile_size, shape, cache_tiles=(2 * reach + 2) * n_cols)
+
+    areas = []
+    boxes = []
+    edges = []
+    n_labels = 0
+    previous_bottom = None
+
+    with ThreadPoolExecutor(workers) as pool:
+        for row in range(n_rows):
+            # fetch the tiles the row needs in parallel first - the rows above are still there - so that no two
+            # threads fetch the same one
+            needed = [(r, col) for r in range(row, min(row + reach, n_rows - 1) + 1) for col in range(n_cols)]
+            list(pool.map(lambda rc: reader.tile(*rc), needed))
+
+            def work(col):
+                y1, x1 = row * tile_size, col * tile_size
+                y2, x2 = min(y1 + tile_size, shape[0]), min(x1 + tile_size, shape[1])
+                wy1, wx1 = max(y1 - halo, 0), max(x1 - halo, 0)
+                window = reader.read(wy1, wx1, min(y2 + halo, shape[0]), min(x2 + halo, shape[1]))
+                core = (slice(y1 - wy1, y2 - wy1), slice(x1 - wx1, x2 - wx1))
+                return _tile_components(window, core, (y1, x1), threshold, closing)
+            tiles = list(pool.map(work, range(n_cols)))
+
+            # give every tile's labels a global ID
+            top = np.full(shape[1], -1, dtype=np.int64)
+            bottom = np.full(shape[1], -1, dtype=np.int64)
+            right_of_previous = None
+            for col, (tile_areas, tile_boxes, strips) in enumerate(tiles):
+                offset = n_labels
+                n_labels += len(tile_areas)
+                areas.append(tile_areas)
+                boxes.append(tile_boxes)
+                globalised = [np.where(s > 0, s + offset - 1, -1) for s in strips]
+                t, b, l, r = globalised
+                x0 = col * tile_size
+                top[x0:x0 + len(t)] = t
+                bottom[x0:x0 + len(b)] = b
+                if right_of_previous is not None:
+                    edges.append(_seam_pairs(right_of_previous, l))
+                right_of_previous = r
+            if previous_bottom is not None:
+                edges.append(_seam_pairs(previous_bottom, top))
+            previous_bottom = bottom
+
+    if n_labels == 0:
+        return RegionSet()
+    areas = np.concatenate(areas)
+    boxes = np.concatenate(boxes)
+    edges = np.concatenate(edges, axis=1) if edges else np.empty((2, 0), dtype=np.int64)
+
+    # stitch components across seams
+    roots = _connected_components(n_labels, edges[0], edges[1])
+    components, component = np.unique(roots, return_inverse=True)
+    total = np.zeros(len(components), dtype=np.int64)
+    np.add.at(total, component, areas)
+    merged = np.empty((len(components), 4), dtype=np.int64)
+    merged[:, :2] = np.iinfo(np.int64).max
+    merged[:, 2:] = np.iinfo(np.int64).min
+    np.minimum.at(merged[:, 0], component, boxes[:, 0])
+    np.minimum.at(merged[:, 1], component, boxes[:, 1])
+    np.maximum.at(merged[:, 2], component, boxes[:, 2])
+    np.maximum.at(merged[:, 3], component, boxes[:, 3])
+
+    # get rid of ROIs smaller than required size threshold
+    regions = RegionSet(merged[total >= size_thresh / (scale_factor ** 2)])
+    regions = prune_regions(regions)
+    return order_regions(regions, order_strategy)
+
+
+def _tile_components(window, core, origin, threshold, closing):
+    '''
+    Threshold and close a tile with its halo (window), then label the tile itself (the core slices of the window).
+    Returns (areas, boxes, strips): the pixel count and the global-coordinate (y1,x1,y2,x2) box of each label, and
+    the label values along the top, bottom, left and right edges of the tile.
+    '''
+    from skimage.measure import label
+    from scipy.ndimage import find_objects
+
+    im_thresh = inverted_gray(window) > threshold
+    im_thresh = diamond_closing(im_thresh, closing)[core]
+    im_lab = label(im_thresh)
+    n = im_lab.max()
+
+    areas = np.bincount(im_lab.ravel(), minlength=n + 1)[1:]
+    boxes = np.empty((n, 4), dtype=np.int64)
+    for i, sl in enumerate(find_objects(im_lab)):
+        boxes[i] = (sl[0].start + origin[0], sl[1].start + origin[1], sl[0].stop + origin[0], sl[1].stop + origin[1])
+    strips = (im_lab[0].copy(), im_lab[-1].copy(), im_lab[:, 0].copy(), im_lab[:, -1].copy())
+    return areas, boxes, strips
+
+
+def _seam_pairs(before, after):
+    '''
+    Global label pairs that touch across a seam, given the edge strips on both sides (-1 for background).
+    Neighbours one pixel along the seam count too, to match label()'s 8-connectivity.
+    '''
+    n = min(len(before), len(after))
+    before = before[:n]
+    after = after[:n]
+    pairs = []
+    for shift in (-1, 0, 1):
+        a = before[max(0, -shift):n - max(0, shift)]
+        b = after[max(0, shift):n - max(0, -shift)]
+        touching = (a >= 0) & (b >= 0)
+        pairs.append(np.stack([a[touching], b[touching]]))
+    return np.concatenate(pairs, axis=1)
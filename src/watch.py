@@ -0,0 +1,341 @@
+import json
+import os
+import time
+
+try:
+    from .batch import run_batch
+except ImportError:
+    from batch import run_batch
+
+
+class WatchState(object):
+    '''
+    What a watcher remembers between polls (and restarts), in a small JSON file: the high-water mark - the sort key
+    of the last image handed to the pipeline, [image_id] or [update time, image_id] - and the images that failed,
+    with the number of attempts so far. Written to a temporary file, synced and renamed, so a crash leaves either
+    the old state or the new one.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.mark = None
+        self.failed = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.mark = state.get('mark')
+            self.failed = {int(k): v for k, v in state.get('failed', {}).items()}
+
+    def save(self):
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'mark': self.mark, 'failed': {str(k): v for k, v in self.failed.items()}}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+def new_images(conn, mark, limit, by='id'):
+    '''
+    One page of the images past a high-water mark, oldest first, with a Blitz query (HQL) - keyset paging, so the
+    cost of a page depends on the page size only, never on how many images the server holds.
+
+            Parameters:
+                    conn (BlitzGateway): connection
+                    mark (list): sort key of the last image already seen ([id] or [update time, id]), None for all
+                    limit (int): page size
+                    by (str): 'id' for newly created images only, 'time' for created or updated ones (by the time
+                    of the image's update event, in ms)
+
+            Returns:
+                    images (list): (image_id, sort key) pairs, in key order
+    '''
+    from omero.rtypes import rtime, unwrap
+    from omero.sys import ParametersI
+
+    params = ParametersI()
+    params.page(0, limit)
+    if by == 'id':
+        query = 'select i.id from Image i'
+        if mark is not None:
+            query += ' where i.id > :id'
+            params.addLong('id', mark[0])
+        query += ' order by i.id'
+    else:
+        query = 'select i.id, e.time from Image i join i.details.updateEvent e'
+        if mark is not None:
+            query += ' where e.time > :time or (e.time = :time and i.id > :id)'
+            params.add('time', rtime(mark[0]))
+            params.addLong('id', mark[1])
+        query += ' order by e.time, i.id'
+    # all the groups the user can see
+    rows = unwrap(conn.getQueryService().projection(query, params, {'omero.group': '-1'}))
+    if by == 'id':
+        return [(row[0], [row[0]]) for row in rows]
+    return [(row[0], [row[1], row[0]]) for row in rows]
+
+
+def latest_mark(conn, by='id'):
+    '''
+    The high-water mark that makes a watcher skip every image already on the server (None if there are none).
+    '''
+    from omero.sys import ParametersI
+    from omero.rtypes import unwrap
+
+    params = ParametersI()
+    params.page(0, 1)
+    if by == 'id':
+        query = 'select i.id from Image i order by i.id desc'
+    else:
+        query = 'select i.id, e.time from Image i join i.details.updateEvent e order by e.time desc, i.id desc'
+    rows = unwrap(conn.getQueryService().projection(query, params, {'omero.group': '-1'}))
+    if not rows:
+        return None
+    return [rows[0][0]] if by == 'id' else [rows[0][1], rows[0][0]]
+
+
+class Watcher(object):
+    '''
+    Processes images as they show up in OMERO: every poll asks for the images past the high-water mark, page by
+    page, runs them through run_batch (retrieve -> detect -> save) and moves the mark past every page it processed,
+    saving the state after each one. A steady-state poll costs one query plus the work on the new images, whatever
+    the size of the repository.
+
+    Images that fail don't hold the mark back; they are remembered and tried again at the next polls, up to
+    max_attempts times in all.
+
+            Parameters:
+                    state (WatchState): high-water mark and failed images, kept between polls and runs
+                    list_new (callable): list_new(mark, limit) -> [(image_id, sort key), ...] past the mark, in key
+                    order (e.g. new_images with a connection)
+                    fetch_image, save_regions (callable): as for run_batch
+                    detection_params (dict): keyword arguments for create_rois
+                    page_size (int): images asked for (and processed) at a time
+                    max_attempts (int): tries per image before it's given up on
+                    prepare (callable): called at the start of every poll, e.g. to check the sessions are still alive
+                    batch_options: other run_batch keyword arguments (fetch_workers, detect_workers, ...)
+    '''
+
+    def __init__(self, state, list_new, fetch_image, save_regions, detection_params, page_size=100, max_attempts=3,
+                 prepare=None, **batch_options):
+        self.state = state
+        self.list_new = list_new
+        self.fetch_image = fetch_image
+        self.save_regions = save_regions
+        self.detection_params = detection_params
+        self.page_size = page_size
+        self.max_attempts = max_attempts
+        self.prepare = prepare
+        self.batch_options = batch_options
+        self.given_up = []
+
+    def process(self, image_ids):
+        results = run_batch(image_ids, self.fetch_image, self.save_regions, self.detection_params, **self.batch_options)
+        for r in results:
+            if r.status == 'failed':
+                attempts = self.state.failed.get(r.image_id, 0) + 1
+                if attempts >= self.max_attempts:
+                    self.state.failed.pop(r.image_id, None)
+                    self.given_up.append(r.image_id)
+                else:
+                    self.state.failed[r.image_id] = attempts
+            else:
+                self.state.failed.pop(r.image_id, None)
+        return results
+
+    def poll(self):
+        '''
+        Processes the images that failed before and everything new since the last poll. Returns the ImageResults.
+        '''
+        if self.prepare is not None:
+            self.prepare()
+        results = []
+        if self.state.failed:
+            results += self.process(sorted(self.state.failed))
+            self.state.save()
+        while True:
+            page = self.list_new(self.state.mark, self.page_size)
+            if not page:
+                break
+            results += self.process([image_id for image_id, key in page])
+            self.state.mark = page[-1][1]
+            self.state.save()
+            if len(page) < self.page_size:
+                break
+        return results
+
+    def run(self, interval=60, max_polls=None, report=None):
+        '''
+        Polls every interval seconds (measured from the start of a poll), max_polls times or forever; report(results)
+        is called after every poll that found something.
+        '''
+        polls = 0
+        while max_polls is None or polls < max_polls:
+            tic = time.time()
+            results = self.poll()
+            if results and report is not None:
+                report(results)
+            polls += 1
+            if max_polls is None or polls < max_polls:
+                time.sleep(max(0, interval - (time.time() - tic)))
+
+
+if __name__ == "__main__":
+    import argparse
+    import queue
+    import sys
+    import threading
+
+    from batch import summarize
+    from client_policy import policy_from_args
+    from create_session import create_json_session, create_blitz_session
+    from retrieve_image import ImageClient, get_image
+    from save_rois import save_rois, sync_rois
+    from thumbnail_cache import ThumbnailCache
+
+    parser = argparse.ArgumentParser(description='Watch OMERO for new images and detect ROIs on them')
+    parser.add_argument('state', help='state file (high-water mark and failed images), created if missing')
+    parser.add_argument('--by', choices=('id', 'time'), default='id',
+                        help="'id': new images only; 'time': new or updated images (ROIs are synced, not added)")
+    parser.add_argument('--from-start', action='store_true',
+                        help='on the first run, process every image already on the server instead of skipping them')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between polls')
+    parser.add_argument('--once', action='store_true', help='poll once and exit')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--scale-factor', type=int, default=64)
+    parser.add_argument('--size-thresh', type=float, default=200)
+    parser.add_argument('--method', default='triangle')
+    parser.add_argument('--closing', type=int, default=5)
+    parser.add_argument('--grayscale', action='store_true')
+    parser.add_argument('--fetch-workers', type=int, default=4)
+    parser.add_argument('--detect-workers', type=int, default=None)
+    parser.add_argument('--upload-workers', type=int, default=2)
+    parser.add_argument('--thumbnail-cache', metavar='DIR', help='keep downloaded thumbnails in this directory')
+    parser.add_argument('--cache-mb', type=int, default=2048, help='size limit of the thumbnail cache')
+    parser.add_argument('--session-file', metavar='FILE',
+                        help='keep the JSON API session in this file (mode 0600) and reuse it while it is valid')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='retry OMERO calls that fail with a transient error up to this many times, with backoff')
+    parser.add_argument('--adaptive-limit', type=int, default=0, metavar='MAX',
+                        help='adapt the number of concurrent OMERO calls to the server latency and errors, up to MAX')
+    args = parser.parse_args(sys.argv[1:])
+
+    WEB_HOSTNAME = os.environ['OMERO_WEB_HOSTNAME']
+    HOSTNAME = os.environ['OMERO_HOSTNAME']
+    USERNAME = os.environ['OMERO_ADMIN_USER']
+    PASSWORD = os.environ['OMERO_ADMIN_PASSWORD']
+
+    policy = policy_from_args(args.retries, args.adaptive_limit)
+    call = policy.call if policy is not None else (lambda fn, *a, **kw: fn(*a, **kw))
+    cache = ThumbnailCache(args.thumbnail_cache, args.cache_mb * 2 ** 20) if args.thumbnail_cache else None
+
+    # the query connection lives as long as the watcher, and so do the upload connections: run_batch starts new
+    # upload threads every poll, so instead of one per thread (a leaked session per thread per poll) they are
+    # borrowed from a pool of idle connections - never more of them than --upload-workers
+    conn = call(create_blitz_session, HOSTNAME, USERNAME, PASSWORD)
+    conns = [conn]
+    conns_lock = threading.Lock()
+    idle = queue.LifoQueue()
+    client = None
+
+    def alive(c):
+        try:
+            return c.keepAlive()
+        except Exception:
+            return False
+
+    def discard(c):
+        with conns_lock:
+            conns.remove(c)
+        try:
+            c.close()
+        except Exception:
+            pass
+
+    state = WatchState(args.state)
+    if state.mark is None and not args.from_start and not os.path.exists(args.state):
+        state.mark = call(latest_mark, conn, args.by)
+        state.save()
+
+    def prepare():
+        global conn, client
+        if not alive(conn):
+            discard(conn)
+            conn = call(create_blitz_session, HOSTNAME, USERNAME, PASSWORD)
+            conns.append(conn)
+        # the upload threads of the last poll are gone, so every upload connection is idle: drop the dead ones,
+        # save_regions reconnects when it needs them
+        pooled = []
+        while not idle.empty():
+            pooled.append(idle.get_nowait())
+        for c in pooled:
+            if alive(c):
+                idle.put(c)
+            else:
+                discard(c)
+        # the JSON session may have expired since the last poll; with --session-file checking it is one request
+        login_rsp, session, base_url = call(create_json_session, WEB_HOSTNAME, USERNAME, PASSWORD, verify=False,
+                                            session_file=args.session_file)
+        if client is not None and client.session is not session:
+            # the last poll's fetches are over; don't leave its connection pool open
+            client.session.close()
+        client = ImageClient(session, base_url, pool_size=args.fetch_workers, cache=cache, policy=policy)
+
+    def list_new(mark, limit):
+        page = call(new_images, conn, mark, limit, args.by)
+        if cache is not None:
+            client.prefetch_stamps(conn, [image_id for image_id, key in page])
+        return page
+
+    def fetch_image(image_id):
+        return client.retrieve(image_id, args.scale_factor, args.grayscale)
+
+    def save_regions(image_id, regions):
+        try:
+            upload = idle.get_nowait()
+        except queue.Empty:
+            upload = call(create_blitz_session, HOSTNAME, USERNAME, PASSWORD)
+            with conns_lock:
+                conns.append(upload)
+        try:
+            image = call(get_image, upload, image_id)
+            if args.by == 'time':
+                # an updated image may already have ROIs from an earlier poll
+                call(sync_rois, image, regions, args.scale_factor)
+            elif policy is not None:
+                # saving without replacing twice would duplicate the ROIs
+                policy.call_once(save_rois, image, regions, args.scale_factor, False)
+            else:
+                save_rois(image, regions, args.scale_factor, False)
+        except Exception:
+            # don't hand a dead connection to the next image
+            if alive(upload):
+                idle.put(upload)
+            else:
+                discard(upload)
+            raise
+        idle.put(upload)
+
+    params = {'size_thresh': args.size_thresh, 'method_thresh': args.method,
+              'closing': args.closing, 'scale_factor': args.scale_factor}
+    watcher = Watcher(state, list_new, fetch_image, save_regions, params, page_size=args.page_size,
+                      max_attempts=args.max_attempts, prepare=prepare, fetch_workers=args.fetch_workers,
+                      detect_workers=args.detect_workers, upload_workers=args.upload_workers)
+
+    def report(results):
+        print(time.strftime('%Y-%m-%d %H:%M:%S'), summarize(results), flush=True)
+        if watcher.given_up:
+            print('  given up on images', ', '.join(str(i) for i in watcher.given_up), flush=True)
+            del watcher.given_up[:]
+
+    try:
+        watcher.run(args.interval, 1 if args.once else None, report)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for c in conns:
+            try:
+                c.close()
+            except Exception:
+                pass
@@ -0,0 +1,487 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+try:
+    from .client_policy import is_session_expired
+    from .create_rois import create_rois
+    from .retrieve_image import ImageClient, get_image
+except ImportError:
+    from client_policy import is_session_expired
+    from create_rois import create_rois
+    from retrieve_image import ImageClient, get_image
+
+
+class Job(object):
+    '''
+    One unit of work for the Worker: an image ID plus the detection/saving parameters that differ from the worker's
+    defaults. key is whatever the queue uses to find the job again.
+    '''
+    __slots__ = ('key', 'image_id', 'params')
+
+    def __init__(self, key, image_id, params=None):
+        self.key = key
+        self.image_id = image_id
+        self.params = params or {}
+
+    def __repr__(self):
+        return 'Job({!r}, {!r}, {!r})'.format(self.key, self.image_id, self.params)
+
+
+class DirectoryQueue(object):
+    '''
+    Job queue in a directory tree - one JSON file per job, e.g. dropped in by an import script:
+        incoming/  waiting jobs, {"image_id": 123, "params": {...}}; taken oldest first
+        running/   claimed by a worker (the claim is an atomic rename, so any number of workers can share the queue),
+                   as <claim time>@<name>
+        done/      finished, with the result added
+        failed/    failed, with the error added
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        for sub in ('incoming', 'running', 'done', 'failed'):
+            os.makedirs(os.path.join(path, sub), exist_ok=True)
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def submit(self, image_id, params=None):
+        with self._lock:
+            self._counter += 1
+            name = '{:.6f}-{}-{}-{}.json'.format(time.time(), os.getpid(), self._counter, image_id)
+        tmp = os.path.join(self.path, name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'image_id': image_id, 'params': params or {}}, f)
+        # the rename makes the job visible in one go, never half-written
+        os.replace(tmp, os.path.join(self.path, 'incoming', name))
+        return name
+
+    def claim(self):
+        '''
+        Takes the oldest waiting job, or returns None if there is none.
+        '''
+        incoming = os.path.join(self.path, 'incoming')
+        for name in sorted(os.listdir(incoming)):
+            # the claim time goes in the name, so it's set by the rename itself (recover goes by it)
+            key = '{:.6f}@{}'.format(time.time(), name)
+            try:
+                os.rename(os.path.join(incoming, name), os.path.join(self.path, 'running', key))
+            except OSError:
+                # another worker got there first
+                continue
+            try:
+                with open(os.path.join(self.path, 'running', key)) as f:
+                    job = json.load(f)
+            except OSError:
+                # put back by recover in the meantime
+                continue
+            return Job(key, job['image_id'], job.get('params'))
+        return None
+
+    def recover(self, lease, max_attempts=3):
+        '''
+        Puts the jobs claimed more than lease seconds ago back in incoming/: their worker died (or was killed) before
+        finishing them. A job lost max_attempts times goes to failed/ instead, as it's likely what kills the workers.
+        Returns the number of jobs put back and failed.
+        '''
+        running = os.path.join(self.path, 'running')
+        requeued = failed = 0
+        for key in os.listdir(running):
+            claimed, _, name = key.rpartition('@')
+            try:
+                claimed = float(claimed) if claimed else os.path.getmtime(os.path.join(running, key))
+            except (OSError, ValueError):
+                continue
+            if time.time() - claimed < lease:
+                continue
+            # moving it out of running/ first makes sure only one worker recovers it
+            tmp = os.path.join(self.path, '{}.{}.recover'.format(key, os.getpid()))
+            try:
+                os.rename(os.path.join(running, key), tmp)
+            except OSError:
+                continue
+            with open(tmp) as f:
+                job = json.load(f)
+            job['lost'] = job.get('lost', 0) + 1
+            if job['lost'] >= max_attempts:
+                job['error'] = 'worker lost the job {} times'.format(job['lost'])
+            with open(tmp, 'w') as f:
+                json.dump(job, f)
+            if 'error' in job:
+                os.replace(tmp, os.path.join(self.path, 'failed', name))
+                failed += 1
+            else:
+                os.replace(tmp, os.path.join(self.path, 'incoming', name))
+                requeued += 1
+        return requeued, failed
+
+    def _finish(self, job, where, **extra):
+        running = os.path.join(self.path, 'running', job.key)
+        with open(running, 'w') as f:
+            json.dump(dict({'image_id': job.image_id, 'params': job.params}, **extra), f)
+        os.replace(running, os.path.join(self.path, where, job.key.rpartition('@')[2]))
+
+    def complete(self, job, result):
+        self._finish(job, 'done', result=result)
+
+    def fail(self, job, error):
+        self._finish(job, 'failed', error=error)
+
+
+class SQLiteQueue(object):
+    '''
+    Job queue in a SQLite table, shared by any number of workers on the same machine (claims happen inside an
+    immediate transaction, so a job goes to exactly one worker). Statuses: queued, running, done, failed; updated is
+    the claim time of a running job.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                image_id INTEGER NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                worker TEXT,
+                result TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                lost INTEGER NOT NULL DEFAULT 0
+            )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)')
+
+    def submit(self, image_id, params=None):
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute('INSERT INTO jobs (image_id, params, created, updated) VALUES (?, ?, ?, ?)',
+                                      (image_id, json.dumps(params or {}), now, now))
+        return cursor.lastrowid
+
+    def claim(self, worker=None):
+        '''
+        Takes the oldest queued job, or returns None if there is none.
+        '''
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._db.execute(
+                    "SELECT id, image_id, params FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE jobs SET status = 'running', worker = ?, updated = ? WHERE id = ?",
+                                     (worker, time.time(), row[0]))
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return None if row is None else Job(row[0], row[1], json.loads(row[2]))
+
+    def recover(self, lease, max_attempts=3):
+        '''
+        Puts the jobs claimed more than lease seconds ago back in the queue: their worker died (or was killed) before
+        finishing them. A job lost max_attempts times is failed instead, as it's likely what kills the workers.
+        Returns the number of jobs put back and failed.
+        '''
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                failed = self._db.execute(
+                    "UPDATE jobs SET status = 'failed', lost = lost + 1, updated = ?, "
+                    "error = 'worker lost the job ' || (lost + 1) || ' times' "
+                    "WHERE status = 'running' AND updated < ? AND lost + 1 >= ?",
+                    (now, now - lease, max_attempts)).rowcount
+                requeued = self._db.execute(
+                    "UPDATE jobs SET status = 'queued', worker = NULL, lost = lost + 1, updated = ? "
+                    "WHERE status = 'running' AND updated < ?", (now, now - lease)).rowcount
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return requeued, failed
+
+    def complete(self, job, result):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = 'done', result = ?, updated = ? WHERE id = ?",
+                             (json.dumps(result), time.time(), job.key))
+
+    def fail(self, job, error):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                             (error, time.time(), job.key))
+
+    def counts(self):
+        with self._lock:
+            return dict(self._db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def close(self):
+        self._db.close()
+
+
+class Worker(object):
+    '''
+    Long-running worker: imports everything and logs in once, then takes jobs off a queue and runs
+    retrieve -> detect -> save on each, so a new slide only costs the work itself (no interpreter start-up, no
+    scikit-image/omero imports, no login handshakes).
+
+    Sessions are reconnected when they go stale: the Blitz connection is kept alive while idle, and a step of a job
+    that fails because its session expired (see client_policy.is_session_expired) is retried once on fresh JSON and
+    Blitz sessions. Saving without replace is the exception: a save that failed halfway may have added some of the
+    ROIs already, so it's never run twice and the job is failed instead. Any other error fails the job right away.
+
+    Jobs a crashed worker left running are put back in the queue once their lease has expired (see recover; a job
+    must never take longer than the lease, or it's run twice).
+
+            Parameters:
+                    queue (DirectoryQueue or SQLiteQueue): where jobs come from
+                    connect_json (callable): connect_json() -> (session, base_url), e.g. wrapping create_json_session
+                    connect_blitz (callable): connect_blitz() -> BlitzGateway connection, e.g. wrapping create_blitz_session
+                    defaults (dict): parameters for jobs that don't set them - create_rois' size_thresh, method_thresh,
+                    closing and scale_factor (plus optionally order_strategy), and grayscale and replace (see save_rois)
+                    poll (num): seconds to wait before looking at an empty queue again
+                    keepalive (num): seconds between Blitz keep-alive pings while idle
+                    cache (ThumbnailCache): if given, thumbnails are read from / kept in it
+                    policy (ClientPolicy): if given, JSON and Blitz calls go through it (retries, adaptive concurrency)
+                    lease (num): seconds after which a claimed job that isn't finished counts as lost
+    '''
+    DETECTION_PARAMS = ('size_thresh', 'method_thresh', 'closing', 'scale_factor', 'order_strategy')
+
+    def __init__(self, queue, connect_json, connect_blitz, defaults, poll=1.0, keepalive=60, cache=None, policy=None,
+                 lease=3600):
+        self.queue = queue
+        self.connect_json = connect_json
+        self.connect_blitz = connect_blitz
+        self.defaults = dict(defaults)
+        self.poll = poll
+        self.keepalive = keepalive
+        self.cache = cache
+        self.policy = policy
+        self.lease = lease
+        self.name = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.client = None
+        self.conn = None
+        self.logins = 0
+        self._last_ping = time.time()
+        self._last_recover = 0
+
+    def warm_up(self):
+        '''
+        Pays the one-off costs up front: the heavy imports (scikit-image loads most of its modules lazily, so the
+        simplest way to get everything loaded is to run detection once on a tiny fake slide) and both logins.
+        '''
+        import numpy as np
+        from PIL import Image, JpegImagePlugin  # noqa: F401
+        try:
+            import omero.gateway  # noqa: F401
+            import omero.model  # noqa: F401
+        except ImportError:
+            pass
+        image = np.full((40, 40, 3), 230, dtype=np.uint8)
+        image[10:30, 10:30] = 60
+        for method in ('otsu', 'triangle', 'yen', 'li'):
+            create_rois(image, 1, method, 1, 1)
+        self.connect()
+
+    def connect(self):
+        self.close()
+        session, base_url = self.connect_json()
+        self.client = ImageClient(session, base_url, cache=self.cache, policy=self.policy)
+        self.conn = self.connect_blitz()
+        self.logins += 1
+        self._last_ping = time.time()
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.client = self.conn = None
+
+    def ping(self):
+        '''
+        Keeps the Blitz session from expiring while the queue is empty; reconnects if it already has.
+        '''
+        if time.time() - self._last_ping < self.keepalive:
+            return
+        self._last_ping = time.time()
+        try:
+            alive = self.conn.keepAlive()
+        except Exception:
+            alive = False
+        if not alive:
+            self.connect()
+
+    def detect(self, job):
+        '''
+        retrieve -> detect for one job; returns the regions and the job's parameters.
+        '''
+        params = dict(self.defaults, **job.params)
+        if self.cache is not None:
+            # the image may have been updated since we last saw it, and the cache goes by its update stamp
+            self.client.prefetch_stamps(self.conn, [job.image_id])
+        image = self.client.retrieve(job.image_id, params['scale_factor'], params.get('grayscale', False))
+        return create_rois(image, **{k: params[k] for k in self.DETECTION_PARAMS if k in params}), params
+
+    def lookup(self, image_id):
+        if self.policy is None:
+            return get_image(self.conn, image_id)
+        return self.policy.call(get_image, self.conn, image_id)
+
+    def save(self, image, regions, params):
+        try:
+            from .save_rois import save_rois
+        except ImportError:
+            from save_rois import save_rois
+        replace = params.get('replace', False)
+        if self.policy is None:
+            save_rois(image, regions, params['scale_factor'], replace)
+            return
+        # saving without replacing twice would duplicate the ROIs
+        save = self.policy.call if replace else self.policy.call_once
+        save(save_rois, image, regions, params['scale_factor'], replace)
+
+    def reconnecting(self, fn, *args):
+        '''
+        fn(*args), called again on fresh sessions if it failed because its session expired.
+        '''
+        try:
+            return fn(*args)
+        except Exception as e:
+            if not is_session_expired(e):
+                raise
+        self.connect()
+        return fn(*args)
+
+    def process(self, job):
+        '''
+        retrieve -> detect -> save for one job; returns the number of ROIs saved.
+        '''
+        regions, params = self.reconnecting(self.detect, job)
+        if params.get('replace', False):
+            # deleting everything and saving again ends up the same however far the first try got
+            self.reconnecting(lambda: self.save(self.lookup(job.image_id), regions, params))
+        else:
+            # the lookup proves the Blitz session alive (or renews it) right before the one and only save
+            image = self.reconnecting(self.lookup, job.image_id)
+            self.save(image, regions, params)
+        return len(regions)
+
+    def run_job(self, job):
+        tic = time.perf_counter()
+        try:
+            n_regions = self.process(job)
+        except Exception as e:
+            self.queue.fail(job, '{}: {}'.format(type(e).__name__, e))
+            return False
+        self.queue.complete(job, {'n_regions': n_regions, 'seconds': time.perf_counter() - tic, 'worker': self.name})
+        return True
+
+    def recover(self):
+        '''
+        Puts the jobs whose lease has expired back in the queue (checking at most every tenth of the lease).
+        '''
+        if time.time() - self._last_recover < self.lease / 10:
+            return
+        self._last_recover = time.time()
+        self.queue.recover(self.lease)
+
+    def run(self, max_jobs=None, idle_exit=None):
+        '''
+        Processes jobs until max_jobs have been run or the queue has been empty for idle_exit seconds (both default
+        to never). Returns the number of jobs run.
+        '''
+        if self.conn is None:
+            self.warm_up()
+        done = 0
+        idle_since = time.time()
+        while max_jobs is None or done < max_jobs:
+            self.recover()
+            job = self.queue.claim()
+            if job is None:
+                if idle_exit is not None and time.time() - idle_since >= idle_exit:
+                    break
+                time.sleep(self.poll)
+                self.ping()
+                continue
+            self.run_job(job)
+            self._last_ping = time.time()
+            done += 1
+            idle_since = time.time()
+        return done
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from create_session import create_json_session, create_blitz_session
+    from thumbnail_cache import ThumbnailCache
+    from client_policy import policy_from_args
+
+    parser = argparse.ArgumentParser(description='Warm worker: keeps imports and OMERO sessions around and '
+                                                 'processes images from a local job queue')
+    queues = parser.add_mutually_exclusive_group(required=True)
+    queues.add_argument('--queue-dir', help='directory queue (one JSON file per job)')
+    queues.add_argument('--queue-db', help='SQLite queue')
+    parser.add_argument('--submit', type=int, nargs='+', metavar='IMAGE_ID',
+                        help="don't run a worker, just queue these images (with the parameters given below)")
+    parser.add_argument('--scale-factor', type=int, default=64)
+    parser.add_argument('--size-thresh', type=float, default=200)
+    parser.add_argument('--method', default='triangle')
+    parser.add_argument('--closing', type=int, default=5)
+    parser.add_argument('--grayscale', action='store_true')
+    parser.add_argument('--rerun',
+                        dest='rerun',
+                        action='store_true',
+                        help='Set this flag if it is a rerun (WILL delete ALL existing ROIs)')
+    parser.add_argument('--thumbnail-cache', metavar='DIR', help='keep downloaded thumbnails in this directory')
+    parser.add_argument('--cache-mb', type=int, default=2048, help='size limit of the thumbnail cache')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='retry OMERO calls that fail with a transient error up to this many times, with backoff')
+    parser.add_argument('--adaptive-limit', type=int, default=0, metavar='MAX',
+                        help='adapt the number of concurrent OMERO calls to the server latency and errors, up to MAX')
+    parser.add_argument('--session-file', metavar='FILE',
+                        help='keep the JSON API session in this file (mode 0600) and reuse it while it is valid')
+    parser.add_argument('--poll', type=float, default=1.0)
+    parser.add_argument('--lease', type=float, default=3600,
+                        help='seconds after which an unfinished job counts as lost (its worker died) and is run again')
+    parser.add_argument('--max-jobs', type=int, default=None)
+    parser.add_argument('--idle-exit', type=float, default=None, help='stop after the queue was empty this long')
+    args = parser.parse_args(sys.argv[1:])
+
+    queue = DirectoryQueue(args.queue_dir) if args.queue_dir else SQLiteQueue(args.queue_db)
+    params = {'size_thresh': args.size_thresh, 'method_thresh': args.method, 'closing': args.closing,
+              'scale_factor': args.scale_factor, 'grayscale': args.grayscale, 'replace': args.rerun}
+
+    if args.submit:
+        for image_id in args.submit:
+            queue.submit(image_id, params)
+        sys.exit(0)
+
+    WEB_HOSTNAME = os.environ['OMERO_WEB_HOSTNAME']
+    HOSTNAME = os.environ['OMERO_HOSTNAME']
+    USERNAME = os.environ['OMERO_ADMIN_USER']
+    PASSWORD = os.environ['OMERO_ADMIN_PASSWORD']
+
+    def connect_json():
+        login_rsp, session, base_url = create_json_session(WEB_HOSTNAME, USERNAME, PASSWORD, verify=False,
+                                                           session_file=args.session_file)
+        return session, base_url
+
+    def connect_blitz():
+        return create_blitz_session(HOSTNAME, USERNAME, PASSWORD)
+
+    cache = ThumbnailCache(args.thumbnail_cache, args.cache_mb * 2 ** 20) if args.thumbnail_cache else None
+    worker = Worker(queue, connect_json, connect_blitz, params, poll=args.poll, cache=cache,
+                    policy=policy_from_args(args.retries, args.adaptive_limit), lease=args.lease)
+    try:
+        worker.run(args.max_jobs, args.idle_exit)
+    finally:
+        worker.close()
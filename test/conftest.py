@@ -0,0 +1,134 @@
+import json
+import threading
+from collections import Counter
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def detection_params():
+    '''
+    create_rois parameters that find every section of a slide, one region each.
+    '''
+    return {'size_thresh': 16, 'method_thresh': 'otsu', 'closing': 1, 'scale_factor': 1}
+
+
+@pytest.fixture
+def slide():
+    '''
+    Makes a 120x200 thumbnail with n_sections dark 40x30 sections on a light background, side by side.
+    '''
+    def slide(n_sections):
+        image = np.full((120, 200, 3), 230, dtype=np.uint8)
+        for i in range(n_sections):
+            image[20:60, 10 + 40 * i:40 + 40 * i] = 60
+        return image
+    return slide
+
+
+# a stub OMERO.web for everything that fetches images over the JSON API and webgateway: the images it serves
+SIZES = {i: (6400 + 64 * i, 3200) for i in range(1, 8)}
+DATASETS = {10: [1, 2, 3, 4, 5], 11: [5, 6, 7]}
+PROJECTS = {20: [10, 11]}
+
+# update event times over Blitz (OMERO.web's JSON doesn't have them), for the thumbnail cache
+STAMPS = {i: 1600000000000 for i in SIZES}
+
+
+@lru_cache()
+def noise_jpeg():
+    # noise barely compresses: a big body for a small image
+    from PIL import Image
+    buf = BytesIO()
+    noise = np.random.RandomState(0).randint(0, 256, (750, 1000, 3), dtype=np.uint8)
+    Image.fromarray(noise).save(buf, format='JPEG', quality=95)
+    return buf.getvalue()
+
+
+def image_json(img_id):
+    return {'@id': img_id, 'Pixels': {'SizeX': SIZES[img_id][0], 'SizeY': SIZES[img_id][1]}}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''
+    Just enough of the OMERO JSON API and webgateway for retrieve_image and ImageClient.
+    '''
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def page(self, objects, query):
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['200'])[0])
+        self.reply({'data': objects[offset:offset + limit], 'meta': {'offset': offset, 'limit': limit, 'totalCount': len(objects)}})
+
+    def do_GET(self):
+        with self.server.lock:
+            # failures injected by the test, the server being overloaded
+            failing = self.server.failures > 0
+            self.server.failures -= failing
+        if failing:
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = [p for p in url.path.split('/') if p]
+        self.server.hits[parts[0] if parts[0] == 'webgateway' else url.path] += 1
+        host = 'http://%s:%d' % self.server.server_address
+        if url.path == '/api/v0/':
+            self.reply({'url:images': host + '/api/v0/m/images/', 'url:datasets': host + '/api/v0/m/datasets/'})
+        elif url.path == '/api/v0/m/images/':
+            self.page([image_json(i) for i in DATASETS[int(query['dataset'][0])]], query)
+        elif url.path == '/api/v0/m/datasets/':
+            self.page([{'@id': d} for d in PROJECTS[int(query['project'][0])]], query)
+        elif parts[:4] == ['api', 'v0', 'm', 'images']:
+            self.reply({'data': image_json(int(parts[4]))})
+        elif parts[0] == 'webgateway':
+            from PIL import Image
+            img_id, width = int(parts[2]), int(parts[3])
+            height = round(width * SIZES[img_id][1] / SIZES[img_id][0])
+            buf = BytesIO()
+            Image.new('RGB', (width, height), (200, 10 * img_id, 0)).save(buf, format='JPEG')
+            self.reply(buf.getvalue(), 'image/jpeg')
+        elif url.path == '/noise.jpg':
+            self.reply(noise_jpeg(), 'image/jpeg')
+        else:
+            self.send_error(404)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    httpd.hits = Counter()
+    httpd.failures = 0
+    httpd.lock = threading.Lock()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def base_url(server):
+    '''
+    JSON API root of the stub server.
+    '''
+    return 'http://%s:%d/api/v0/' % server.server_address
@@ -0,0 +1,81 @@
+import threading
+import time
+
+from detect_rois_omero.src.batch import run_batch, summarize
+from detect_rois_omero.src.result_store import ResultStore
+
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+    def __exit__(self, *exc):
+        with self.lock:
+            self.active -= 1
+
+
+def test_run_batch_reports_every_image(detection_params, slide):
+    fetching, uploading = Recorder(), Recorder()
+    saved = {}
+
+    def fetch_image(image_id):
+        with fetching:
+            time.sleep(0.01)
+            if image_id == 3:
+                raise IOError('thumbnail went missing')
+            return slide(1 + image_id % 4)
+
+    def save_regions(image_id, regions):
+        with uploading:
+            time.sleep(0.01)
+            if image_id == 5:
+                raise RuntimeError('server said no')
+            saved[image_id] = list(regions)
+
+    results = run_batch(range(12), fetch_image, save_regions, detection_params,
+                        fetch_workers=2, detect_workers=2, upload_workers=1, max_pending=4)
+
+    assert [r.image_id for r in results] == list(range(12))
+    assert fetching.peak <= 2 and uploading.peak <= 1
+    failed = {r.image_id: r for r in results if r.status != 'ok'}
+    assert sorted(failed) == [3, 5]
+    assert failed[3].stage == 'fetch' and 'thumbnail went missing' in failed[3].error
+    assert failed[5].stage == 'upload'
+    for r in results:
+        if r.status == 'ok':
+            assert r.n_regions == 1 + r.image_id % 4 == len(saved[r.image_id])
+    assert summarize(results).startswith('12 images, 10 ok, 0 skipped, 2 failed')
+
+
+def test_run_batch_skips_unchanged_images(tmp_path, detection_params, slide):
+    store = ResultStore(str(tmp_path / 'results.sqlite'))
+    thumbnails = {i: slide(1 + i % 4) for i in range(6)}
+    uploads = []
+
+    def save_regions(image_id, regions):
+        uploads.append(image_id)
+
+    def run(params):
+        return run_batch(range(6), thumbnails.get, save_regions, params, detect_workers=1, store=store)
+
+    assert [r.status for r in run(detection_params)] == ['ok'] * 6
+    assert len(uploads) == 6
+
+    # nothing changed: no detection, no upload
+    results = run(detection_params)
+    assert [r.status for r in results] == ['skipped'] * 6
+    assert [r.n_regions for r in results] == [1 + i % 4 for i in range(6)]
+    assert len(uploads) == 6
+
+    # one new thumbnail, then a parameter change touching everything
+    thumbnails[2] = slide(4)
+    assert [r.status for r in run(detection_params)] == ['skipped', 'skipped', 'ok', 'skipped', 'skipped', 'skipped']
+    assert [r.status for r in run(dict(detection_params, closing=2))] == ['ok'] * 6
+    assert len(uploads) == 13
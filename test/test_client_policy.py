@@ -0,0 +1,186 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from detect_rois_omero.src.client_policy import AdaptiveLimiter, ClientPolicy, is_session_expired, is_transient
+from detect_rois_omero.src.retrieve_image import ImageClient, ResponseError, retrieve_image
+
+from .conftest import DATASETS
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.content = b''
+        self.headers = headers or {}
+
+
+# what Ice raises when the connection to the server drops
+ConnectionLostException = type('ConnectionLostException', (Exception,), {})
+# and when the session is gone
+SessionException = type('SessionException', (Exception,), {})
+RemovedSessionException = type('RemovedSessionException', (SessionException,), {})
+
+
+def test_is_transient():
+    assert is_transient(ResponseError(FakeResponse(503)))
+    assert is_transient(ResponseError(FakeResponse(429, {'Retry-After': '3'})))
+    assert not is_transient(ResponseError(FakeResponse(404)))
+    assert is_transient(requests.ConnectionError())
+    assert is_transient(ConnectionLostException())
+    assert not is_transient(KeyError('data'))
+    assert ResponseError(FakeResponse(429, {'Retry-After': '3'})).retry_after == 3
+
+
+def test_is_session_expired():
+    assert is_session_expired(ResponseError(FakeResponse(403)))
+    assert is_session_expired(RemovedSessionException())
+    assert not is_session_expired(ResponseError(FakeResponse(404)))
+    assert not is_session_expired(ResponseError(FakeResponse(503)))
+    assert not is_session_expired(ConnectionLostException())
+    assert not is_session_expired(RuntimeError('session expired'))
+
+
+def test_policy_retries_transient_errors_only():
+    policy = ClientPolicy(attempts=3, base_delay=0.001)
+    calls = []
+
+    def flaky(fail, error):
+        calls.append(1)
+        if len(calls) <= fail:
+            raise error
+        return 'ok'
+
+    assert policy.call(flaky, 2, ResponseError(FakeResponse(502))) == 'ok' and len(calls) == 3
+    del calls[:]
+    with pytest.raises(ResponseError):
+        policy.call(flaky, 3, ResponseError(FakeResponse(502)))
+    assert len(calls) == 3
+    del calls[:]
+    with pytest.raises(ResponseError):
+        policy.call(flaky, 1, ResponseError(FakeResponse(403)))
+    assert len(calls) == 1
+    del calls[:]
+    # no retries, ever
+    with pytest.raises(ResponseError):
+        policy.call_once(flaky, 1, ResponseError(FakeResponse(502)))
+    assert len(calls) == 1 and policy.retries == 4
+
+
+def test_backoff_is_jittered_and_capped():
+    policy = ClientPolicy(base_delay=1, max_delay=5)
+    delays = [policy.delay(attempt) for attempt in range(10) for _ in range(20)]
+    assert all(0 <= d <= 5 for d in delays) and len(set(delays)) > 100
+    assert policy.delay(0, ResponseError(FakeResponse(429, {'Retry-After': '4'}))) >= 4
+
+
+def test_limiter_aimd():
+    limiter = AdaptiveLimiter(initial=2, maximum=10, target_latency=1)
+
+    def round_trip(latency, ok=True):
+        # as many calls as the limit allows at once
+        n = int(limiter.limit)
+        for _ in range(n):
+            limiter.acquire()
+        for _ in range(n):
+            limiter.release(latency, ok)
+
+    # one call at a time doesn't need more than the limit there is
+    for _ in range(50):
+        limiter.acquire()
+        limiter.release(0.1)
+    assert limiter.limit < 3
+    for _ in range(50):
+        round_trip(0.1)
+    assert limiter.limit == 10
+    # a burst of errors from the same round only halves it once
+    for _ in range(5):
+        limiter.acquire()
+        limiter.release(0.1, ok=False)
+    assert limiter.limit == 5
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(2.0)
+    assert limiter.minimum <= limiter.limit < 2
+
+
+def test_limiter_finds_server_capacity():
+    # a server that serves 3 calls at once quickly, and answers 503 beyond that
+    capacity = 3
+    state = {'active': 0, 'peak': 0}
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            state['active'] += 1
+            overloaded = state['active'] > capacity
+        try:
+            time.sleep(0.002)
+            if overloaded:
+                raise ResponseError(FakeResponse(503))
+        finally:
+            with lock:
+                state['active'] -= 1
+
+    policy = ClientPolicy(AdaptiveLimiter(initial=1, maximum=16), attempts=20, base_delay=0.001, max_delay=0.01)
+
+    def worker():
+        for _ in range(40):
+            policy.call(call)
+
+    threads = [threading.Thread(target=worker) for _ in range(12)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # every call made it in the end, and the limit hovers around the capacity instead of the 12 threads
+    assert policy.limiter.in_flight == 0
+    assert policy.limiter.limits()['call'] <= 2 * capacity + 1
+
+
+def test_limiter_keeps_a_limit_per_kind_of_call():
+    # a healthy server where saves are just much slower than thumbnails: neither limit should collapse
+    def thumbnail():
+        time.sleep(0.002)
+
+    def query():
+        time.sleep(0.02)
+
+    def save():
+        time.sleep(0.04)
+
+    policy = ClientPolicy(AdaptiveLimiter(initial=4, maximum=8))
+
+    def worker(fn, n):
+        for _ in range(n):
+            policy.call(fn)
+
+    threads = [threading.Thread(target=worker, args=(fn, n))
+               for fn, n in [(thumbnail, 100), (query, 15), (save, 8)] for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    limits = policy.limiter.limits()
+    assert set(limits) == {'thumbnail', 'query', 'save'}
+    assert all(limit >= 4 for limit in limits.values())
+    assert policy.limiter.in_flight == 0
+
+
+def test_client_rides_out_server_errors(server, base_url):
+    policy = ClientPolicy(AdaptiveLimiter(), base_delay=0.001)
+    client = ImageClient(requests.Session(), base_url, policy=policy, page_size=2)
+    server.failures = 3
+    assert client.prefetch_dataset(10) == DATASETS[10]
+    server.failures = 2
+    assert client.retrieve(1, 64).shape[:2] == (50, 101)
+    server.failures = 2
+    assert retrieve_image(requests.Session(), base_url, 2, 64, policy=policy).shape[:2] == (50, 102)
+    assert policy.retries == 7
+
+    server.failures = 1
+    with pytest.raises(ResponseError) as e:
+        retrieve_image(requests.Session(), base_url, 2, 64)
+    assert e.value.status_code == 503
@@ -0,0 +1,380 @@
+import numpy as np
+import pytest
+
+from detect_rois_omero.src import create_rois as cr
+
+
+def make_slide(seed, shape=(300, 400), sections=6, specks=400):
+    '''
+    Light background with a few dark rectangular "sections" and lots of dark single-pixel specks.
+    '''
+    rng = np.random.RandomState(seed)
+    image = np.full(shape + (3,), 235, dtype=np.uint8)
+    for _ in range(sections):
+        h, w = rng.randint(20, 60, size=2)
+        y, x = rng.randint(0, shape[0] - h), rng.randint(0, shape[1] - w)
+        image[y:y + h, x:x + w] = rng.randint(40, 120)
+    ys = rng.randint(0, shape[0], size=specks)
+    xs = rng.randint(0, shape[1], size=specks)
+    image[ys, xs] = 30
+    return image
+
+
+def reference_filter(im_lab, min_pixels):
+    # the original per-label implementation
+    for i in range(1, im_lab.max() + 1):
+        coords = np.where(im_lab == i)
+        if len(coords[0]) < min_pixels:
+            im_lab[coords] = 0
+    return im_lab
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('min_pixels', [0, 1, 2, 10, 500])
+def test_filter_small_regions_matches_reference(seed, min_pixels):
+    from skimage.measure import label
+    image = make_slide(seed)
+    im_lab = label(image[..., 0] < 200)
+    expected = reference_filter(im_lab.copy(), min_pixels)
+    result = cr.filter_small_regions(im_lab.copy(), min_pixels)
+    np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_create_rois_unchanged_by_size_filter(seed, monkeypatch):
+    image = make_slide(seed)
+    regions = cr.create_rois(image, 200, 'triangle', 1, 4)
+    monkeypatch.setattr(cr, 'filter_small_regions', reference_filter)
+    expected = cr.create_rois(image, 200, 'triangle', 1, 4)
+    assert regions == expected
+    assert len(regions) > 0
+
+
+def reference_cluster(regions):
+    # the original networkx-based implementation
+    import networkx as nx
+    results = []
+    edges = []
+    for i, region in enumerate(regions):
+        intersection = cr.check_intersections(region, regions)
+        if intersection != -1:
+            edges.append((i, intersection))
+        else:
+            results.append(region)
+    G = nx.Graph()
+    G.add_edges_from(edges)
+    for a in nx.connected_components(G):
+        results.append(cr.merge_cluster(list(a), regions))
+    return results
+
+
+def random_boxes(seed, n, extent=200, size=30):
+    rng = np.random.RandomState(seed)
+    y1 = rng.randint(0, extent, size=n)
+    x1 = rng.randint(0, extent, size=n)
+    h, w = rng.randint(1, size, size=(2, n))
+    boxes = [tuple(int(v) for v in b) for b in zip(y1, x1, y1 + h, x1 + w)]
+    # throw in a few exact duplicates, which check_intersections treats as "itself"
+    boxes += boxes[:n // 10]
+    return boxes
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('n', [0, 1, 2, 10, 60])
+def test_cluster_regions_matches_reference(seed, n):
+    boxes = random_boxes(seed, n)
+    assert cr.cluster_regions(boxes) == reference_cluster(boxes)
+
+
+def test_cluster_regions_scales():
+    # timings are in benchmarks/bench_stages.py; here, the sweep only looks at boxes that overlap in Y
+    n = 20000
+    boxes = random_boxes(0, n, extent=20000, size=60)
+    order, start, counts = cr._sweep_candidates(np.array(boxes))
+    assert counts.sum() < 100 * n < n * (n - 1) // 2
+    regions = cr.cluster_regions(boxes)
+    assert 0 < len(regions) < len(boxes)
+
+
+def reference_order(regions):
+    # the original list-based ordering
+    if regions == []:
+        return []
+    regions = list(regions)
+    centroids = [((r[1] + r[3]) / 2, (r[0] + r[2]) / 2) for r in regions]
+    sums = [c[0] + c[1] for c in centroids]
+    topleft = sums.index(min(sums))
+    c_topleft = centroids[topleft]
+    r_topleft = regions[topleft]
+    regions.remove(r_topleft)
+    centroids.remove(c_topleft)
+    dists = [cr.weighted_distance(x, c_topleft, 20) for x in centroids]
+    regions = [x for _, x in sorted(zip(dists, regions))]
+    dists = sorted(dists)
+    differences = [dists[i + 1] - dists[i] for i in range(len(dists) - 1)]
+    line_dividers = np.insert(np.asarray(differences) > 1.5 * np.std(differences), 0, False) if differences else [False]
+    lines = [[r_topleft]]
+    for i in range(len(regions)):
+        if line_dividers[i]:
+            lines.append([])
+        lines[-1].append(regions[i])
+    results = []
+    for line in lines:
+        xvals = [(r[1] + r[3]) / 2 for r in line]
+        results.append([x for _, x in sorted(zip(xvals, line))])
+    return [item for sublist in results for item in sublist]
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('n', [0, 1, 2, 3, 10, 60])
+def test_order_regions_matches_reference(seed, n):
+    boxes = random_boxes(seed, n)
+    assert cr.order_regions(boxes, 'weighted') == reference_order(boxes)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_prune_regions_drops_elongated(seed):
+    boxes = random_boxes(seed, 60)
+    kept = [b for b in boxes if not cr.check_aspect_ratio(b, 4)]
+    assert cr.prune_regions(boxes) == reference_cluster(kept)
+
+
+def test_region_set_behaves_like_tuple_list():
+    from detect_rois_omero.src.region_set import RegionSet
+    boxes = [(1, 2, 5, 9), (0, 0, 3, 3)]
+    regions = RegionSet.from_regions(boxes)
+    assert regions.boxes.dtype == np.int32
+    assert len(regions) == 2 and regions == boxes and list(regions) == boxes
+    assert regions[1] == (0, 0, 3, 3)
+    assert regions[np.array([False, True])] == [(0, 0, 3, 3)]
+    assert regions.centroids().tolist() == [[5.5, 3.0], [1.5, 1.5]]
+    assert regions.scaled(2).tolist() == [[2, 4, 10, 18], [0, 0, 6, 6]]
+    assert not RegionSet() and RegionSet() == []
+
+
+def test_region_set_array_does_not_leak():
+    from detect_rois_omero.src.region_set import RegionSet
+    regions = RegionSet([(1, 2, 5, 9)])
+    with pytest.raises(ValueError):
+        np.asarray(regions)[0] = 0
+    copied = np.array(regions)
+    copied[0] = 0
+    assert regions == [(1, 2, 5, 9)]
+    assert np.asarray(regions, dtype=np.float64).tolist() == [[1, 2, 5, 9]]
+
+
+def tma_grid(seed, rows, cols, jitter=6, size=40, pitch=60):
+    # a grid of square cores with a bit of positional noise, listed in the expected reading order
+    rng = np.random.RandomState(seed)
+    boxes = []
+    for r in range(rows):
+        for c in range(cols):
+            dy, dx = rng.randint(-jitter, jitter + 1, size=2)
+            y, x = 100 + r * pitch + dy, 100 + c * pitch + dx
+            boxes.append((int(y), int(x), int(y + size), int(x + size)))
+    return boxes
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_order_regions_rows_reading_order(seed):
+    expected = tma_grid(seed, 7, 9)
+    shuffled = list(expected)
+    np.random.RandomState(seed).shuffle(shuffled)
+    assert cr.order_regions(shuffled) == expected
+    assert cr.order_regions(shuffled, 'rows') == cr.order_regions(shuffled[::-1], 'rows')
+
+
+def test_order_regions_rows_overlapping_rows():
+    # sections of different heights in the first row, whose centroids are all over the place
+    boxes = [(150, 0, 200, 50), (20, 200, 140, 250), (30, 100, 90, 150), (0, 0, 100, 50)]
+    assert cr.order_regions(boxes) == [(0, 0, 100, 50), (30, 100, 90, 150), (20, 200, 140, 250), (150, 0, 200, 50)]
+
+
+def test_order_regions_rows_large_grid():
+    # timings are in benchmarks/bench_stages.py
+    boxes = tma_grid(0, 60, 80, size=30, pitch=45)
+    assert cr.order_regions(boxes[::-1]) == boxes
+
+
+def test_order_regions_unknown_strategy():
+    with pytest.raises(ValueError):
+        cr.order_regions([(0, 0, 1, 1)], 'alphabetical')
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('tile_size', [37, 64, 500])
+def test_detect_tiled_matches_whole_image(seed, tile_size):
+    from detect_rois_omero.src.tiled import detect_tiled
+    image = make_slide(seed, specks=100)
+    threshold = cr.threshold_value(cr.inverted_gray(image), 'triangle')
+
+    def fetch_tile(row, col):
+        return image[row * tile_size:(row + 1) * tile_size, col * tile_size:(col + 1) * tile_size]
+
+    # without closing, tiling must not change anything
+    expected = cr.create_rois(image, 200, 'triangle', 0, 4)
+    regions = detect_tiled(fetch_tile, image.shape[:2], tile_size, threshold, 200, 0, 4, workers=3)
+    assert sorted(regions) == sorted(expected)
+    assert len(regions) > 0
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('tile_size', [5, 37, 64])
+def test_detect_tiled_closes_across_seams(seed, tile_size):
+    from detect_rois_omero.src.tiled import detect_tiled
+    image = make_slide(seed, sections=3, specks=100)
+    # a section cut in two by a gap right on a seam, which only closing joins back up
+    seam = tile_size * -(-250 // tile_size)
+    image[200:250, seam - 60:seam + 40] = 60
+    image[200:250, seam - 2:seam + 2] = 235
+    threshold = cr.threshold_value(cr.inverted_gray(image), 'triangle')
+    fetched = []
+
+    def fetch_tile(row, col):
+        fetched.append((row, col))
+        return image[row * tile_size:(row + 1) * tile_size, col * tile_size:(col + 1) * tile_size]
+
+    expected = cr.create_rois(image, 200, 'triangle', 3, 4)
+    regions = detect_tiled(fetch_tile, image.shape[:2], tile_size, threshold, 200, 3, 4, workers=3)
+    assert sorted(regions) == sorted(expected)
+    # one region covers both halves
+    assert any(x1 <= seam - 60 and x2 >= seam + 40 for y1, x1, y2, x2 in regions if y1 <= 200 < y2)
+    # the halos come from tiles that are kept, not fetched again
+    assert sorted(fetched) == sorted(set(fetched))
+
+
+def test_refine_regions_recovers_fine_boxes():
+    from detect_rois_omero.src.refine import TileReader, refine_regions
+    fine = make_slide(7, shape=(960, 1280), sections=8, specks=0)
+    ratio = 8
+    coarse = fine.reshape(120, ratio, 160, ratio, 3).mean(axis=(1, 3)).astype(np.uint8)
+    threshold = cr.threshold_value(cr.inverted_gray(coarse), 'otsu')
+    candidates = cr.create_rois(coarse, 0, 'otsu', 0, 1)
+
+    def fetch_tile(row, col):
+        return fine[row * 100:(row + 1) * 100, col * 100:(col + 1) * 100]
+
+    reader = TileReader(fetch_tile, 100, fine.shape[:2])
+    stats = {}
+    refined = refine_regions(candidates, ratio, reader, threshold, stats=stats)
+    assert len(refined) == len(candidates) > 0
+    # every refined box is a box found by running on the fine image directly
+    assert set(refined) <= set(cr.create_rois(fine, 0, 'otsu', 0, 1))
+    # and we looked at a fraction of the slide
+    assert stats['pixels'] < 0.6 * fine.shape[0] * fine.shape[1]
+
+
+def test_refine_regions_adjacent_sections():
+    from detect_rois_omero.src.refine import TileReader, refine_regions
+    fine = np.full((480, 640), 235, dtype=np.uint8)
+    fine[80:240, 80:300] = 60
+    fine[80:240, 310:500] = 60
+    fine[300:400, 40:600] = 60
+    reader = TileReader(lambda r, c: fine[r * 64:(r + 1) * 64, c * 64:(c + 1) * 64], 64, fine.shape)
+    # at a ratio of 8, the coarse boxes are up to a coarse pixel off: the first reaches into its neighbour,
+    # the last only covers part of its section
+    coarse = [(10, 10, 30, 40), (10, 38, 30, 63), (37, 20, 50, 40)]
+    refined = refine_regions(coarse, 8, reader, 100, margin=2)
+    assert list(refined) == [(80, 80, 240, 300), (80, 310, 240, 500), (300, 40, 400, 600)]
+
+
+
+def test_refined_detection_merges_boxes_that_refine_onto_one_section():
+    from detect_rois_omero.src.refine import create_rois_refined
+    # two sections joined by a bridge too thin to survive downsampling: two coarse boxes, one section at full scale
+    fine = np.full((480, 640), 235, dtype=np.uint8)
+    fine[80:240, 80:260] = 60
+    fine[80:240, 300:380] = 60
+    fine[152:154, 260:300] = 60
+
+    class FakeClient(object):
+        def image_size(self, img_id):
+            return 640, 480
+
+        def zoom_levels(self, img_id):
+            return {0: 1.0}
+
+        def retrieve(self, img_id, scale, grayscale=False):
+            return fine.reshape(480 // scale, scale, 640 // scale, scale).mean(axis=(1, 3)).astype(np.uint8)
+
+        def render_tile(self, img_id, level, col, row, width, height, grayscale=False):
+            return fine[row * height:(row + 1) * height, col * width:(col + 1) * width]
+
+    assert len(cr.create_rois(FakeClient().retrieve(1, 8), 0, 'otsu', 0, 8)) == 2
+    regions = create_rois_refined(FakeClient(), 1, 0, 'otsu', 0, coarse_scale=8, fine_scale=1, tile_size=64)
+    assert len(regions) == 1
+    y1, x1, y2, x2 = regions[0]
+    assert (y1, x1, y2) == (80, 80, 240) and x2 >= 380
+
+def test_tile_reader_crops():
+    from detect_rois_omero.src.refine import TileReader
+    image = np.arange(50 * 70).reshape(50, 70)
+    reader = TileReader(lambda r, c: image[r * 16:(r + 1) * 16, c * 16:(c + 1) * 16], 16, image.shape, cache_tiles=4)
+    for y1, x1, y2, x2 in [(0, 0, 50, 70), (3, 5, 4, 6), (15, 15, 33, 49), (40, 60, 50, 70)]:
+        np.testing.assert_array_equal(reader.read(y1, x1, y2, x2), image[y1:y2, x1:x2])
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('method', ['otsu', 'triangle', 'yen', 'li'])
+def test_create_rois_uint8_grayscale(seed, method):
+    # make_slide is neutral grey, so the uint8 path sees the same image as rgb2gray
+    image = make_slide(seed)
+    gray = image[..., 0].copy()
+    assert cr.inverted_gray(gray).dtype == np.uint8
+    assert cr.create_rois(gray, 200, method, 1, 4) == cr.create_rois(image, 200, method, 1, 4)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('gray', [False, True])
+def test_sweep_parameters_matches_create_rois(seed, gray):
+    from detect_rois_omero.src.sweep import sweep_parameters, histogram_thresholds, format_table
+    image = make_slide(seed)
+    # colour the sections a bit so that rgb2gray gives a float image with a real spread of values
+    image[..., 2] = np.minimum(image[..., 2].astype(int) + 15, 255)
+    if gray:
+        image = image[..., 0].copy()
+    methods = ['otsu', 'triangle', 'yen', 'li']
+    im = cr.inverted_gray(image)
+    thresholds = histogram_thresholds(im, methods)
+    for method in methods:
+        assert thresholds[method] == cr.threshold_value(im, method)
+
+    rows = sweep_parameters(image, methods, [0, 2], [0, 200, 2000], 4)
+    assert len(rows) == 4 * 2 * 3
+    for row in rows:
+        expected = cr.create_rois(image, row['size_thresh'], row['method_thresh'], row['closing'], 4)
+        assert row['regions'] == expected
+    assert len(format_table(rows).splitlines()) == len(rows) + 1
+
+
+@pytest.mark.filterwarnings('ignore::FutureWarning')
+@pytest.mark.parametrize('seed', range(6))
+@pytest.mark.parametrize('radius', [0, 1, 2, 3, 5, 9, 20])
+def test_diamond_closing_matches_binary_closing(seed, radius):
+    from skimage.morphology import diamond, binary_closing
+    rng = np.random.RandomState(seed)
+    mask = rng.rand(70, 90) > 0.93
+    # a blob touching the border and a thin broken line
+    mask[:15, :20] = True
+    mask[40, ::4] = True
+    np.testing.assert_array_equal(cr.diamond_closing(mask, radius), binary_closing(mask, diamond(radius)))
+
+
+def test_diamond_closing_edge_cases():
+    assert not cr.diamond_closing(np.zeros((5, 5), bool), 3).any()
+    assert cr.diamond_closing(np.ones((5, 5), bool), 3).all()
+
+
+@pytest.mark.parametrize('rgb', [True, False])
+def test_synthetic_slide_grid(rgb):
+    from detect_rois_omero.src.synthetic import synthetic_slide
+    image, boxes = synthetic_slide((300, 400), grid=(3, 4), specks=0, seed=3, rgb=rgb)
+    again, _ = synthetic_slide((300, 400), grid=(3, 4), specks=0, seed=3, rgb=rgb)
+    np.testing.assert_array_equal(image, again)
+    assert image.shape == ((300, 400, 3) if rgb else (300, 400))
+    for method in ['otsu', 'triangle']:
+        assert cr.create_rois(image, 20, method, 2, 1) == boxes
+
+    # specks get closed into neighbouring sections now and then, but never make regions of their own
+    speckled, _ = synthetic_slide((300, 400), grid=(3, 4), specks=300, seed=3, rgb=rgb)
+    assert len(cr.create_rois(speckled, 20, 'triangle', 2, 1)) == len(boxes)
@@ -1,20 +1,88 @@
-from detect_rois_omero.src.create_session import create_json_session
+import os
 
+import pytest
 
-def test_json_login():
-    import os
+from detect_rois_omero.src.create_session import create_blitz_session, create_json_session
+from detect_rois_omero.src.omero_standin import StandInServer
+
+
+@pytest.fixture
+def standin():
+    with StandInServer() as server:
+        yield server
+
+
+def test_json_login(standin):
+    login_rsp, session, base_url = create_json_session(standin.host, 'root', 'omero')
+    assert login_rsp['success']
+    assert base_url == standin.base_url
+    # the session is logged in
+    assert session.get(base_url + 'm/images/').status_code == 200
+
+
+def test_json_login_wrong_password(standin):
+    with pytest.raises(AssertionError):
+        create_json_session(standin.host, 'root', 'wrong')
+
+
+@pytest.mark.skipif('OMERO_WEB_HOSTNAME' not in os.environ, reason='needs a real OMERO server')
+def test_json_login_server():
     HOSTNAME = os.environ['OMERO_WEB_HOSTNAME']
     USERNAME = os.environ['OMERO_ADMIN_USER']
     PASSWORD = os.environ['OMERO_ADMIN_PASSWORD']
 
-    login_rsp, session, base_url = create_session(HOSTNAME, USERNAME, PASSWORD)
+    login_rsp, session, base_url = create_json_session(HOSTNAME, USERNAME, PASSWORD)
     assert login_rsp['success']
 
+
+@pytest.mark.skipif('OMERO_HOSTNAME' not in os.environ, reason='needs a real OMERO server')
 def test_blitz_login():
-    import os
+    pytest.importorskip('omero')
     HOSTNAME = os.environ['OMERO_HOSTNAME']
     USERNAME = os.environ['OMERO_ADMIN_USER']
     PASSWORD = os.environ['OMERO_ADMIN_PASSWORD']
 
-    login_rsp, session, base_url = create_session(HOSTNAME, USERNAME, PASSWORD)
-    assert login_rsp['success']
\ No newline at end of file
+    conn = create_blitz_session(HOSTNAME, USERNAME, PASSWORD)
+    try:
+        assert conn.isConnected()
+    finally:
+        conn.close()
+
+
+def test_session_file_reuse(standin, tmp_path):
+    path = str(tmp_path / 'session.json')
+    login_rsp, session, base_url = create_json_session(standin.host, 'root', 'omero', session_file=path)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert 'omero' not in open(path).read()
+    logins = standin.hits['/api/v0/login/']
+
+    # reused with a single request, no login
+    before = sum(standin.hits.values())
+    login_rsp2, session2, base_url2 = create_json_session(standin.host, 'root', 'omero', session_file=path)
+    assert sum(standin.hits.values()) == before + 1
+    assert standin.hits['/api/v0/login/'] == logins
+    assert base_url2 == base_url
+    assert login_rsp2 == login_rsp
+    assert session2.get(base_url + 'm/images/1/').status_code == 200
+
+
+def test_session_file_expired(standin, tmp_path):
+    path = str(tmp_path / 'session.json')
+    create_json_session(standin.host, 'root', 'omero', session_file=path)
+    standin.expire_sessions()
+    login_rsp, session, base_url = create_json_session(standin.host, 'root', 'omero', session_file=path)
+    assert standin.hits['/api/v0/login/'] == 2
+    assert session.get(base_url + 'm/images/1/').status_code == 200
+    # the fresh session was stored
+    create_json_session(standin.host, 'root', 'omero', session_file=path)
+    assert standin.hits['/api/v0/login/'] == 2
+
+
+def test_session_file_other_user(standin, tmp_path):
+    path = str(tmp_path / 'session.json')
+    with open(path, 'w') as f:
+        f.write('{"broken')
+    create_json_session(standin.host, 'root', 'omero', session_file=path)
+    with pytest.raises(AssertionError):
+        create_json_session(standin.host, 'someone', 'else', session_file=path)
+    assert standin.hits['/api/v0/login/'] == 2
@@ -0,0 +1,124 @@
+import json
+
+import numpy as np
+import pytest
+import requests
+
+from detect_rois_omero.src import metrics
+from detect_rois_omero.src.batch import run_batch
+from detect_rois_omero.src.create_rois import create_rois
+from detect_rois_omero.src.retrieve_image import ImageClient
+
+
+@pytest.fixture
+def recorder():
+    recorder = metrics.enable(metrics.Recorder(memory=True))
+    yield recorder
+    metrics.disable()
+
+
+def test_disabled_hooks_do_nothing(detection_params, slide):
+    assert metrics.active() is None
+    assert metrics.stage('detect') is metrics.image(3)
+    with metrics.stage('detect'), metrics.image(3):
+        metrics.add_bytes(10)
+    assert create_rois(slide(2), **detection_params) == [(20, 10, 60, 40), (20, 50, 60, 80)]
+
+
+def test_stages_images_and_errors(recorder, tmp_path, detection_params, slide):
+    with metrics.image(7):
+        with metrics.stage('retrieve'):
+            metrics.add_bytes(100)
+            with metrics.stage('decode', image_id=8):
+                metrics.add_bytes(5)
+                np.ones(10 ** 6)
+        with pytest.raises(ValueError):
+            create_rois(slide(1), 16, 'median', 1, 1)
+    create_rois(slide(1), **detection_params)
+
+    stages = [(r['stage'], r['image_id'], r['bytes'], r['ok']) for r in recorder.records]
+    assert stages == [('decode', 8, 5, True), ('retrieve', 7, 100, True), ('detect', 7, 0, False), ('detect', None, 0, True)]
+    assert recorder.records[0]['peak_bytes'] >= 8 * 10 ** 6
+    # the nested stage doesn't wipe the peak of the one around it
+    assert recorder.records[1]['peak_bytes'] >= 8 * 10 ** 6
+
+    totals = recorder.totals()
+    assert totals['detect']['calls'] == 2 and totals['detect']['errors'] == 1
+
+    recorder.write_jsonl(str(tmp_path / 'm.jsonl'))
+    lines = [json.loads(l) for l in open(str(tmp_path / 'm.jsonl'))]
+    assert [l['stage'] for l in lines] == ['decode', 'retrieve', 'detect', 'detect']
+
+    recorder.write_prometheus(str(tmp_path / 'm.prom'))
+    prom = open(str(tmp_path / 'm.prom')).read().splitlines()
+    assert '# TYPE detect_rois_stage_seconds_total counter' in prom
+    assert 'detect_rois_stage_calls_total{stage="detect"} 2' in prom
+    assert 'detect_rois_stage_errors_total{stage="detect"} 1' in prom
+    assert 'detect_rois_stage_bytes_total{stage="retrieve"} 100' in prom
+
+
+def test_retrieve_counts_bytes(recorder, base_url):
+    client = ImageClient(requests.Session(), base_url)
+    client.retrieve(3, 64)
+    client.retrieve(4, 64, grayscale=True)
+    retrieved = [r for r in recorder.records if r['stage'] == 'retrieve']
+    assert len(retrieved) == 2
+    # small solid-colour jpegs, a few hundred bytes each
+    assert all(100 < r['bytes'] < 10000 for r in retrieved)
+
+
+def test_batch_attributes_stages_to_images(recorder, detection_params, slide):
+    def fetch_image(image_id):
+        with metrics.stage('retrieve'):
+            return slide(1 + image_id % 3)
+
+    def save_regions(image_id, regions):
+        with metrics.stage('save'):
+            pass
+
+    run_batch(range(6), fetch_image, save_regions, detection_params, fetch_workers=2, detect_workers=2,
+              upload_workers=1)
+    by_stage = {}
+    for r in recorder.records:
+        by_stage.setdefault(r['stage'], []).append(r['image_id'])
+    assert {k: sorted(v) for k, v in by_stage.items()} == {s: list(range(6)) for s in ('retrieve', 'detect', 'save')}
+    # detection runs alone in its process; the fetches and saves overlapped in threads
+    assert all(r['peak_bytes'] is not None for r in recorder.records if r['stage'] == 'detect')
+
+
+def test_overlapping_threads_get_no_peak(recorder):
+    import threading
+    started, release = threading.Event(), threading.Event()
+
+    def other():
+        with metrics.stage('save'):
+            started.set()
+            release.wait()
+
+    t = threading.Thread(target=other)
+    t.start()
+    started.wait()
+    with metrics.stage('retrieve'):
+        np.ones(10 ** 5)
+    release.set()
+    t.join()
+    with metrics.stage('detect'):
+        np.ones(10 ** 5)
+    peaks = {r['stage']: r['peak_bytes'] for r in recorder.records}
+    assert peaks['retrieve'] is None and peaks['save'] is None
+    assert peaks['detect'] >= 8 * 10 ** 5
+
+
+def test_peaks_without_reset_peak(recorder, monkeypatch):
+    # what Python < 3.9 has: no tracemalloc.reset_peak
+    import tracemalloc
+    monkeypatch.delattr(tracemalloc, 'reset_peak', raising=False)
+    tracemalloc.clear_traces()
+    with metrics.stage('detect'):
+        np.ones(10 ** 6)
+    # below the earlier high: only sampled at the stage boundaries, but still measured
+    with metrics.stage('save'):
+        np.ones(10 ** 5)
+    peaks = {r['stage']: r['peak_bytes'] for r in recorder.records}
+    assert peaks['detect'] >= 8 * 10 ** 6
+    assert peaks['save'] is not None and 0 <= peaks['save'] < 8 * 10 ** 6
@@ -0,0 +1,118 @@
+import pytest
+
+from detect_rois_omero.src.batch import run_batch
+from detect_rois_omero.src.offline import CommitJournal, DetectionStore, commit_detections
+
+
+class FakeOmero(object):
+    '''
+    ROIs per image, saved like sync_rois(..., delete=False) (only the missing ones are added) or, with replace, like
+    save_rois(..., replace=True); fails once on the images in crash_on.
+    '''
+    def __init__(self, crash_on=(), replace=False):
+        self.rois = {}
+        self.saves = 0
+        self.crash_on = set(crash_on)
+        self.replace = replace
+
+    def save(self, image_id, regions, scale):
+        if image_id in self.crash_on:
+            self.crash_on.discard(image_id)
+            raise IOError('connection lost')
+        self.saves += 1
+        boxes = [tuple(int(v * scale) for v in box) for box in regions]
+        if self.replace:
+            self.rois[image_id] = boxes
+        else:
+            existing = self.rois.setdefault(image_id, [])
+            for i, box in enumerate(boxes):
+                # repeated boxes are told apart by their "ROI n" labels
+                if existing.count(box) <= boxes[:i].count(box):
+                    existing.append(box)
+
+
+def test_store_round_trip(tmp_path, detection_params):
+    store = DetectionStore(str(tmp_path), flush_every=2)
+    store.add(1, [(0, 0, 5, 5), (10, 10, 20, 30)], 64, detection_params)
+    store.add(2, [], 64, detection_params)
+    store.add(3, [(1, 2, 3, 4)], 32, dict(detection_params, closing=3))
+    # only full buffers are written until flush()
+    assert store.images() == {1, 2}
+    store.flush()
+    store.add(1, [(7, 7, 9, 9)], 16, detection_params)
+    store.flush()
+
+    results = DetectionStore(str(tmp_path)).read()
+    assert sorted(results) == [1, 2, 3]
+    regions, scale, params, part = results[1]
+    assert regions == [(7, 7, 9, 9)] and scale == 16 and params == detection_params
+    assert results[2][0] == [] and results[3][1:3] == (32, dict(detection_params, closing=3))
+    assert len(DetectionStore(str(tmp_path)).parts()) == 3
+
+
+def test_detect_offline_with_run_batch(tmp_path, detection_params, slide):
+    store = DetectionStore(str(tmp_path / 'store'), flush_every=3)
+    results = run_batch(range(8), lambda i: slide(1 + i % 4), lambda i, r: store.add(i, r, 1, detection_params),
+                        detection_params, detect_workers=2)
+    store.flush()
+    assert all(r.status == 'ok' for r in results)
+    stored = store.read()
+    assert {i: len(stored[i][0]) for i in stored} == {r.image_id: r.n_regions for r in results}
+
+
+def test_commit_resumes_without_duplicates(tmp_path, detection_params):
+    store = DetectionStore(str(tmp_path / 'store'))
+    for image_id in range(10):
+        store.add(image_id, [(0, 0, 2, 2)] * (image_id % 3), 4, detection_params)
+    store.flush()
+    journal_path = str(tmp_path / 'journal.txt')
+
+    omero = FakeOmero(crash_on=[4, 7])
+    journal = CommitJournal(journal_path)
+    committed, skipped, failed = commit_detections(store, journal, omero.save, workers=3)
+    journal.close()
+    assert (committed, skipped, sorted(failed)) == (8, 0, [4, 7])
+
+    # the previous run died while writing its last line
+    with open(journal_path, 'a') as f:
+        f.write('9 part')
+    journal = CommitJournal(journal_path)
+    assert sorted(journal.committed) == [0, 1, 2, 3, 5, 6, 8, 9]
+    assert commit_detections(store, journal, omero.save) == (2, 8, {})
+    assert omero.saves == 10
+
+    assert omero.rois[5] == [(0, 0, 8, 8)] * 2
+
+    # nothing left to do, until an image is detected again
+    assert commit_detections(store, journal, omero.save) == (0, 10, {})
+    store.add(3, [(1, 1, 2, 2)], 4, detection_params)
+    store.flush()
+    assert commit_detections(store, journal, omero.save) == (1, 9, {})
+    journal.close()
+    assert commit_detections(store, CommitJournal(journal_path), omero.save) == (0, 10, {})
+
+
+@pytest.mark.parametrize('replace', [False, True])
+def test_commit_keeps_hand_drawn_rois_unless_rerun(tmp_path, detection_params, replace):
+    store = DetectionStore(str(tmp_path / 'store'))
+    store.add(1, [(0, 0, 2, 2), (4, 4, 6, 6)], 4, detection_params)
+    store.flush()
+    omero = FakeOmero(replace=replace)
+    omero.rois[1] = [(100, 100, 200, 200)]
+
+    journal = CommitJournal(str(tmp_path / 'journal.txt'))
+    assert commit_detections(store, journal, omero.save) == (1, 0, {})
+    # the image saved again, e.g. after a crash before the journal line: no duplicates either way
+    omero.save(1, [(0, 0, 2, 2), (4, 4, 6, 6)], 4)
+    journal.close()
+    detected = [(0, 0, 8, 8), (16, 16, 24, 24)]
+    assert omero.rois[1] == (detected if replace else [(100, 100, 200, 200)] + detected)
+
+
+def test_journal_ignores_torn_line(tmp_path):
+    path = tmp_path / 'journal.txt'
+    path.write_text('1 part-a.npz\n2 part-a.npz\n3 par')
+    journal = CommitJournal(str(path))
+    assert journal.committed == {1: 'part-a.npz', 2: 'part-a.npz'}
+    assert journal.done(1, 'part-a.npz') and not journal.done(1, 'part-b.npz')
+    journal.close()
@@ -0,0 +1,140 @@
+import numpy as np
+import pytest
+import requests
+
+from detect_rois_omero.src.batch import run_batch
+from detect_rois_omero.src.client_policy import ClientPolicy
+from detect_rois_omero.src.create_rois import create_rois
+from detect_rois_omero.src.create_session import create_json_session
+from detect_rois_omero.src.omero_standin import FakeBlitzGateway, StandInServer, TryAgain
+from detect_rois_omero.src.retrieve_image import ImageClient, ResponseError, get_image, retrieve_image
+from detect_rois_omero.src.refine import create_rois_refined
+from detect_rois_omero.src.tiled import create_rois_tiled
+
+
+@pytest.fixture
+def standin():
+    with StandInServer(images={1: (6400, 3200), 2: (8000, 6000)}, datasets={5: [1, 2]}) as server:
+        yield server
+
+
+def login(standin):
+    login_rsp, session, base_url = create_json_session(standin.host, standin.username, standin.password)
+    return session, base_url
+
+
+def test_needs_login(standin):
+    r = requests.get(standin.base_url + 'm/images/1/')
+    assert r.status_code == 403
+    r = requests.get(standin.host + '/webgateway/render_birds_eye_view/1/100/')
+    assert r.status_code == 403
+
+
+def test_retrieve_image(standin):
+    session, base_url = login(standin)
+    image = retrieve_image(session, base_url, 1, 64)
+    assert image.shape == (50, 100, 3)
+    assert image.dtype == np.uint8
+    # the same slide every time
+    np.testing.assert_array_equal(retrieve_image(session, base_url, 1, 64), image)
+    assert retrieve_image(session, base_url, 2, 64).shape == (94, 125, 3)
+
+
+def test_image_client(standin):
+    session, base_url = login(standin)
+    client = ImageClient(session, base_url)
+    assert client.prefetch_dataset(5) == [1, 2]
+    before = sum(standin.hits.values())
+    assert client.retrieve(2, 32).shape == (188, 250, 3)
+    assert sum(standin.hits.values()) == before + 1
+    tile = client.render_tile(1, 0, 1, 0, 256, 256)
+    assert tile.shape == (256, 256, 3)
+
+
+@pytest.mark.parametrize('factor, scale, tiles', [(2, 16, 4), (4, 16, 4), (4, 8, 0)])
+def test_tiled_detection_picks_the_pyramid_level(factor, scale, tiles):
+    with StandInServer(images={1: (8192, 6144)}, pyramid_factor=factor) as standin:
+        session, base_url = login(standin)
+        client = ImageClient(session, base_url)
+        assert client.zoom_levels(1)[1] == 1 / factor
+        regions = create_rois_tiled(client, 1, 200, 'triangle', 2, scale, tile_size=256)
+        assert len(regions) > 0
+        assert standin.hits['webgateway/render_image_region'] == tiles
+        if not tiles:
+            # no level 8 times smaller in a pyramid of factor 4: the whole birds-eye view instead
+            assert regions == create_rois(client.retrieve(1, scale, True), 200, 'triangle', 2, scale)
+
+
+@pytest.mark.parametrize('fine_scale, tiled', [(16, True), (8, False)])
+def test_refined_detection_picks_the_pyramid_level(fine_scale, tiled):
+    with StandInServer(images={1: (8192, 6144)}, pyramid_factor=4) as standin:
+        session, base_url = login(standin)
+        client = ImageClient(session, base_url)
+        regions = create_rois_refined(client, 1, 200, 'triangle', 2, coarse_scale=64, fine_scale=fine_scale)
+        assert len(regions) > 0
+        assert (standin.hits['webgateway/render_image_region'] > 0) == tiled
+        if not tiled:
+            assert regions == create_rois(client.retrieve(1, fine_scale, True), 200, 'triangle', 2, fine_scale)
+
+
+def test_injected_errors(standin):
+    session, base_url = login(standin)
+    standin.fail_next = 2
+    with pytest.raises(ResponseError) as e:
+        retrieve_image(session, base_url, 1, 64)
+    assert e.value.status_code == 503
+    # the second injected error is absorbed by a retry
+    policy = ClientPolicy(attempts=3, base_delay=0)
+    assert retrieve_image(session, base_url, 1, 64, policy=policy).shape == (50, 100, 3)
+    assert policy.retries == 1
+
+
+def test_latency_and_capacity():
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    with StandInServer(images={1: (640, 320)}, latency=0.1, capacity=1) as standin:
+        session, base_url = login(standin)
+        tic = time.perf_counter()
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(lambda _: requests.get(standin.base_url).status_code, range(4)))
+        # one at a time
+        assert time.perf_counter() - tic >= 0.4
+
+
+def test_detects_the_synthetic_sections(standin):
+    # what test_end_to_end saves, minus the saving (which needs omero-py)
+    session, base_url = login(standin)
+    client = ImageClient(session, base_url)
+    results = run_batch(client.prefetch_dataset(5), lambda i: client.retrieve(i, 16), lambda i, regions: None,
+                        {'size_thresh': 200, 'method_thresh': 'triangle', 'closing': 5, 'scale_factor': 16},
+                        detect_workers=1)
+    assert [r.status for r in results] == ['ok', 'ok']
+    assert all(r.n_regions > 0 for r in results)
+
+
+def test_fake_gateway(standin):
+    conn = FakeBlitzGateway(standin)
+    assert conn.connect()
+    assert get_image(conn, 1).getId() == 1
+    assert get_image(conn, 3) is None
+    assert not FakeBlitzGateway(standin, password='wrong').connect()
+    standin.fail_next = 1
+    with pytest.raises(TryAgain):
+        conn.getObject('Image', 1)
+
+
+def test_end_to_end(standin):
+    pytest.importorskip('omero')
+    from detect_rois_omero.src.save_rois import save_rois
+
+    session, base_url = login(standin)
+    client = ImageClient(session, base_url)
+    conn = FakeBlitzGateway(standin)
+    conn.connect()
+    params = {'size_thresh': 200, 'method_thresh': 'triangle', 'closing': 5, 'scale_factor': 16}
+    results = run_batch(client.prefetch_dataset(5), lambda i: client.retrieve(i, 16),
+                        lambda i, regions: save_rois(get_image(conn, i), regions, 16, True), params, detect_workers=1)
+    assert [r.status for r in results] == ['ok', 'ok']
+    for r in results:
+        assert len(standin.saved_boxes(r.image_id)) == r.n_regions > 0
@@ -0,0 +1,178 @@
+import os
+import tracemalloc
+from io import BytesIO
+
+import numpy as np
+import pytest
+import requests
+
+from detect_rois_omero.src.retrieve_image import ImageClient, fetch_jpeg, list_images, retrieve_image
+
+from .conftest import DATASETS, SIZES, STAMPS
+
+
+def test_retrieve_image(base_url):
+    img = retrieve_image(requests.Session(), base_url, 3, 64)
+    assert img.shape == (50, 103, 3)
+
+
+def test_client_costs_one_request_per_image(server, base_url):
+    client = ImageClient(requests.Session(), base_url, page_size=2)
+    ids = client.prefetch_dataset(10)
+    assert ids == DATASETS[10]
+    listing = sum(server.hits.values())
+    assert server.hits['/api/v0/'] == 1
+    # 5 images, 2 per page
+    assert server.hits['/api/v0/m/images/'] == 3
+
+    for img_id in ids:
+        img = client.retrieve(img_id, 64)
+        assert img.shape[1] == round(SIZES[img_id][0] / 64)
+    assert sum(server.hits.values()) == listing + len(ids) == listing + server.hits['webgateway']
+
+
+def test_client_unknown_image_costs_one_metadata_call(server, base_url):
+    client = ImageClient(requests.Session(), base_url)
+    client.retrieve(7, 32)
+    client.retrieve(7, 64)
+    assert server.hits['/api/v0/m/images/7/'] == 1
+    assert server.hits['/api/v0/'] == 1
+    assert client.image_size(7) == SIZES[7]
+
+
+class FakeQueryConn(object):
+    '''
+    Blitz connection whose query service answers image_sizes' projection from SIZES.
+    '''
+
+    def __init__(self):
+        self.queries = 0
+
+    def getQueryService(self):
+        return self
+
+    def projection(self, query, params, ctx):
+        from omero.rtypes import rint, rlong, rtime, unwrap
+        self.queries += 1
+        ids = unwrap(params.map['ids'])
+        if 'updateEvent' in query:
+            # image update time, no rendering settings
+            return [[rlong(i), rtime(STAMPS[i]), None] for i in ids if i in SIZES]
+        return [[rlong(i), rint(SIZES[i][0]), rint(SIZES[i][1])] for i in ids if i in SIZES]
+
+
+def test_client_prefetch_images(server, base_url):
+    pytest.importorskip('omero')
+    conn = FakeQueryConn()
+    client = ImageClient(requests.Session(), base_url)
+    assert client.prefetch_images(conn, [7, 2, 99]) == [7, 2, 99]
+    assert conn.queries == 1
+    client.retrieve(7, 64)
+    client.retrieve(2, 64)
+    # no metadata calls, just the thumbnails
+    assert server.hits['webgateway'] == 2 and server.hits['/api/v0/m/images/7/'] == 0
+
+
+
+def test_client_only_mounts_a_pool_when_asked(base_url):
+    session = requests.Session()
+    adapter = session.get_adapter(base_url)
+    list_images(session, base_url, dataset_id=11)
+    ImageClient(session, base_url)
+    assert session.get_adapter(base_url) is adapter
+    ImageClient(session, base_url, pool_size=4)
+    assert session.get_adapter(base_url) is not adapter
+    assert session.get_adapter(base_url)._pool_maxsize == 4
+
+def test_list_project_images(base_url):
+    assert list_images(requests.Session(), base_url, project_id=20, page_size=1) == [1, 2, 3, 4, 5, 6, 7]
+    assert list_images(requests.Session(), base_url, dataset_id=11) == [5, 6, 7]
+
+
+def test_retrieve_grayscale_draft(base_url):
+    client = ImageClient(requests.Session(), base_url)
+    rgb = client.retrieve(4, 32)
+    gray = client.retrieve(4, 32, grayscale=True)
+    assert gray.dtype == np.uint8 and gray.shape == rgb.shape[:2]
+    # luma of the solid (200, 40, 0) colour
+    assert abs(int(gray.mean()) - 83) <= 2
+    small = client.retrieve(4, 32, grayscale=True, reduce=2)
+    assert small.shape == (-(-gray.shape[0] // 2), -(-gray.shape[1] // 2))
+
+
+def test_fetch_jpeg_decodes_while_streaming(server):
+    from PIL import Image
+    url = 'http://%s:%d/noise.jpg' % server.server_address
+    session = requests.Session()
+    body = session.get(url).content
+    expected = Image.open(BytesIO(body))
+    expected.draft('L', (expected.size[0] // 8, expected.size[1] // 8))
+
+    # a metrics Recorder(memory=True) may have left tracemalloc running
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        # before Python 3.9 the peak only resets with the traces
+        tracemalloc.clear_traces()
+    before = tracemalloc.get_traced_memory()[0]
+    try:
+        small = fetch_jpeg(session, url, grayscale=True, reduce=8)
+        peak = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    assert np.array_equal(small, np.asarray(expected))
+    # reading the body first would have cost all of it; streamed, only the headers and a block at a time
+    assert len(body) > 500000 and peak < len(body) / 4
+
+
+def test_client_thumbnail_cache(server, tmp_path, base_url):
+    from detect_rois_omero.src.thumbnail_cache import ThumbnailCache
+    cache = ThumbnailCache(str(tmp_path))
+    client = ImageClient(requests.Session(), base_url, cache=cache)
+    client.prefetch_dataset(10)
+    # without a stamp there's no telling a stale entry, so the cache is left alone
+    client.retrieve(2, 64)
+    assert server.hits['webgateway'] == 1 and not cache.entries()
+
+    first = client.retrieve(2, 64, stamp=STAMPS[2])
+    assert server.hits['webgateway'] == 2
+    again = client.retrieve(2, 64, stamp=STAMPS[2])
+    assert isinstance(again, np.memmap) and not again.flags.writeable
+    np.testing.assert_array_equal(first, again)
+    # grayscale and other widths are separate entries
+    client.retrieve(2, 64, grayscale=True, stamp=STAMPS[2])
+    client.retrieve(2, 32, stamp=STAMPS[2])
+    assert server.hits['webgateway'] == 4 and cache.hits == 1
+
+    # a fresh client (e.g. the next run) still hits, until the image is updated
+    rerun = ImageClient(requests.Session(), base_url, cache=ThumbnailCache(str(tmp_path)))
+    np.testing.assert_array_equal(rerun.retrieve(2, 64, stamp=STAMPS[2]), first)
+    assert server.hits['webgateway'] == 4
+    rerun.retrieve(2, 64, stamp=STAMPS[2] + 1)
+    assert server.hits['webgateway'] == 5
+    # the stale entry went when the new one was written
+    assert len([e for e in cache.entries() if os.path.basename(e[2]).startswith('2_102_rgb_1_')]) == 1
+
+    retrieve_image(requests.Session(), base_url, 2, 64, cache=cache, stamp=STAMPS[2] + 1)
+    assert server.hits['webgateway'] == 5
+
+
+def test_client_prefetch_stamps(server, tmp_path, monkeypatch, base_url):
+    pytest.importorskip('omero')
+    from detect_rois_omero.src.thumbnail_cache import ThumbnailCache
+    conn = FakeQueryConn()
+    client = ImageClient(requests.Session(), base_url, cache=ThumbnailCache(str(tmp_path)))
+    client.prefetch_images(conn, [2, 3])
+    # one query for the sizes, one for the stamps
+    assert conn.queries == 2
+    client.retrieve(2, 64)
+    client.retrieve(2, 64)
+    assert server.hits['webgateway'] == 1
+    monkeypatch.setitem(STAMPS, 2, STAMPS[2] + 1)
+    client.prefetch_stamps(conn, [2])
+    client.retrieve(2, 64)
+    assert server.hits['webgateway'] == 2
\ No newline at end of file
@@ -0,0 +1,251 @@
+import importlib
+import sys
+import types
+
+import pytest
+
+
+class FakeRType(object):
+    def __init__(self, value):
+        self._val = value
+
+    def getValue(self):
+        return self._val
+
+
+class FakeObject(object):
+    def __init__(self, obj_id=None, loaded=True):
+        self._id = FakeRType(obj_id) if obj_id is not None else None
+
+    def getId(self):
+        return self._id
+
+    def setId(self, obj_id):
+        self._id = obj_id
+
+
+class FakeRectangleI(FakeObject):
+    x = y = width = height = textValue = theZ = theT = None
+
+    def getX(self):
+        return self.x
+
+    def getY(self):
+        return self.y
+
+    def getWidth(self):
+        return self.width
+
+    def getHeight(self):
+        return self.height
+
+    def getTextValue(self):
+        return self.textValue
+
+
+class FakeRoiI(FakeObject):
+    def __init__(self, obj_id=None, loaded=True):
+        FakeObject.__init__(self, obj_id, loaded)
+        self.image = None
+        self.shapes = []
+
+    def setImage(self, image):
+        self.image = image
+
+    def addShape(self, shape):
+        self.shapes.append(shape)
+
+    def copyShapes(self):
+        return list(self.shapes)
+
+
+def fake_omero():
+    # just what save_rois touches of omero.rtypes and omero.model, for when omero-py isn't installed
+    omero = types.ModuleType('omero')
+    omero.rtypes = types.ModuleType('omero.rtypes')
+    omero.rtypes.rdouble = omero.rtypes.rint = omero.rtypes.rstring = omero.rtypes.rlong = FakeRType
+    omero.model = types.ModuleType('omero.model')
+    omero.model.ImageI, omero.model.RectangleI, omero.model.RoiI = FakeObject, FakeRectangleI, FakeRoiI
+    return {'omero': omero, 'omero.rtypes': omero.rtypes, 'omero.model': omero.model}
+
+
+@pytest.fixture
+def sr(monkeypatch):
+    # save_rois against the real omero-py when it's there, against fake_omero() (for this module only) when not
+    try:
+        import omero.model  # noqa: F401
+    except ImportError:
+        import detect_rois_omero.src
+        for name, module in fake_omero().items():
+            monkeypatch.setitem(sys.modules, name, module)
+        # set, then delete, so that undoing puts back whatever was there before (nothing included)
+        monkeypatch.setitem(sys.modules, 'detect_rois_omero.src.save_rois', None)
+        monkeypatch.delitem(sys.modules, 'detect_rois_omero.src.save_rois')
+        monkeypatch.setattr(detect_rois_omero.src, 'save_rois', None, raising=False)
+        monkeypatch.delattr(detect_rois_omero.src, 'save_rois')
+    return importlib.import_module('detect_rois_omero.src.save_rois')
+
+
+class FakeUpdateService(object):
+    def __init__(self, calls):
+        self.calls = calls
+
+    def saveAndReturnObject(self, roi, ctx):
+        self.calls.append(('saveAndReturnObject', 1, ctx))
+        return roi
+
+    def saveAndReturnArray(self, rois, ctx):
+        self.calls.append(('saveAndReturnArray', len(rois), ctx))
+        return list(rois)
+
+    def saveArray(self, rois, ctx):
+        self.calls.append(('saveArray', len(rois), ctx))
+
+
+class FakeRoi(object):
+    def __init__(self, roi_id):
+        self.roi_id = roi_id
+
+    def getId(self):
+        return self
+
+    def getValue(self):
+        return self.roi_id
+
+
+class FakeRoiService(object):
+    def __init__(self, calls, roi_ids):
+        self.calls = calls
+        self.roi_ids = roi_ids
+
+    def findByImage(self, image_id, options):
+        self.calls.append(('findByImage', image_id))
+
+        class Result(object):
+            rois = [FakeRoi(i) for i in self.roi_ids]
+        return Result()
+
+
+class FakeGateway(object):
+    '''
+    Counts every call save_rois makes against the server.
+    '''
+    def __init__(self, roi_ids=()):
+        self.calls = []
+        self.roi_ids = list(roi_ids)
+
+    def getUpdateService(self):
+        return FakeUpdateService(self.calls)
+
+    def getRoiService(self):
+        return FakeRoiService(self.calls, self.roi_ids)
+
+    def deleteObjects(self, graph_spec, obj_ids, wait=False):
+        self.calls.append(('deleteObjects', graph_spec, list(obj_ids)))
+
+
+class FakeImage(object):
+    def __init__(self, conn, group_id=3):
+        from omero.model import ImageI
+        self._conn = conn
+        self._obj = ImageI(7, False)
+        self.group_id = group_id
+        self.group_lookups = 0
+
+    def getId(self):
+        return 7
+
+    def getDetails(self):
+        self.group_lookups += 1
+        image = self
+
+        class Details(object):
+            def getGroup(self):
+                class Group(object):
+                    def getId(self):
+                        return image.group_id
+                return Group()
+        return Details()
+
+
+REGIONS = [(i, 2 * i, i + 10, 2 * i + 10) for i in range(250)]
+
+
+def test_save_rois_single_bulk_call(sr):
+    conn = FakeGateway()
+    image = FakeImage(conn)
+    saved = sr.save_rois(image, REGIONS, 64, False)
+    assert conn.calls == [('saveAndReturnArray', 250, {'omero.group': '3'})]
+    assert len(saved) == 250 and image.group_lookups == 1
+    shape = saved[4].copyShapes()[0]
+    assert shape.getTextValue().getValue() == 'ROI 5'
+    assert shape.getX().getValue() == 8 * 64 and shape.getHeight().getValue() == 10 * 64
+
+
+def test_save_rois_chunks_and_fire_and_forget(sr):
+    conn = FakeGateway()
+    assert sr.save_rois(FakeImage(conn), REGIONS, 64, False, chunk_size=100, return_objects=False) is None
+    assert [c[:2] for c in conn.calls] == [('saveArray', 100), ('saveArray', 100), ('saveArray', 50)]
+
+
+def test_replace_deletes_with_one_call(sr):
+    conn = FakeGateway(roi_ids=range(100, 140))
+    sr.save_rois(FakeImage(conn), REGIONS[:3], 64, True)
+    assert conn.calls[0] == ('findByImage', 7)
+    assert conn.calls[1] == ('deleteObjects', 'Roi', list(range(100, 140)))
+    assert [c[0] for c in conn.calls[2:]] == ['saveAndReturnArray']
+
+
+def test_replace_without_existing_rois_skips_delete(sr):
+    conn = FakeGateway()
+    sr.remove_all_rois(FakeImage(conn))
+    assert [c[0] for c in conn.calls] == ['findByImage']
+
+
+class FakeRoiServiceWithShapes(object):
+    def __init__(self, calls, rois):
+        self.calls = calls
+        self.rois = rois
+
+    def findByImage(self, image_id, options):
+        self.calls.append(('findByImage', image_id))
+        service = self
+
+        class Result(object):
+            rois = service.rois
+        return Result()
+
+
+def test_sync_rois_only_touches_the_difference(sr):
+    from omero.rtypes import rlong
+    conn = FakeGateway()
+    image = FakeImage(conn)
+    # what a previous run saved: ROI 1 and ROI 2 unchanged, ROI 3 has moved
+    existing = []
+    for i, region in enumerate([(0, 0, 10, 10), (0, 20, 10, 30), (0, 40, 10, 50)], 1):
+        roi = sr.build_roi(image, [sr.create_rectangle(region, i, 64)])
+        roi.setId(rlong(100 + i))
+        existing.append(roi)
+    conn.getRoiService = lambda: FakeRoiServiceWithShapes(conn.calls, existing)
+
+    added, deleted = sr.sync_rois(image, [(0, 0, 10, 10), (0, 20, 10, 30), (0, 45, 10, 55), (20, 0, 30, 10)], 64)
+    assert (added, deleted) == (2, 1)
+    assert ('deleteObjects', 'Roi', [103]) in conn.calls
+    assert ('saveArray', 2, {'omero.group': '3'}) in conn.calls
+
+
+def test_sync_rois_without_delete_only_adds(sr):
+    from omero.rtypes import rlong
+    conn = FakeGateway()
+    image = FakeImage(conn)
+    # one ROI from a previous run, one drawn by hand
+    existing = []
+    for i, (region, label) in enumerate([((0, 0, 10, 10), 1), ((5, 5, 7, 9), 7)], 1):
+        roi = sr.build_roi(image, [sr.create_rectangle(region, label, 64)])
+        roi.setId(rlong(100 + i))
+        existing.append(roi)
+    conn.getRoiService = lambda: FakeRoiServiceWithShapes(conn.calls, existing)
+
+    assert sr.sync_rois(image, [(0, 0, 10, 10), (0, 20, 10, 30)], 64, delete=False) == (1, 0)
+    assert not [c for c in conn.calls if c[0] == 'deleteObjects']
+    assert ('saveArray', 1, {'omero.group': '3'}) in conn.calls
@@ -0,0 +1,81 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from detect_rois_omero.src.thumbnail_cache import ThumbnailCache
+
+
+def thumb(value, shape=(50, 100, 3)):
+    return np.full(shape, value, dtype=np.uint8)
+
+
+def test_round_trip_and_stamps(tmp_path):
+    cache = ThumbnailCache(str(tmp_path))
+    assert cache.get(1, 100, 'a') is None
+    stored = cache.put(1, 100, 'a', thumb(5))
+    assert isinstance(stored, np.memmap)
+    np.testing.assert_array_equal(cache.get(1, 100, 'a'), thumb(5))
+    assert cache.get(1, 100, 'b') is None and cache.get(1, 101, 'a') is None
+    assert cache.get(1, 100, 'a', grayscale=True) is None
+    cache.put(1, 100, 'b', thumb(6))
+    assert cache.get(1, 100, 'a') is None
+    assert len(cache.entries()) == 1
+    assert (cache.hits, cache.misses) == (1, 5)
+
+    calls = []
+    fetched = cache.get_or_fetch(2, 100, None, lambda: calls.append(1) or thumb(7))
+    again = cache.get_or_fetch(2, 100, None, lambda: calls.append(1) or thumb(8))
+    assert len(calls) == 1 and again[0, 0, 0] == fetched[0, 0, 0] == 7
+
+
+def test_lru_eviction(tmp_path):
+    # room for 3.5 thumbnails, evicting down to 90% of that leaves 3
+    cache = ThumbnailCache(str(tmp_path), max_bytes=7 * (50 * 100 * 3 + 128) // 2)
+    for img_id in range(3):
+        cache.put(img_id, 100, 0, thumb(img_id))
+        time.sleep(0.01)
+    # touching 0 makes 1 the least recently used
+    cache.get(0, 100, 0)
+    time.sleep(0.01)
+    cache.put(3, 100, 0, thumb(3))
+    assert [cache.get(i, 100, 0) is not None for i in range(4)] == [True, False, True, True]
+    assert cache.size() <= cache.max_bytes
+
+
+def test_scans_only_when_full(tmp_path):
+    entry = 20 * 20 + 128
+    cache = ThumbnailCache(str(tmp_path), max_bytes=50 * entry)
+    for img_id in range(45):
+        cache.put(img_id, 20, 0, np.zeros((20, 20), np.uint8))
+    # the one scan up front
+    assert cache.scans == 1
+    # an update replaces the entry without a scan
+    cache.put(3, 20, 1, np.zeros((20, 20), np.uint8))
+    assert cache.scans == 1 and len(cache.entries()) == 45
+    for img_id in range(45, 56):
+        cache.put(img_id, 20, 0, np.zeros((20, 20), np.uint8))
+    # full once, evicted down to 90%, then room for a few more
+    assert cache.scans == 2
+    assert cache.size() <= cache.max_bytes
+
+
+def fill(args):
+    path, worker = args
+    cache = ThumbnailCache(path, max_bytes=20 * (20 * 20 + 128))
+    for i in range(40):
+        img_id = (i * 7 + worker) % 30
+        image = cache.get_or_fetch(img_id, 20, 0, lambda: np.full((20, 20), img_id, dtype=np.uint8))
+        assert (image == img_id).all()
+    return True
+
+
+def test_shared_between_processes(tmp_path):
+    with ProcessPoolExecutor(4) as pool:
+        assert all(pool.map(fill, [(str(tmp_path), w) for w in range(8)]))
+    # each process only counts its own writes between scans, the next eviction catches up with the others'
+    cache = ThumbnailCache(str(tmp_path), max_bytes=20 * (20 * 20 + 128))
+    cache.evict()
+    assert cache.size() <= cache.max_bytes
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.tmp')]
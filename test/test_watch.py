@@ -0,0 +1,107 @@
+import json
+
+import pytest
+
+from detect_rois_omero.src.watch import Watcher, WatchState
+
+
+class FakeServer(object):
+    '''
+    Images with update times, listed past a mark like new_images does; counts how many images it had to look at.
+    '''
+
+    def __init__(self, n, slide, detection_params):
+        self.slide = slide
+        self.detection_params = detection_params
+        self.times = {i: 1000 + i for i in range(1, n + 1)}
+        self.listed = 0
+        self.broken = set()
+        self.saved = {}
+
+    def list_new(self, by):
+        def list_new(mark, limit):
+            keys = sorted(([t, i] if by == 'time' else [i], i) for i, t in self.times.items())
+            page = [(i, key) for key, i in keys if mark is None or key > mark][:limit]
+            self.listed += len(page)
+            return page
+        return list_new
+
+    def fetch_image(self, image_id):
+        if image_id in self.broken:
+            raise IOError('not imported yet')
+        return self.slide(1 + image_id % 3)
+
+    def save_regions(self, image_id, regions):
+        self.saved[image_id] = len(regions)
+
+
+@pytest.fixture
+def make_server(slide, detection_params):
+    return lambda n: FakeServer(n, slide, detection_params)
+
+
+def watcher(server, state, by='id', **kwargs):
+    return Watcher(state, server.list_new(by), server.fetch_image, server.save_regions, server.detection_params,
+                   detect_workers=1, **kwargs)
+
+
+def test_watch_only_new_images(tmp_path, make_server):
+    server = make_server(25)
+    state = WatchState(str(tmp_path / 'state.json'))
+    results = watcher(server, state, page_size=10).poll()
+    assert sorted(r.image_id for r in results) == list(range(1, 26))
+    assert server.saved[4] == 2
+    assert state.mark == [25]
+
+    # nothing new: nothing processed, nothing listed
+    server.listed = 0
+    assert watcher(server, state, page_size=10).poll() == []
+    assert server.listed == 0
+
+    # the steady state only looks at the new images, and the mark survives a restart
+    server.times.update({26: 2000, 27: 2001})
+    server.saved.clear()
+    results = watcher(server, WatchState(str(tmp_path / 'state.json')), page_size=10).poll()
+    assert sorted(server.saved) == [26, 27]
+    assert server.listed == 2
+    assert json.load(open(str(tmp_path / 'state.json')))['mark'] == [27]
+
+
+def test_watch_updated_images(tmp_path, make_server):
+    server = make_server(5)
+    state = WatchState(str(tmp_path / 'state.json'))
+    watcher(server, state, by='time').poll()
+    assert state.mark == [1005, 5]
+    server.saved.clear()
+    server.times[2] = 3000
+    watcher(server, state, by='time').poll()
+    assert list(server.saved) == [2]
+    assert state.mark == [3000, 2]
+
+
+def test_watch_retries_failed_images(tmp_path, make_server):
+    server = make_server(6)
+    server.broken = {3}
+    path = str(tmp_path / 'state.json')
+    w = watcher(server, WatchState(path), max_attempts=3)
+    results = w.poll()
+    assert [r.image_id for r in results if r.status == 'failed'] == [3]
+    # a broken image doesn't hold the mark back
+    assert w.state.mark == [6]
+    assert WatchState(path).failed == {3: 1}
+
+    w.poll()
+    assert WatchState(path).failed == {3: 2}
+    # fixed in the meantime
+    server.broken.clear()
+    server.saved.clear()
+    w.poll()
+    assert list(server.saved) == [3]
+    assert WatchState(path).failed == {}
+
+    server.broken = {7}
+    server.times[7] = 3000
+    for _ in range(3):
+        w.poll()
+    assert w.given_up == [7]
+    assert WatchState(path).failed == {}
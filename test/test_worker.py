@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+import requests
+
+from detect_rois_omero.src.worker import DirectoryQueue, SQLiteQueue, Worker
+
+
+PARAMS = {'size_thresh': 0, 'method_thresh': 'otsu', 'closing': 1, 'scale_factor': 64}
+
+
+class FakeConn(object):
+    def __init__(self):
+        self.alive = True
+
+    def keepAlive(self):
+        return self.alive
+
+    def close(self):
+        self.alive = False
+
+
+# what Ice raises on a call with an expired session
+SessionTimeoutException = type('SessionTimeoutException', (Exception,), {})
+
+
+class RecordingWorker(Worker):
+    # everything but the OMERO calls, which need omero-py; expire = {'lookup' or 'save': times left to fail}
+    def __init__(self, *args, **kwargs):
+        super(RecordingWorker, self).__init__(*args, **kwargs)
+        self.saved = {}
+        self.saves = 0
+        self.expire = {}
+
+    def expired(self, step):
+        if self.expire.get(step):
+            self.expire[step] -= 1
+            raise SessionTimeoutException('session expired')
+
+    def lookup(self, image_id):
+        self.expired('lookup')
+        return image_id
+
+    def save(self, image_id, regions, params):
+        self.saves += 1
+        self.expired('save')
+        self.saved[image_id] = (self.conn, list(regions), params)
+
+
+def make_queue(kind, tmp_path):
+    return DirectoryQueue(str(tmp_path / 'jobs')) if kind == 'dir' else SQLiteQueue(str(tmp_path / 'jobs.sqlite'))
+
+
+def make_worker(queue, base_url, **kwargs):
+    def connect_json():
+        return requests.Session(), base_url
+    return RecordingWorker(queue, connect_json, FakeConn, PARAMS, poll=0.01, **kwargs)
+
+
+@pytest.mark.parametrize('kind', ['dir', 'sqlite'])
+def test_worker_processes_queue_with_one_login(kind, tmp_path, base_url):
+    queue = make_queue(kind, tmp_path)
+    for image_id in [1, 2, 3]:
+        queue.submit(image_id)
+    queue.submit(4, {'closing': 0, 'method_thresh': 'triangle'})
+    queue.submit(99)
+
+    worker = make_worker(queue, base_url)
+    assert worker.run(idle_exit=0) == 5
+    assert worker.logins == 1  # a missing image is no reason to log in again
+    assert sorted(worker.saved) == [1, 2, 3, 4]
+    assert worker.saved[4][2]['method_thresh'] == 'triangle' and worker.saved[4][2]['closing'] == 0
+    assert queue.claim() is None
+    if kind == 'sqlite':
+        assert queue.counts() == {'done': 4, 'failed': 1}
+
+
+def test_worker_reconnects_when_session_expires(tmp_path, base_url):
+    queue = make_queue('sqlite', tmp_path)
+    worker = make_worker(queue, base_url, keepalive=0)
+    worker.warm_up()
+    first = worker.conn
+
+    queue.submit(1)
+    worker.expire = {'lookup': 1}
+    assert worker.run(max_jobs=1) == 1
+    assert worker.logins == 2 and worker.saved[1][0] is not first and not first.alive
+
+    # idle: a dead Blitz session is noticed by the keep-alive ping
+    worker.conn.alive = False
+    worker.run(idle_exit=0.05)
+    assert worker.logins == 3 and worker.conn.alive
+    assert queue.counts() == {'done': 1}
+
+
+def test_worker_never_saves_twice_without_replace(tmp_path, base_url):
+    queue = make_queue('sqlite', tmp_path)
+    worker = make_worker(queue, base_url)
+    worker.warm_up()
+
+    # the save may have added some ROIs before the session expired: adding them again would duplicate them
+    queue.submit(1)
+    worker.expire = {'save': 1}
+    worker.run(max_jobs=1)
+    assert worker.saves == 1 and worker.logins == 1
+    assert queue.counts() == {'failed': 1}
+
+    # replacing is safe to repeat
+    queue.submit(2, {'replace': True})
+    worker.expire = {'save': 1}
+    worker.run(max_jobs=1)
+    assert worker.saves == 3 and worker.logins == 2 and 2 in worker.saved
+    assert queue.counts() == {'done': 1, 'failed': 1}
+
+
+@pytest.mark.parametrize('kind', ['dir', 'sqlite'])
+def test_queue_recovers_lost_jobs(kind, tmp_path):
+    queue = make_queue(kind, tmp_path)
+    for image_id in [1, 2]:
+        queue.submit(image_id)
+    # a worker claims both and dies
+    lost = [queue.claim(), queue.claim()]
+    assert queue.claim() is None
+    assert queue.recover(lease=60) == (0, 0)
+
+    time.sleep(0.05)
+    assert make_queue(kind, tmp_path).recover(lease=0.01) == (2, 0)
+    assert sorted(queue.claim().image_id for _ in lost) == [1, 2]
+
+    # lost once more, then given up on as a likely worker killer
+    time.sleep(0.05)
+    assert queue.recover(lease=0.01, max_attempts=2) == (0, 2)
+    assert queue.claim() is None
+    if kind == 'sqlite':
+        assert queue.counts() == {'failed': 2}
+        assert queue._db.execute('SELECT error FROM jobs').fetchone()[0] == 'worker lost the job 2 times'
+    else:
+        failed = os.listdir(str(tmp_path / 'jobs' / 'failed'))
+        assert len(failed) == 2 and not os.listdir(str(tmp_path / 'jobs' / 'running'))
+        with open(str(tmp_path / 'jobs' / 'failed' / failed[0])) as f:
+            assert json.load(f)['error'] == 'worker lost the job 2 times'
+
+
+def test_worker_recovers_lost_jobs(tmp_path, base_url):
+    queue = make_queue('dir', tmp_path)
+    queue.submit(1)
+    queue.claim()
+    time.sleep(0.05)
+    worker = make_worker(queue, base_url, lease=0.01)
+    assert worker.run(idle_exit=0) == 1
+    assert list(worker.saved) == [1]
+    assert len(os.listdir(str(tmp_path / 'jobs' / 'done'))) == 1
+
+
+@pytest.mark.parametrize('kind', ['dir', 'sqlite'])
+def test_queue_claims_are_exclusive(kind, tmp_path):
+    queue = make_queue(kind, tmp_path)
+    for image_id in range(200):
+        queue.submit(image_id)
+    claimed = []
+
+    def drain():
+        # every worker has its own handle on the queue
+        own = make_queue(kind, tmp_path)
+        while True:
+            job = own.claim()
+            if job is None:
+                return
+            claimed.append(job.image_id)
+            own.complete(job, {})
+
+    threads = [threading.Thread(target=drain) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(claimed) == list(range(200))